@@ -0,0 +1,246 @@
+import os
+import json
+import logging
+import datetime
+import collections
+import numpy
+import sqlalchemy
+from database import *
+
+DEFAULT_CACHE_DIR = 'analytics'
+BOUNCE_STATUSES = (ExMailStatus.REJECTED, ExMailStatus.SEND_FAILURE)
+
+
+class Dictionary:
+    '''字典编码：把字符串列转换为整数编码，values[code] 为原值'''
+
+    def __init__(self) -> None:
+        self.codes = {}
+        self.values = []
+
+    def encode(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class Frame:
+    '''一天数据的列式表示：数值列为 numpy 数组，字符串列字典编码'''
+
+    def __init__(self, columns: dict, dictionaries: dict) -> None:
+        self.columns = columns
+        self.dictionaries = dictionaries
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, name: str) -> numpy.ndarray:
+        return self.columns[name]
+
+
+def _dayRange(day: datetime.date) -> tuple:
+    start = datetime.datetime.combine(day, datetime.time())
+    return start, start + datetime.timedelta(days=1)
+
+
+def loadFrame(db: sqlalchemy.engine.Engine, model, day: datetime.date, encoded: tuple, batchSize: int = DEFAULT_BATCH_SIZE) -> Frame:
+    '''
+    读取一天的数据：time 转为秒级时间戳，枚举列取其值，encoded 中的列做字典编码
+    字典按列共享，如 sender 与 receiver 使用同一字典，编码可直接比较
+    '''
+    start, end = _dayRange(day)
+    table = model.__table__
+    names = ['time'] + [c.name for c in table.columns if c.name not in ('id', 'time', 'content_hash')]
+    enums = {c.name for c in table.columns if getattr(c.type, 'enum_class', None) is not None}
+    dictionary = Dictionary()
+    values = {n: [] for n in names}
+    stmt = sqlalchemy.select(*[table.c[n] for n in names]) \
+        .where(table.c.time >= start, table.c.time < end) \
+        .execution_options(yield_per=batchSize)
+    with sqlalchemy.orm.Session(db) as session:
+        for row in session.execute(stmt):
+            values['time'].append(row[0].timestamp())
+            for name, value in zip(names[1:], row[1:]):
+                if name in encoded:
+                    value = dictionary.encode(value)
+                elif name in enums:
+                    value = value.value if value is not None else -1
+                values[name].append(value)
+    columns = {'time': numpy.array(values['time'], dtype=numpy.int64)}
+    for name in names[1:]:
+        if name in encoded:
+            columns[name] = numpy.array(values[name], dtype=numpy.int32)
+        elif name in enums:
+            columns[name] = numpy.array(values[name], dtype=numpy.int16)
+    return Frame(columns, {name: dictionary for name in encoded})
+
+
+def countBy(codes: numpy.ndarray, dictionary: Dictionary, mask: numpy.ndarray = None) -> dict:
+    '''按编码分组计数，返回 原值 -> 次数'''
+    if mask is not None:
+        codes = codes[mask]
+    counts = numpy.bincount(codes, minlength=len(dictionary))
+    nonzero = numpy.flatnonzero(counts)
+    return {dictionary.values[i]: int(counts[i]) for i in nonzero}
+
+
+def distinctPairs(left: numpy.ndarray, right: numpy.ndarray, dictionary: Dictionary) -> list:
+    '''两列编码组合后去重，返回原值对列表'''
+    if len(left) == 0:
+        return []
+    width = numpy.int64(len(dictionary))
+    keys = numpy.unique(left.astype(numpy.int64) * width + right)
+    return [[dictionary.values[k // width], dictionary.values[k % width]] for k in keys.tolist()]
+
+
+def loginDay(frame: Frame) -> dict:
+    '''单日登录统计：每个 IP 的登录次数与 (邮箱, IP) 组合'''
+    dictionary = frame.dictionaries['address']
+    return {
+        'rows': len(frame),
+        'logins': countBy(frame['ip'], dictionary),
+        'pairs': distinctPairs(frame['address'], frame['ip'], dictionary)
+    }
+
+
+def mailDay(frame: Frame, domains: set) -> dict:
+    '''单日邮件统计：外部发件人的来信数，以及每个发件人的发信数与退信数'''
+    dictionary = frame.dictionaries['sender']
+    # 只对字典中的不同值判断是否为外部地址，再按编码广播
+    external = numpy.array([v is not None and v.rsplit('@', 1)[-1].lower() not in domains for v in dictionary.values], dtype=bool)
+    received = frame['type'] == ExMailType.RECEIVE.value
+    sent = frame['type'] == ExMailType.SEND.value
+    bounced = sent & numpy.isin(frame['status'], [s.value for s in BOUNCE_STATUSES])
+    fromExternal = received & external[frame['sender']]
+    return {
+        'rows': len(frame),
+        'external': countBy(frame['sender'], dictionary, fromExternal),
+        'sent': countBy(frame['sender'], dictionary, sent),
+        'bounced': countBy(frame['sender'], dictionary, bounced)
+    }
+
+
+def _days(start: datetime.date, end: datetime.date):
+    d = start
+    while d <= end:
+        yield d
+        d += datetime.timedelta(days=1)
+
+
+def _top(counts: dict, top: int) -> list:
+    return sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))[:top]
+
+
+class Analytics:
+    '''
+    登录与邮件日志的分析报表
+    每天的聚合结果缓存在 cacheDir 中，以当天数据的版本（见 _version）与计算参数（如内部域名）校验，
+    数据变化（如回填或邮件状态更新）或参数变化后自动重算
+    '''
+
+    def __init__(self, db: sqlalchemy.engine.Engine, cacheDir: str = DEFAULT_CACHE_DIR, domains: list = None,
+                 batchSize: int = DEFAULT_BATCH_SIZE) -> None:
+        self.db = db
+        self.cacheDir = cacheDir
+        self.batchSize = batchSize
+        self._domains = {d.lower() for d in domains} if domains else None
+
+    def domains(self) -> set:
+        '''内部域名，未配置时取邮箱表中出现的域名'''
+        if self._domains is None:
+            with sqlalchemy.orm.Session(self.db) as session:
+                self._domains = {a.rsplit('@', 1)[-1].lower() for a in session.scalars(sqlalchemy.select(MailBox.address))}
+        return self._domains
+
+    def _version(self, model, day: datetime.date) -> list:
+        '''
+        当天数据的版本：行数、最大 id，以及不参与摘要的枚举列（如邮件的 status）按 id 加权的和
+        这些列由 upsert 原地更新，行数与最大 id 不会因此变化
+        '''
+        start, end = _dayRange(day)
+        table = model.__table__
+        columns = [sqlalchemy.func.count(), sqlalchemy.func.max(table.c.id)]
+        for c in table.columns:
+            enumClass = getattr(c.type, 'enum_class', None)
+            if enumClass is not None and c.name not in model.dedupFields:
+                code = sqlalchemy.case(*[(c == m, m.value + 1) for m in enumClass], else_=0)
+                columns.append(sqlalchemy.func.sum(table.c.id * code))
+        stmt = sqlalchemy.select(*columns).where(table.c.time >= start, table.c.time < end)
+        with sqlalchemy.orm.Session(self.db) as session:
+            return [int(v) if v is not None else None for v in session.execute(stmt).one()]
+
+    def _day(self, report: str, model, day: datetime.date, compute, params: list = None) -> dict:
+        path = os.path.join(self.cacheDir, report, f'{day.isoformat()}.json')
+        version = self._version(model, day) + (params or [])
+        if os.path.exists(path):
+            with open(path) as fp:
+                cached = json.load(fp)
+            if cached['version'] == version:
+                return cached['result']
+        frame = loadFrame(self.db, model, day, ('address', 'ip') if model is LoginLog else ('sender', 'receiver'), self.batchSize)
+        result = compute(frame)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpName = path + '.tmp'
+        with open(tmpName, 'w') as fp:
+            json.dump({'version': version, 'result': result}, fp, ensure_ascii=False)
+        os.replace(tmpName, path)
+        logging.info(f'Computed {report} for {day.isoformat()} from {len(frame)} rows')
+        return result
+
+    def loginDays(self, start: datetime.date, end: datetime.date):
+        for day in _days(start, end):
+            yield day, self._day('login', LoginLog, day, loginDay)
+
+    def mailDays(self, start: datetime.date, end: datetime.date):
+        domains = self.domains()
+        for day in _days(start, end):
+            yield day, self._day('mail', MailLog, day, lambda frame: mailDay(frame, domains), [sorted(domains)])
+
+    def loginsPerIp(self, start: datetime.date, end: datetime.date, top: int = 20) -> list:
+        '''登录次数最多的 IP 及其登录用户数'''
+        logins = collections.Counter()
+        users = collections.defaultdict(set)
+        for _, result in self.loginDays(start, end):
+            logins.update(result['logins'])
+            for address, ip in result['pairs']:
+                users[ip].add(address)
+        return [{'ip': ip, 'logins': n, 'users': len(users[ip])} for ip, n in _top(logins, top)]
+
+    def newIps(self, start: datetime.date, end: datetime.date, lookback: int = 30) -> list:
+        '''[start, end] 内每个用户首次出现的登录 IP，基线为 start 之前 lookback 天'''
+        seen = set()
+        for _, result in self.loginDays(start - datetime.timedelta(days=lookback), start - datetime.timedelta(days=1)):
+            seen.update(map(tuple, result['pairs']))
+        found = []
+        for day, result in self.loginDays(start, end):
+            for address, ip in result['pairs']:
+                if (address, ip) not in seen:
+                    seen.add((address, ip))
+                    found.append({'date': day.isoformat(), 'address': address, 'ip': ip})
+        return found
+
+    def topExternalSenders(self, start: datetime.date, end: datetime.date, top: int = 20) -> list:
+        '''来信最多的外部发件人'''
+        counts = collections.Counter()
+        for _, result in self.mailDays(start, end):
+            counts.update(result['external'])
+        return [{'sender': sender, 'mails': n} for sender, n in _top(counts, top)]
+
+    def bounceRates(self, start: datetime.date, end: datetime.date, minSent: int = 20, top: int = 20) -> dict:
+        '''整体与各发件人的退信率，只统计发信数不少于 minSent 的发件人'''
+        sent, bounced = collections.Counter(), collections.Counter()
+        daily = []
+        for day, result in self.mailDays(start, end):
+            sent.update(result['sent'])
+            bounced.update(result['bounced'])
+            s, b = sum(result['sent'].values()), sum(result['bounced'].values())
+            daily.append({'date': day.isoformat(), 'sent': s, 'bounced': b, 'rate': round(b / s, 4) if s > 0 else None})
+        rates = {k: bounced[k] / n for k, n in sent.items() if n >= minSent}
+        senders = [{'sender': k, 'sent': sent[k], 'bounced': bounced[k], 'rate': round(r, 4)}
+                   for k, r in sorted(rates.items(), key=lambda kv: (-kv[1], kv[0]))[:top]]
+        return {'daily': daily, 'senders': senders}
@@ -0,0 +1,305 @@
+import os
+import json
+import zlib
+import time
+import enum
+import queue
+import struct
+import logging
+import datetime
+import threading
+import collections
+import sqlalchemy
+from database import *
+
+DEFAULT_BLOCK_ROWS = 4096
+DEFAULT_FLUSH_ROWS = 100000
+
+ARCHIVE_MODELS = {'login': LoginLog, 'mail': MailLog, 'op': OpLog}
+# 按邮箱检索时使用的列
+ADDRESS_FIELDS = {'login': ('address',), 'mail': ('sender', 'receiver'), 'op': ('operator', 'operand')}
+
+_HEADER = struct.Struct('>I')
+_SEGMENT_SUFFIX = '.blk'
+_INDEX_SUFFIX = '.idx.json'
+
+
+def _encode(row: dict) -> dict:
+    '''时间存为秒级时间戳，枚举存为名称（与数据库一致）'''
+    record = {}
+    for k, v in row.items():
+        if k == 'content_hash':
+            # 可由其余字段重新计算，且几乎无法压缩
+            continue
+        if isinstance(v, datetime.datetime):
+            v = int(v.timestamp())
+        elif isinstance(v, enum.Enum):
+            v = v.name
+        record[k] = v
+    return record
+
+
+class _Segment:
+    '''
+    一个只追加的分段文件：由独立压缩的数据块组成，每块前有 4 字节长度
+    旁路索引记录每块的偏移、时间范围，以及每个邮箱出现在哪些块中
+    '''
+
+    def __init__(self, directory: str, name: str) -> None:
+        self.path = os.path.join(directory, name + _SEGMENT_SUFFIX)
+        self.indexPath = os.path.join(directory, name + _INDEX_SUFFIX)
+        self._fp = open(self.path, 'ab')
+        self.blocks = []
+        self.addresses = collections.defaultdict(set)
+
+    def append(self, records: list, addressFields: tuple) -> None:
+        payload = zlib.compress('\n'.join(json.dumps(r, ensure_ascii=False) for r in records).encode(), 6)
+        offset = self._fp.tell()
+        self._fp.write(_HEADER.pack(len(payload)))
+        self._fp.write(payload)
+        times = [r['time'] for r in records]
+        blockNo = len(self.blocks)
+        self.blocks.append({'offset': offset + _HEADER.size, 'length': len(payload), 'rows': len(records),
+                            'minTime': min(times), 'maxTime': max(times)})
+        for r in records:
+            for field in addressFields:
+                if r.get(field):
+                    self.addresses[r[field]].add(blockNo)
+
+    def close(self) -> None:
+        '''落盘后再原子写入索引，没有索引的分段视为未完成'''
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._fp.close()
+        index = {
+            'blocks': self.blocks,
+            'addresses': {a: sorted(b) for a, b in self.addresses.items()}
+        }
+        tmpName = self.indexPath + '.tmp'
+        with open(tmpName, 'w') as fp:
+            json.dump(index, fp, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmpName, self.indexPath)
+
+
+class ArchiveWriter:
+    '''
+    按 日志类型/日期 分区写入压缩归档：root/<logType>/<YYYY-MM-DD>/part-*.blk
+    每 blockRows 行压缩为一个数据块，flush() 后数据与索引才可见
+    '''
+
+    def __init__(self, root: str, logType: str, blockRows: int = DEFAULT_BLOCK_ROWS) -> None:
+        if logType not in ARCHIVE_MODELS:
+            raise ValueError(f'Unknown log type {logType}')
+        self.root = root
+        self.logType = logType
+        self.blockRows = blockRows
+        self._buffers = collections.defaultdict(list)
+        self._segments = {}
+        self._lock = threading.Lock()
+        self._sequence = 0
+
+    def _segment(self, day: str) -> _Segment:
+        segment = self._segments.get(day)
+        if segment is None:
+            directory = os.path.join(self.root, self.logType, day)
+            os.makedirs(directory, exist_ok=True)
+            self._sequence += 1
+            name = f'part-{time.time_ns()}-{os.getpid()}-{self._sequence}'
+            segment = self._segments[day] = _Segment(directory, name)
+        return segment
+
+    def write(self, rows: list) -> None:
+        with self._lock:
+            for row in rows:
+                day = row['time'].date().isoformat()
+                buffer = self._buffers[day]
+                buffer.append(_encode(row))
+                if len(buffer) >= self.blockRows:
+                    self._segment(day).append(buffer, ADDRESS_FIELDS[self.logType])
+                    self._buffers[day] = []
+
+    def flush(self) -> None:
+        with self._lock:
+            for day, buffer in self._buffers.items():
+                if len(buffer) > 0:
+                    self._segment(day).append(buffer, ADDRESS_FIELDS[self.logType])
+            self._buffers.clear()
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.flush()
+
+
+class ArchiveReader:
+    '''只读取与时间范围或邮箱匹配的分区与数据块'''
+
+    def __init__(self, root: str, logType: str) -> None:
+        if logType not in ARCHIVE_MODELS:
+            raise ValueError(f'Unknown log type {logType}')
+        self.root = root
+        self.logType = logType
+        table = ARCHIVE_MODELS[logType].__table__
+        self._enums = {c.name: c.type.enum_class for c in table.columns if getattr(c.type, 'enum_class', None) is not None}
+
+    def partitions(self, start: datetime.date = None, end: datetime.date = None) -> list:
+        '''返回 [start, end] 内存在的日期分区'''
+        directory = os.path.join(self.root, self.logType)
+        if not os.path.isdir(directory):
+            return []
+        days = []
+        for name in sorted(os.listdir(directory)):
+            try:
+                day = datetime.date.fromisoformat(name)
+            except ValueError:
+                continue
+            if (start is None or day >= start) and (end is None or day <= end):
+                days.append(day)
+        return days
+
+    def _segments(self, day: datetime.date) -> list:
+        directory = os.path.join(self.root, self.logType, day.isoformat())
+        result = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(_INDEX_SUFFIX):
+                with open(os.path.join(directory, name)) as fp:
+                    result.append((os.path.join(directory, name[:-len(_INDEX_SUFFIX)] + _SEGMENT_SUFFIX), json.load(fp)))
+        return result
+
+    def _decode(self, record: dict) -> dict:
+        record['time'] = datetime.datetime.fromtimestamp(record['time'])
+        for name, enumClass in self._enums.items():
+            if record.get(name) is not None:
+                record[name] = enumClass[record[name]]
+        return record
+
+    def scan(self, start: datetime.datetime = None, end: datetime.datetime = None, address: str = None):
+        '''
+        按时间顺序逐条返回 [start, end) 内（且与 address 相关）的记录，格式与写入数据库的行相同
+        通过索引跳过时间范围不重叠或不含该邮箱的数据块
+        '''
+        startTs = int(start.timestamp()) if start is not None else None
+        endTs = int(end.timestamp()) if end is not None else None
+        fields = ADDRESS_FIELDS[self.logType]
+        days = self.partitions(start.date() if start is not None else None, end.date() if end is not None else None)
+        for day in days:
+            records = []
+            for path, index in self._segments(day):
+                blocks = range(len(index['blocks']))
+                if address is not None:
+                    blocks = index['addresses'].get(address, [])
+                with open(path, 'rb') as fp:
+                    for blockNo in blocks:
+                        block = index['blocks'][blockNo]
+                        if startTs is not None and block['maxTime'] < startTs:
+                            continue
+                        if endTs is not None and block['minTime'] >= endTs:
+                            continue
+                        fp.seek(block['offset'])
+                        for line in zlib.decompress(fp.read(block['length'])).decode().split('\n'):
+                            r = json.loads(line)
+                            if startTs is not None and r['time'] < startTs:
+                                continue
+                            if endTs is not None and r['time'] >= endTs:
+                                continue
+                            if address is not None and all(r.get(f) != address for f in fields):
+                                continue
+                            records.append(r)
+            records.sort(key=lambda r: r['time'])
+            for r in records:
+                yield self._decode(r)
+
+    def stats(self) -> dict:
+        '''各分区的分段数、行数与压缩后字节数'''
+        result = {}
+        for day in self.partitions():
+            segments = self._segments(day)
+            result[day.isoformat()] = {
+                'segments': len(segments),
+                'rows': sum(b['rows'] for _, index in segments for b in index['blocks']),
+                'bytes': sum(os.path.getsize(path) for path, _ in segments)
+            }
+        return result
+
+
+def archiveWorker(writer: ArchiveWriter, rowQueue: queue.Queue, flushRows: int, state, stop=None, flushInterval: float = None):
+    '''
+    流水线的归档写入线程：数据写入归档而不是数据库
+    每 flushRows 行或队列空闲 flushInterval 秒后落盘一次，落盘后才通知流水线对应任务已完成
+    '''
+    tasks = collections.Counter()
+    pending = 0
+
+    def flush():
+        nonlocal pending
+        if len(tasks) == 0:
+            return
+        ok = False
+        try:
+            writer.flush()
+            ok = True
+        except Exception as ex:
+            logging.error(f'Error flushing {pending} rows into archive {writer.root}, reason: {repr(ex)}')
+        state.written(tasks, pending if ok else 0, ok)
+        tasks.clear()
+        pending = 0
+
+    while True:
+        try:
+            item = rowQueue.get(timeout=flushInterval)
+        except queue.Empty:
+            flush()
+            continue
+        if item is stop:
+            break
+        task, rows = item
+        writer.write(rows)
+        tasks[task] += 1
+        pending += len(rows)
+        if pending >= flushRows:
+            flush()
+    flush()
+
+
+def moveToArchive(db: sqlalchemy.engine.Engine, root: str, logType: str, before: datetime.datetime,
+                  batchSize: int = DEFAULT_BATCH_SIZE, flushRows: int = DEFAULT_FLUSH_ROWS) -> int:
+    '''
+    将 before 之前的日志从数据表移入归档，每 flushRows 行先落盘归档再删除对应数据行
+    在两者之间中断时，重新运行会使这部分记录在归档中重复出现一次，但不会丢失
+    '''
+    model = ARCHIVE_MODELS[logType]
+    table = model.__table__
+    columns = [c for c in table.columns if not c.primary_key and c.name != 'content_hash']
+    moved = 0
+    ids = []
+    writer = ArchiveWriter(root, logType)
+
+    def flush():
+        nonlocal moved
+        writer.flush()
+        with sqlalchemy.orm.Session(db) as session:
+            session.begin()
+            for i in range(0, len(ids), batchSize):
+                session.execute(sqlalchemy.delete(table).where(table.c.id.in_(ids[i:i + batchSize])))
+            session.commit()
+        moved += len(ids)
+        logging.info(f'Moved {moved} rows from {model.__tablename__} into archive {root}')
+        ids.clear()
+
+    while True:
+        # 每轮重新查询，删除后的数据不会再被读到
+        stmt = sqlalchemy.select(table.c.id, *columns).where(table.c.time < before) \
+            .order_by(table.c.id).limit(flushRows)
+        with sqlalchemy.orm.Session(db) as session:
+            rows = session.execute(stmt).all()
+        if len(rows) == 0:
+            break
+        for row in rows:
+            ids.append(row[0])
+        writer.write([{c.name: v for c, v in zip(columns, row[1:])} for row in rows])
+        flush()
+    return moved
@@ -0,0 +1,153 @@
+import asyncio
+import datetime
+import logging
+import time
+import aiohttp
+import requests
+from exmail import *
+
+DEFAULT_CONCURRENCY = 200
+
+
+class AsyncExMailApi(ExMailApi):
+    '''
+    基于 asyncio 的企业邮箱 API 客户端
+    令牌桶与重试策略与同步客户端共享；并发由独立的 AIMD 控制，
+    上限为 concurrency（不受 rateLimit 中 maxConcurrency 限制），从上限开始，被限流时成倍减小
+    '''
+    _concurrency: int = DEFAULT_CONCURRENCY
+    _aioSession: aiohttp.ClientSession = None
+    _asyncConcurrency: AsyncAdaptiveConcurrency = None
+    _asyncTokenLock: asyncio.Lock = None
+
+    def __init__(self, configName: str = None, concurrency: int = None) -> None:
+        super().__init__(configName)
+        if concurrency is not None:
+            self._concurrency = concurrency
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        '''在事件循环内创建连接池'''
+        connector = aiohttp.TCPConnector(limit=self._concurrency)
+        self._aioSession = aiohttp.ClientSession(connector=connector)
+        self._asyncConcurrency = AsyncAdaptiveConcurrency(self._concurrency)
+        self._asyncTokenLock = asyncio.Lock()
+
+    async def close(self) -> None:
+        if self._aioSession is not None:
+            await self._aioSession.close()
+            self._aioSession = None
+
+    async def getTokenAsync(self) -> str:
+        if self._tokenUsable():
+            # 不会阻塞：必要时由 getToken 在后台线程中提前刷新
+            return self.getToken()
+        # 令牌已过期时只允许一个协程等待刷新，刷新本身复用同步实现
+        async with self._asyncTokenLock:
+            return await asyncio.to_thread(self.getToken)
+
+    async def _post(self, path: str, jsonData: dict) -> dict:
+        '''与 ExMailApi._request 相同的速率控制与重试逻辑，等待时不阻塞事件循环'''
+        control = self._rateControl
+        deadline = control.deadline()
+        attempt = 0
+        while True:
+            wait = control.bucket(path).reserve()
+            if time.monotonic() + wait > deadline:
+                raise ExMailApiError(-1, f'Rate limit wait for {path} exceeded deadline')
+            await asyncio.sleep(wait)
+            if not await self._asyncConcurrency.acquire(max(0, deadline - time.monotonic())):
+                raise ExMailApiError(-1, f'Rate limit wait for {path} exceeded deadline')
+            result, data, errcode, reason = FAILED, None, -1, None
+            token, label = None, 'gettoken'
+            started = time.perf_counter()
+            try:
+                token = await self.getTokenAsync()
+                label = 'network'
+                async with self._aioSession.post(self._base + path, json=jsonData, params={'access_token': token}) as r:
+                    label = f'http_{r.status}'
+                    if classify(r.status) == THROTTLED:
+                        result, reason = THROTTLED, f'HTTP {r.status}'
+                    else:
+                        data = loads(await r.read())
+                        errcode = data.get('errcode', 0)
+                        label = str(errcode)
+                        result, reason = classify(r.status, errcode), f'{errcode}({data.get("errmsg")})'
+            except (aiohttp.ClientError, asyncio.TimeoutError, requests.RequestException, ValueError) as ex:
+                result, reason = RETRY, repr(ex)
+            finally:
+                await self._asyncConcurrency.release(result)
+                self._observe(path, started, result, label)
+
+            if result in (OK, FAILED):
+                return data
+            if result == TOKEN_EXPIRED:
+                self._invalidateToken(token)
+            delay = control.retry.nextDelay(attempt, deadline)
+            if delay is None:
+                raise ExMailApiError(errcode, f'Giving up on {path} after {attempt + 1} attempts, last error is {reason}')
+            logging.warning(f'Request to {path} is {result} ({reason}), retrying in {delay:.1f}s (attempt {attempt + 1})')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+class AsyncExMailLogApi(AsyncExMailApi):
+    _config = 'log.json'
+
+    async def getLoginLog(self, userId: str, dateFrom: datetime.date, dateTo: datetime.date) -> list:
+        '''
+        获取登录记录
+        https://exmail.qq.com/qy_mng_logic/doc#10029
+        '''
+        jsonData = {
+            'begin_date': dateFrom.isoformat(),
+            'end_date': dateTo.isoformat(),
+            'userid': userId
+        }
+        data = await self._post('log/login', jsonData)
+        if data['errcode'] == 0:
+            return data['list']
+        else:
+            logging.error(f'Error fetching login log for user {userId}, error is {data["errcode"]}({data["errmsg"]})')
+            raise ExMailApiError(data['errcode'], data['errmsg'])
+
+    async def getMailLog(self, userId: str, dateFrom: datetime.date, dateTo: datetime.date, type: ExMailType = ExMailType.ALL) -> list:
+        '''
+        获取邮件记录
+        https://exmail.qq.com/qy_mng_logic/doc#10028
+        '''
+        jsonData = {
+            'begin_date': dateFrom.isoformat(),
+            'end_date': dateTo.isoformat(),
+            'userid': userId,
+            'mailtype': type.value
+        }
+        data = await self._post('log/mail', jsonData)
+        if data['errcode'] == 0:
+            return data['list']
+        else:
+            logging.error(f'Error fetching mail log for user {userId}, error is {data["errcode"]}({data["errmsg"]})')
+            raise ExMailApiError(data['errcode'], data['errmsg'])
+
+    async def getOpLog(self, dateFrom: datetime.date, dateTo: datetime.date, type: ExMailOpQueryType = ExMailOpQueryType.ALL) -> list:
+        '''
+        获取操作记录
+        https://exmail.qq.com/qy_mng_logic/doc#10031
+        '''
+        jsonData = {
+            'begin_date': dateFrom.isoformat(),
+            'end_date': dateTo.isoformat(),
+            'type': type.value
+        }
+        data = await self._post('log/operation', jsonData)
+        if data['errcode'] == 0:
+            return data['list']
+        else:
+            logging.error(f'Error fetching op log for type {type}, error is {data["errcode"]}({data["errmsg"]})')
+            raise ExMailApiError(data['errcode'], data['errmsg'])
@@ -0,0 +1,137 @@
+import datetime
+import logging
+import threading
+import sqlalchemy
+from database import *
+from pipeline import *
+
+SHARD_PENDING = 'pending'
+SHARD_DONE = 'done'
+SHARD_FAILED = 'failed'
+
+
+def shardRanges(start: datetime.date, end: datetime.date, shardDays: int):
+    '''将 [start, end] 按 shardDays 天切分为闭区间'''
+    if shardDays < 1:
+        raise ValueError(f'shardDays must be at least 1, got {shardDays}')
+    d = start
+    while d <= end:
+        yield d, min(d + datetime.timedelta(days=shardDays - 1), end)
+        d += datetime.timedelta(days=shardDays)
+
+
+def planShards(db: sqlalchemy.engine.Engine, job: str, logType: str, addresses, start: datetime.date, end: datetime.date,
+               shardDays: int = 1, batchSize: int = DEFAULT_BATCH_SIZE) -> int:
+    '''为新任务生成 邮箱 × 日期区间 分片，任务已存在时不做改动以便断点续传'''
+    with sqlalchemy.orm.Session(db) as session:
+        stmt = sqlalchemy.select(BackfillShard.id).where(BackfillShard.job == job).limit(1)
+        if session.execute(stmt).first() is not None:
+            logging.info(f'Backfill job {job} already planned, resuming')
+            return 0
+
+    ranges = list(shardRanges(start, end, shardDays))
+    now = datetime.datetime.now()
+    planned = 0
+    batch = []
+    with sqlalchemy.orm.Session(db) as session:
+        session.begin()
+        for address in addresses:
+            for dateFrom, dateTo in ranges:
+                batch.append({
+                    'job': job,
+                    'log_type': logType,
+                    'address': address,
+                    'date_from': dateFrom,
+                    'date_to': dateTo,
+                    'state': SHARD_PENDING,
+                    'attempts': 0,
+                    'updated': now
+                })
+                if len(batch) >= batchSize:
+                    session.execute(sqlalchemy.insert(BackfillShard), batch)
+                    planned += len(batch)
+                    batch = []
+        if len(batch) > 0:
+            session.execute(sqlalchemy.insert(BackfillShard), batch)
+            planned += len(batch)
+        session.commit()
+    logging.info(f'Planned {planned} shards for backfill job {job}')
+    return planned
+
+
+def pendingShards(db: sqlalchemy.engine.Engine, job: str, batchSize: int = DEFAULT_BATCH_SIZE):
+    '''逐个返回尚未完成的分片 (id, address, date_from, date_to)'''
+    stmt = sqlalchemy.select(BackfillShard.id, BackfillShard.address, BackfillShard.date_from, BackfillShard.date_to) \
+        .where(BackfillShard.job == job, BackfillShard.state != SHARD_DONE) \
+        .order_by(BackfillShard.id) \
+        .execution_options(yield_per=batchSize)
+    with sqlalchemy.orm.Session(db) as session:
+        for row in session.execute(stmt):
+            yield tuple(row)
+
+
+class ShardLedger:
+    '''收集分片结果并分批更新状态'''
+
+    def __init__(self, db: sqlalchemy.engine.Engine, batchSize: int = DEFAULT_BATCH_SIZE) -> None:
+        self._db = db
+        self._batchSize = batchSize
+        self._results = {SHARD_DONE: [], SHARD_FAILED: []}
+        self._lock = threading.Lock()
+
+    def done(self, shard: tuple) -> None:
+        self._add(SHARD_DONE, shard[0])
+
+    def failed(self, shard: tuple) -> None:
+        self._add(SHARD_FAILED, shard[0])
+
+    def _add(self, state: str, shardId: int) -> None:
+        with self._lock:
+            self._results[state].append(shardId)
+            if len(self._results[state]) >= self._batchSize:
+                self._flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        now = datetime.datetime.now()
+        with sqlalchemy.orm.Session(self._db) as session:
+            session.begin()
+            for state, ids in self._results.items():
+                if len(ids) == 0:
+                    continue
+                stmt = sqlalchemy.update(BackfillShard).where(BackfillShard.id.in_(ids)) \
+                    .values(state=state, attempts=BackfillShard.attempts + 1, updated=now)
+                session.execute(stmt)
+            session.commit()
+        self._results = {SHARD_DONE: [], SHARD_FAILED: []}
+
+
+def shardProgress(db: sqlalchemy.engine.Engine, job: str) -> dict:
+    '''统计任务各状态的分片数'''
+    stmt = sqlalchemy.select(BackfillShard.state, sqlalchemy.func.count()) \
+        .where(BackfillShard.job == job).group_by(BackfillShard.state)
+    with sqlalchemy.orm.Session(db) as session:
+        return {state: count for state, count in session.execute(stmt)}
+
+
+def runBackfill(db: sqlalchemy.engine.Engine, config: dict, job: str, model, fetch) -> dict:
+    '''
+    并行执行任务中尚未完成的分片，fetch(address, dateFrom, dateTo) 返回待写入的行
+    分片数据提交后才标记为完成，中断后重新运行即可从断点继续
+    '''
+    batchSize = config.get('batchSize', DEFAULT_BATCH_SIZE)
+    ledger = ShardLedger(db, batchSize)
+    try:
+        stats = runPipeline(db, model, pendingShards(db, job, batchSize),
+                            lambda shard: fetch(shard[1], shard[2], shard[3]),
+                            config, ledger.done, ledger.failed)
+    except KeyboardInterrupt:
+        logging.warning(f'Backfill job {job} interrupted, run it again to resume')
+        raise
+    finally:
+        ledger.flush()
+    logging.info(f'Backfill job {job} progress: {shardProgress(db, job)}')
+    return stats
@@ -0,0 +1,169 @@
+'''
+端到端吞吐量基准测试
+在本地替身服务（mockserver.py）上运行 syncUserList 与登录/邮件/操作日志同步，
+每个阶段在独立子进程中运行，报告每秒写入行数、请求延迟 p50/p99 与峰值内存
+
+    python bench.py --users 2000 --days 3 --save baseline.json
+    python bench.py --users 2000 --days 3 --baseline baseline.json
+'''
+import os
+import json
+import time
+import datetime
+import resource
+import tempfile
+import multiprocessing
+import fire
+import sqlalchemy
+from mockserver import MockExMail, startServer, baseUrl
+
+PHASES = ['users', 'login', 'mail', 'op']
+# 每个阶段写入的数据表，按表行数的增量统计实际写入的行数
+PHASE_TABLES = {'users': 'mail_box', 'login': 'login_log', 'mail': 'mail_log', 'op': 'op_log'}
+
+
+def percentile(values: list, p: float) -> float:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def _instrument(client, latencies: list) -> None:
+    '''记录客户端每次 HTTP 请求的耗时'''
+    request = client._session.request
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return request(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    client._session.request = timed
+
+
+def _runPhase(phase: str, base: str, workdir: str, config: dict, start: str, days: int, results) -> None:
+    '''子进程中运行单个阶段'''
+    os.chdir(workdir)
+    import getlog
+    getlog.ExMailApi._base = base
+    latencies = []
+    date1 = datetime.date.fromisoformat(start)
+    date2 = date1 + datetime.timedelta(days=days - 1)
+    began = time.perf_counter()
+    if phase == 'users':
+        client = getlog.ExMailContactApi('contact.json')
+        _instrument(client, latencies)
+        result = getlog.syncUserList(client, config)
+        reported = result['inserted'] + result['updated']
+    else:
+        client = getlog.ExMailLogApi('log.json')
+        _instrument(client, latencies)
+        if phase == 'login':
+            reported = getlog.loginLogs(client, config, date1, date2)['written']
+        elif phase == 'mail':
+            reported = getlog.mailLogs(client, config, date1, date2)['written']
+        else:
+            reported = getlog.opLogs(client, config, date1, date2)
+    wall = time.perf_counter() - began
+    results.put({
+        'phase': phase,
+        'reported': reported,
+        'seconds': round(wall, 3),
+        'requests': len(latencies),
+        'p50Ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        'p99Ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        # Linux 下 ru_maxrss 单位为 KB
+        'peakRssMb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    })
+
+
+def _countRows(db: sqlalchemy.engine.Engine, table: str) -> int:
+    with db.connect() as conn:
+        return conn.exec_driver_sql(f'SELECT COUNT(*) FROM {table}').scalar()
+
+
+def _phases(phases) -> list:
+    '''fire 将 users,login 解析为元组，也接受逗号分隔的字符串'''
+    if isinstance(phases, str):
+        phases = phases.split(',')
+    phases = [str(p).strip() for p in phases]
+    unknown = [p for p in phases if p not in PHASES]
+    if len(unknown) > 0:
+        raise ValueError(f'Unknown phases {unknown}, expected some of {PHASES}')
+    return phases
+
+
+def _writeClientConfig(path: str, rateLimit: dict) -> None:
+    with open(path, 'w') as fp:
+        json.dump({'corpId': 'mock', 'corpSecret': 'mock', 'accessToken': None, 'accessTokenExpiry': None, 'rateLimit': rateLimit}, fp)
+
+
+def _compare(results: list, baseline: list) -> None:
+    old = {r['phase']: r for r in baseline}
+    for r in results:
+        b = old.get(r['phase'])
+        if b is None or not b.get('rowsPerSec') or not r.get('rowsPerSec'):
+            continue
+        change = (r['rowsPerSec'] / b['rowsPerSec'] - 1) * 100
+        print(f'{r["phase"]:>6}: {b["rowsPerSec"]:>10} -> {r["rowsPerSec"]:>10} rows/s ({change:+.1f}%), '
+              f'p99 {b["p99Ms"]} -> {r["p99Ms"]} ms, peak RSS {b["peakRssMb"]} -> {r["peakRssMb"]} MB')
+
+
+def main(users: int = 500, days: int = 2, start: str = '2024-01-01', phases=','.join(PHASES),
+         db: str = None, parallel: int = 16, batchSize: int = 1000, writers: int = 1,
+         apiRate: float = 20, latency: float = 0.02, errorRate: float = 0, rateLimit: float = 0,
+         loginsPerDay: int = 5, mailsPerDay: int = 20, save: str = None, baseline: str = None) -> None:
+    '''
+    运行基准测试；db 为数据库 URL，默认使用临时 SQLite 文件
+    apiRate 为客户端每个接口每秒请求数上限，rateLimit 为替身服务端的限流阈值（0 为不限）
+    save 将结果保存为 JSON，baseline 与之前保存的结果比较
+    结果中 rows 为阶段前后数据表行数之差（实际写入的行数），reported 为同步函数自身报告的行数
+    '''
+    phases = _phases(phases)
+    workdir = tempfile.mkdtemp(prefix='exmail-bench-')
+    if db is None:
+        db = f'sqlite:///{os.path.join(workdir, "bench.db")}'
+    from common import create_all
+    engine = sqlalchemy.create_engine(db)
+    create_all(engine)
+    clientRateLimit = {'rate': apiRate, 'maxConcurrency': parallel}
+    _writeClientConfig(os.path.join(workdir, 'log.json'), clientRateLimit)
+    _writeClientConfig(os.path.join(workdir, 'contact.json'), clientRateLimit)
+
+    mock = MockExMail(users=users, latency=latency, errorRate=errorRate, rateLimit=rateLimit,
+                      loginsPerDay=loginsPerDay, mailsPerDay=mailsPerDay)
+    server = startServer(mock)
+    config = {'db': {'url': db}, 'parallel': parallel, 'batchSize': batchSize, 'writers': writers}
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        for phase in phases:
+            before = _countRows(engine, PHASE_TABLES[phase])
+            queue = context.Queue()
+            process = context.Process(target=_runPhase, args=(phase, baseUrl(server), workdir, config, start, days, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f'Phase {phase} failed with exit code {process.exitcode}, see {workdir}/exmail.log')
+                continue
+            result = queue.get()
+            result['rows'] = _countRows(engine, PHASE_TABLES[phase]) - before
+            result['rowsPerSec'] = round(result['rows'] / result['seconds'], 1) if result['seconds'] > 0 else None
+            results.append(result)
+            print(json.dumps(result))
+    finally:
+        server.shutdown()
+    print(f'Mock server stats: {mock.stats}')
+
+    if save is not None:
+        with open(save, 'w') as fp:
+            json.dump(results, fp, indent=4)
+    if baseline is not None:
+        with open(baseline) as fp:
+            _compare(results, json.load(fp))
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,100 @@
+'''
+获取日志热路径的微基准：解析接口响应并构造数据库行，报告每秒记录数
+baseline 为原先的实现（json 解析、Enum(value) 与 json.dumps 摘要），current 为 getlog 中的实现
+
+    python benchdecode.py --records 200000
+'''
+import json
+import time
+import hashlib
+import datetime
+import fire
+import getlog
+from common import *
+from mockserver import MockExMail
+
+
+def _baselineHash(fields: list) -> str:
+    return hashlib.md5(json.dumps([v.isoformat() if isinstance(v, datetime.datetime) else v.name if isinstance(v, enum.Enum) else v
+                                   for v in fields]).encode()).hexdigest()
+
+
+def baselineMailRows(payload: bytes) -> list:
+    rows = []
+    for log in json.loads(payload)['list']:
+        row = {
+            'time': datetime.datetime.fromtimestamp(log['time']),
+            'sender': log['sender'],
+            'receiver': log['receiver'],
+            'subject': log['subject'],
+            'status': ExMailStatus(log['status']),
+            'type': ExMailType(log['mailtype'])
+        }
+        row['content_hash'] = _baselineHash([row[f] for f in MailLog.dedupFields])
+        rows.append(row)
+    return rows
+
+
+def baselineLoginRows(mailbox: str, payload: bytes) -> list:
+    rows = []
+    for log in json.loads(payload)['list']:
+        row = {
+            'time': datetime.datetime.fromtimestamp(log['time']),
+            'address': mailbox,
+            'type': ExLoginType(log['type']),
+            'ip': log['ip']
+        }
+        row['content_hash'] = _baselineHash([row[f] for f in LoginLog.dedupFields])
+        rows.append(row)
+    return rows
+
+
+def currentMailRows(payload: bytes) -> list:
+    return [getlog.mailLogRow(log) for log in getlog.loads(payload)['list']]
+
+
+def currentLoginRows(mailbox: str, payload: bytes) -> list:
+    return [getlog.loginLogRow(mailbox, log) for log in getlog.loads(payload)['list']]
+
+
+def _rate(func, records: int, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return records / best
+
+
+def main(records: int = 100000, repeat: int = 3) -> dict:
+    '''records 为每次解析的记录数，取 repeat 次中最快的一次'''
+    mock = MockExMail(users=1, mailsPerDay=records, loginsPerDay=records, heavyRatio=0)
+    body = {'userid': mock.userId(0), 'begin_date': '2024-01-01', 'end_date': '2024-01-01'}
+    mail = json.dumps({'errcode': 0, 'errmsg': 'ok', 'list': mock.mailLog(body)}).encode()
+    login = json.dumps({'errcode': 0, 'errmsg': 'ok', 'list': mock.loginLog(body)}).encode()
+    mailCount, loginCount = len(json.loads(mail)['list']), len(json.loads(login)['list'])
+    assert baselineMailRows(mail) == currentMailRows(mail)
+    assert baselineLoginRows(body['userid'], login) == currentLoginRows(body['userid'], login)
+
+    result = {
+        'json': getlog.loads.__module__,
+        'mail': {
+            'records': mailCount,
+            'baseline': round(_rate(lambda: baselineMailRows(mail), mailCount, repeat)),
+            'current': round(_rate(lambda: currentMailRows(mail), mailCount, repeat))
+        },
+        'login': {
+            'records': loginCount,
+            'baseline': round(_rate(lambda: baselineLoginRows(body['userid'], login), loginCount, repeat)),
+            'current': round(_rate(lambda: currentLoginRows(body['userid'], login), loginCount, repeat))
+        }
+    }
+    for kind in ('mail', 'login'):
+        r = result[kind]
+        r['speedup'] = round(r['current'] / r['baseline'], 2)
+    return result
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,244 @@
+import os
+import enum
+import time
+import queue
+import logging
+import datetime
+import tempfile
+import collections
+import sqlalchemy
+from database import *
+from metrics import DB_WRITE_LATENCY, ROWS_WRITTEN, QUEUE_DEPTH
+
+DEFAULT_STAGING_ROWS = 1000000
+
+_NULL = '\\N'
+_ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+_UNESCAPES = {'\\': '\\', 't': '\t', 'n': '\n', 'r': '\r'}
+
+
+def stagingColumns(model) -> list:
+    '''暂存文件中的列：除自增主键外的全部列'''
+    return [c.name for c in model.__table__.columns if not (c.primary_key and c.autoincrement in (True, 'auto'))]
+
+
+def _text(value) -> str:
+    '''转换为 MySQL LOAD DATA 与 PostgreSQL COPY 共用的文本格式'''
+    if value is None:
+        return _NULL
+    if isinstance(value, enum.Enum):
+        # 与 sqlalchemy.Enum 一致，按名称存储
+        value = value.name
+    elif isinstance(value, datetime.datetime):
+        value = value.strftime('%Y-%m-%d %H:%M:%S.%f')
+    elif isinstance(value, datetime.date):
+        value = value.isoformat()
+    elif isinstance(value, bool):
+        value = '1' if value else '0'
+    value = str(value)
+    for char, escaped in _ESCAPES.items():
+        value = value.replace(char, escaped)
+    return value
+
+
+def _value(text: str):
+    if text == _NULL:
+        return None
+    if '\\' not in text:
+        return text
+    result = []
+    chars = iter(text)
+    for char in chars:
+        if char == '\\':
+            char = next(chars, '\\')
+            result.append(_UNESCAPES.get(char, char))
+        else:
+            result.append(char)
+    return ''.join(result)
+
+
+class StagingFile:
+    '''将行流式写入制表符分隔的暂存文件，NULL 记为 \\N'''
+
+    def __init__(self, model, directory: str = None) -> None:
+        self.model = model
+        self.columns = stagingColumns(model)
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix=f'{model.__tablename__}-', suffix='.tsv')
+        self._fp = os.fdopen(fd, 'w', encoding='utf-8', newline='\n')
+        self.rows = 0
+
+    def add(self, rows: list) -> None:
+        lines = ['\t'.join(_text(row.get(c)) for c in self.columns) + '\n' for row in rows]
+        self._fp.writelines(lines)
+        self.rows += len(rows)
+
+    def close(self) -> None:
+        if not self._fp.closed:
+            self._fp.close()
+
+    def remove(self) -> None:
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def read(self):
+        '''逐行读回暂存文件'''
+        with open(self.path, encoding='utf-8', newline='\n') as fp:
+            for line in fp:
+                yield tuple(_value(v) for v in line.rstrip('\n').split('\t'))
+
+
+def _quote(conn: sqlalchemy.engine.Connection, name: str) -> str:
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def _createStaging(conn: sqlalchemy.engine.Connection, model, staging: str, columns: list) -> None:
+    '''创建与主表列类型相同的临时暂存表'''
+    dialect = conn.dialect.name
+    table = _quote(conn, model.__tablename__)
+    name = _quote(conn, staging)
+    if dialect == 'mysql':
+        # 不带 TEMPORARY 的 DROP TABLE 会隐式提交事务
+        conn.exec_driver_sql(f'DROP TEMPORARY TABLE IF EXISTS {name}')
+        conn.exec_driver_sql(f'CREATE TEMPORARY TABLE {name} LIKE {table}')
+    elif dialect == 'postgresql':
+        conn.exec_driver_sql(f'DROP TABLE IF EXISTS {name}')
+        conn.exec_driver_sql(f'CREATE TEMPORARY TABLE {name} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP')
+    elif dialect == 'sqlite':
+        names = ', '.join(_quote(conn, c) for c in columns)
+        conn.exec_driver_sql(f'DROP TABLE IF EXISTS {name}')
+        conn.exec_driver_sql(f'CREATE TEMPORARY TABLE {name} AS SELECT {names} FROM {table} WHERE 0')
+    else:
+        raise ValueError(f'Unsupported database dialect {dialect}')
+
+
+def _loadStaging(conn: sqlalchemy.engine.Connection, staging: StagingFile, name: str, batchSize: int) -> None:
+    '''用数据库自带的导入方式将暂存文件载入暂存表'''
+    dialect = conn.dialect.name
+    table = _quote(conn, name)
+    names = ', '.join(_quote(conn, c) for c in staging.columns)
+    if dialect == 'mysql':
+        # 需要在连接参数中开启 local_infile，见 getDB
+        conn.exec_driver_sql(
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE {table} CHARACTER SET utf8mb4 "
+            f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({names})",
+            (staging.path,))
+    elif dialect == 'postgresql':
+        sql = f'COPY {table} ({names}) FROM STDIN'
+        cursor = conn.connection.driver_connection.cursor()
+        with open(staging.path, encoding='utf-8') as fp:
+            if hasattr(cursor, 'copy_expert'):
+                # psycopg2
+                cursor.copy_expert(sql, fp)
+            else:
+                # psycopg 3
+                with cursor.copy(sql) as copy:
+                    for block in iter(lambda: fp.read(1 << 20), ''):
+                        copy.write(block)
+    else:
+        placeholders = ', '.join('?' for _ in staging.columns)
+        insert = f'INSERT INTO {table} ({names}) VALUES ({placeholders})'
+        batch = []
+        for row in staging.read():
+            batch.append(row)
+            if len(batch) >= batchSize:
+                conn.exec_driver_sql(insert, batch)
+                batch = []
+        if len(batch) > 0:
+            conn.exec_driver_sql(insert, batch)
+
+
+def mergeStatement(model, staging: str, columns: list):
+    '''
+    由暂存表合并入主表的单条语句：去掉暂存表内的重复行以及主表中已存在的行
+    有唯一键时按唯一键判断是否已存在，暂存表内键相同的行（如同一封邮件的不同状态）只保留一行；否则比较全部列
+    '''
+    table = model.__table__
+    source = sqlalchemy.table(staging, *[sqlalchemy.column(c, table.c[c].type) for c in columns])
+    keys = conflictColumns(model, columns) or columns
+    exists = sqlalchemy.select(sqlalchemy.literal(1)).select_from(table).where(
+        *[table.c[k].is_not_distinct_from(source.c[k]) for k in keys])
+    if keys == columns:
+        select = sqlalchemy.select(*[source.c[c] for c in columns]).distinct().where(~exists.exists())
+        return sqlalchemy.insert(table).from_select(columns, select)
+    rank = sqlalchemy.func.row_number().over(partition_by=[source.c[k] for k in keys]).label('_rank')
+    ranked = sqlalchemy.select(*[source.c[c] for c in columns], rank).where(~exists.exists()).subquery()
+    select = sqlalchemy.select(*[ranked.c[c] for c in columns]).where(ranked.c._rank == 1)
+    return sqlalchemy.insert(table).from_select(columns, select)
+
+
+def bulkLoad(db: sqlalchemy.engine.Engine, staging: StagingFile, batchSize: int = DEFAULT_BATCH_SIZE) -> int:
+    '''在一个事务中将暂存文件导入临时表并合并入主表，返回新增的行数'''
+    staging.close()
+    model = staging.model
+    name = f'{model.__tablename__}_staging'
+    start = time.perf_counter()
+    with db.begin() as conn:
+        _createStaging(conn, model, name, staging.columns)
+        _loadStaging(conn, staging, name, batchSize)
+        loaded = time.perf_counter()
+        merged = conn.execute(mergeStatement(model, name, staging.columns)).rowcount
+        if conn.dialect.name == 'mysql':
+            conn.exec_driver_sql(f'DROP TEMPORARY TABLE {_quote(conn, name)}')
+        elif conn.dialect.name == 'sqlite':
+            conn.exec_driver_sql(f'DROP TABLE {_quote(conn, name)}')
+    elapsed = time.perf_counter() - start
+    DB_WRITE_LATENCY.observe(elapsed, table=model.__tablename__)
+    ROWS_WRITTEN.inc(merged, table=model.__tablename__)
+    logging.info(f'Bulk loaded {staging.rows} rows into {model.__tablename__} in {elapsed:.2f}s '
+                 f'(load {loaded - start:.2f}s, merge {elapsed - (loaded - start):.2f}s), {merged} new rows')
+    return merged
+
+
+def stagingWorker(db: sqlalchemy.engine.Engine, model, rowQueue: queue.Queue, stagingRows: int, batchSize: int, state, directory: str = None, stop=None,
+                  writeLimit=None, flushInterval: float = None):
+    '''
+    流水线的批量导入写入线程：数据块先写入暂存文件，累计 stagingRows 行或队列空闲 flushInterval 秒后整体导入并合并
+    只有合并提交后才通知流水线对应任务已完成，并将最近的摘要加入流水线的 recent；writeLimit 按每个暂存文件的行数限速
+    '''
+    staging = None
+    tasks = collections.Counter()
+    # 只保留 recent 容量以内的最近摘要，合并提交后再加入
+    keys = collections.deque(maxlen=state.recent.capacity) if state.recent is not None else None
+
+    def flush():
+        nonlocal staging
+        if staging is None:
+            return
+        rows, ok = staging.rows, False
+        if writeLimit is not None:
+            writeLimit.wait(rows)
+        try:
+            bulkLoad(db, staging, batchSize)
+            ok = True
+            if keys is not None:
+                state.recent.add([{'content_hash': k} for k in keys])
+        except Exception as ex:
+            logging.error(f'Error bulk loading {rows} rows into {model.__tablename__}, reason: {repr(ex)}')
+        finally:
+            staging.remove()
+        state.written(tasks, rows if ok else 0, ok)
+        staging = None
+        tasks.clear()
+        if keys is not None:
+            keys.clear()
+
+    while True:
+        try:
+            item = rowQueue.get(timeout=flushInterval)
+        except queue.Empty:
+            flush()
+            continue
+        QUEUE_DEPTH.set(rowQueue.qsize(), table=model.__tablename__)
+        if item is stop:
+            break
+        task, rows = item
+        if staging is None:
+            staging = StagingFile(model, directory)
+        staging.add(rows)
+        if keys is not None:
+            keys.extend(r['content_hash'] for r in rows if r.get('content_hash') is not None)
+        tasks[task] += 1
+        if staging.rows >= stagingRows:
+            flush()
+    flush()
@@ -1,6 +1,6 @@
 import datetime
 import enum
-from sqlalchemy import Column, String, Integer, DateTime, Enum, BigInteger, UniqueConstraint, Index
+from sqlalchemy import Column, String, Integer, Date, DateTime, Enum, BigInteger, UniqueConstraint, Index
 import sqlalchemy
 from sqlalchemy.orm import relationship, declarative_base
 
@@ -129,6 +129,11 @@ class ExMailOpType(enum.Enum):
     MERGE_DATA_AND_MAILBOX = 83
 
 
+def enumLookup(enumClass) -> dict:
+    '''值到枚举成员的字典，比 enumClass(value) 快得多'''
+    return {e.value: e for e in enumClass}
+
+
 class Department:
     id: int
     name: str
@@ -162,25 +167,36 @@ class MailBox(Base):
     department_id = Column(String(255))
     alias = Column(String(255))
     need_reset_password = Column(Integer)
+    enable = Column(Integer, default=1)
+    # 以上字段的摘要，用于判断用户信息是否变化
+    content_hash = Column(String(32))
     updated = Column(DateTime, default=datetime.datetime.fromtimestamp(0))
 
 class LoginLog(Base):
     __tablename__ = 'login_log'
+    # 复合索引用于按邮箱或 IP 过滤并按 (time, id) 分页的查询，无需额外排序
+    __table_args__ = (UniqueConstraint('content_hash', name='uq_login_log_content_hash'),
+                      Index('ix_login_log_address_time', 'address', 'time', 'id'),
+                      Index('ix_login_log_ip_time', 'ip', 'time', 'id'))
+    # 参与去重摘要的字段
+    dedupFields = ('time', 'address', 'type', 'ip')
 
-    id = Column(BigInteger, primary_key=True)
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
     time = Column(DateTime, index=True)
     address = Column(String(255), index=True)
     type = Column(Enum(ExLoginType))
     ip = Column(String(64), index=True)
-
-    uniqueIndex = UniqueConstraint(time, address, type, ip)
-    
+    content_hash = Column(String(32))
 
     def __repr__(self) -> str:
         return f'LoginLog(time={self.time}, address={self.address}, ip={self.ip}, type={self.type})'
 
 class MailLog(Base):
     __tablename__ = 'mail_log'
+    __table_args__ = (UniqueConstraint('content_hash', name='uq_mail_log_content_hash'),
+                      Index('ix_mail_log_sender_time', 'sender', 'time', 'id'),
+                      Index('ix_mail_log_receiver_time', 'receiver', 'time', 'id'))
+    dedupFields = ('time', 'sender', 'receiver', 'subject', 'type')
 
     id = Column(Integer, primary_key=True)
     time = Column(DateTime, index=True)
@@ -189,26 +205,137 @@ class MailLog(Base):
     subject = Column(String(255))
     type = Column(Enum(ExMailType))
     status = Column(Enum(ExMailStatus))
-
-    uniqueIndex = UniqueConstraint(time, sender, receiver, subject, type)
+    content_hash = Column(String(32))
 
     def __repr__(self) -> str:
         return f'MailLog(time={self.time}, from={self.sender}, to={self.receiver}, status={self.status})'
 
 class OpLog(Base):
     __tablename__ = 'op_log'
+    __table_args__ = (UniqueConstraint('content_hash', name='uq_op_log_content_hash'),)
+    dedupFields = ('time', 'operator', 'type', 'operand')
 
-    id = Column(BigInteger, primary_key=True)
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
     time = Column(DateTime, index=True)
     operator = Column(String(255))
     type = Column(Enum(ExMailOpType))
     operand = Column(String(255))
-
-    uniqueIndex = UniqueConstraint(time, operator, type, operand)
+    content_hash = Column(String(32))
 
     def __repr__(self) -> str:
         return f'OpLog(time={self.time}, operator={self.operator}, type={self.type}, operand={self.operand})'
 
+class SyncWatermark(Base):
+    '''每个邮箱、每类日志已成功同步到的时间'''
+    __tablename__ = 'sync_watermark'
+
+    address = Column(String(255), primary_key=True)
+    log_type = Column(String(16), primary_key=True)
+    synced_until = Column(DateTime)
+    updated = Column(DateTime)
+
+    def __repr__(self) -> str:
+        return f'SyncWatermark(address={self.address}, log_type={self.log_type}, synced_until={self.synced_until})'
+
+class BackfillShard(Base):
+    '''历史数据回填任务的分片（邮箱 × 日期区间）及其状态'''
+    __tablename__ = 'backfill_shard'
+    __table_args__ = (UniqueConstraint('job', 'log_type', 'address', 'date_from'),)
+
+    id = Column(Integer, primary_key=True)
+    job = Column(String(64), index=True)
+    log_type = Column(String(16))
+    address = Column(String(255))
+    date_from = Column(Date)
+    date_to = Column(Date)
+    state = Column(String(16), index=True)
+    attempts = Column(Integer, default=0)
+    updated = Column(DateTime)
+
+    def __repr__(self) -> str:
+        return f'BackfillShard(job={self.job}, address={self.address}, date_from={self.date_from}, date_to={self.date_to}, state={self.state})'
+
+class SyncLease(Base):
+    '''多进程同步时邮箱的租约：每轮同步中每个邮箱只由持有有效租约的进程获取'''
+    __tablename__ = 'sync_lease'
+    __table_args__ = (UniqueConstraint('sync_round', 'address'),)
+
+    id = Column(Integer, primary_key=True)
+    sync_round = Column(String(64), index=True)
+    address = Column(String(255))
+    priority = Column(Integer)
+    state = Column(String(16), index=True)
+    owner = Column(String(128))
+    claim_token = Column(String(32), index=True)
+    lease_until = Column(DateTime)
+    attempts = Column(Integer, default=0)
+    updated = Column(DateTime)
+
+    def __repr__(self) -> str:
+        return f'SyncLease(sync_round={self.sync_round}, address={self.address}, state={self.state}, owner={self.owner}, lease_until={self.lease_until})'
+
+class FailedFetch(Base):
+    '''获取失败、等待重试的同步单元（日志类型 × 邮箱 × 日期区间），成功重试后删除'''
+    __tablename__ = 'failed_fetch'
+    __table_args__ = (UniqueConstraint('log_type', 'address', 'date_from', 'date_to'),)
+
+    id = Column(Integer, primary_key=True)
+    log_type = Column(String(16))
+    address = Column(String(255))
+    date_from = Column(Date)
+    date_to = Column(Date)
+    error = Column(String(1024))
+    attempts = Column(Integer, default=1)
+    first_failed = Column(DateTime)
+    last_failed = Column(DateTime)
+
+    def __repr__(self) -> str:
+        return f'FailedFetch(log_type={self.log_type}, address={self.address}, date_from={self.date_from}, date_to={self.date_to}, attempts={self.attempts})'
+
+class LoginAlert(Base):
+    '''登录异常检测产生的报警'''
+    __tablename__ = 'login_alert'
+
+    id = Column(Integer, primary_key=True)
+    time = Column(DateTime, index=True)
+    kind = Column(String(32))
+    address = Column(String(255), index=True)
+    ip = Column(String(64))
+    detail = Column(String(1024))
+    created = Column(DateTime)
+
+    def __repr__(self) -> str:
+        return f'LoginAlert(time={self.time}, kind={self.kind}, address={self.address}, ip={self.ip})'
+
+class LoginRollup(Base):
+    '''登录日志按 时间粒度（hour/day）× 邮箱 × 登录类型 汇总的次数，随每批日志写入增量更新'''
+    __tablename__ = 'login_rollup'
+    __table_args__ = (Index('ix_login_rollup_bucket', 'grain', 'bucket'),)
+
+    grain = Column(String(8), primary_key=True)
+    address = Column(String(255), primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    type = Column(Enum(ExLoginType), primary_key=True)
+    count = Column(BigInteger, default=0)
+
+    def __repr__(self) -> str:
+        return f'LoginRollup(grain={self.grain}, address={self.address}, bucket={self.bucket}, type={self.type}, count={self.count})'
+
+class MailRollup(Base):
+    '''邮件日志按 时间粒度 × 邮箱 × 邮件类型 × 状态 汇总的封数，发信计入发件人，收信计入收件人'''
+    __tablename__ = 'mail_rollup'
+    __table_args__ = (Index('ix_mail_rollup_bucket', 'grain', 'bucket'),)
+
+    grain = Column(String(8), primary_key=True)
+    address = Column(String(255), primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    type = Column(Enum(ExMailType), primary_key=True)
+    status = Column(Enum(ExMailStatus), primary_key=True)
+    count = Column(BigInteger, default=0)
+
+    def __repr__(self) -> str:
+        return f'MailRollup(grain={self.grain}, address={self.address}, bucket={self.bucket}, type={self.type}, status={self.status}, count={self.count})'
+
 
 def create_all(engine: sqlalchemy.engine):
     Base.metadata.create_all(engine)
\ No newline at end of file
@@ -0,0 +1,472 @@
+import time
+import json
+import enum
+import hashlib
+import operator
+import datetime
+import threading
+import logging
+import collections
+import sqlalchemy
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from common import *
+from metrics import DB_WRITE_LATENCY, ROWS_WRITTEN
+from rollup import upsertLogRows, ROLLUPS
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_RECENT_KEYS = 200000
+
+
+_engines = {}
+_enginesLock = threading.Lock()
+
+
+def getDB(config: dict):
+    '''
+    连接数据库，配置中给出 url 时直接使用（如本地测试用的 sqlite:///local.db）
+    localInfile 为 true 时允许 MySQL 的 LOAD DATA LOCAL INFILE（批量导入模式需要）
+    相同配置共享同一个带连接池的 engine，poolSize 为连接池大小，取出连接前检测连接是否可用
+    '''
+    key = json.dumps(config, sort_keys=True)
+    with _enginesLock:
+        if key in _engines:
+            return _engines[key]
+        if 'url' in config:
+            url = config['url']
+        else:
+            url = f'mysql+pymysql://{config["user"]}:{config["password"]}@{config["host"]}:{config["port"]}/{config["database"]}'
+        options = {'pool_pre_ping': True}
+        if url.startswith('mysql'):
+            # 日志汇总依赖同一事务内一致性快照不变来判断实际插入的行，见 rollup.insertNewRows
+            options['isolation_level'] = 'REPEATABLE READ'
+        if config.get('localInfile'):
+            options['connect_args'] = {'local_infile': True}
+        if config.get('poolSize') and not url.startswith('sqlite'):
+            options['pool_size'] = config['poolSize']
+            options['max_overflow'] = config.get('maxOverflow', config['poolSize'])
+            options['pool_recycle'] = config.get('poolRecycle', 3600)
+        engine = _engines[key] = sqlalchemy.create_engine(url, **options)
+        return engine
+
+
+def conflictColumns(model, keys) -> list:
+    '''返回第一个列全部出现在 keys 中的主键或唯一约束的列名，没有时返回 None'''
+    table = model.__table__
+    candidates = [table.primary_key.columns]
+    candidates += [c.columns for c in table.constraints if isinstance(c, sqlalchemy.UniqueConstraint)]
+    candidates += [i.columns for i in table.indexes if i.unique]
+    for columns in candidates:
+        names = [c.name for c in columns]
+        if len(names) > 0 and all(n in keys for n in names):
+            return names
+    return None
+
+
+def upsertStatement(model, rows: list, dialect: str = 'mysql'):
+    '''
+    生成多行 upsert 语句
+    MySQL 使用 ON DUPLICATE KEY UPDATE；SQLite 与 PostgreSQL 使用 ON CONFLICT，
+    冲突目标取 conflictColumns，行中不含任何唯一键时只忽略冲突
+    '''
+    if dialect == 'mysql':
+        stmt = mysql.insert(model).values(rows)
+        return stmt.on_duplicate_key_update({k: stmt.inserted[k] for k in rows[0]})
+    if dialect not in ('sqlite', 'postgresql'):
+        raise ValueError(f'Unsupported database dialect {dialect}')
+    insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+    stmt = insert(model).values(rows)
+    target = conflictColumns(model, rows[0])
+    if target is None:
+        return stmt.on_conflict_do_nothing()
+    update = {k: stmt.excluded[k] for k in rows[0] if k not in target}
+    if len(update) == 0:
+        return stmt.on_conflict_do_nothing(index_elements=target)
+    return stmt.on_conflict_do_update(index_elements=target, set_=update)
+
+
+def uniqueRows(model, rows: list) -> list:
+    '''
+    按 content_hash 去掉日志表（定义了 dedupFields 的表）中的重复行；同一语句中出现重复键时 PostgreSQL 的 ON CONFLICT DO UPDATE 会报错
+    其他表的 content_hash 只用于判断记录是否变化，不作为键
+    '''
+    if len(rows) == 0 or not hasattr(model, 'dedupFields'):
+        return rows
+    return list({r['content_hash']: r for r in rows}.values())
+
+
+def _upsertChunk(session: sqlalchemy.orm.Session, model, rows: list, dialect: str) -> None:
+    if model in ROLLUPS:
+        upsertLogRows(session, model, rows, dialect)
+    else:
+        session.execute(upsertStatement(model, rows, dialect))
+
+
+def upsertRows(session: sqlalchemy.orm.Session, model, rows: list, batchSize: int = DEFAULT_BATCH_SIZE) -> int:
+    '''分批写入数据库，单批失败时逐行写入；有汇总的日志表经 upsertLogRows 写入，汇总在同一事务中累加'''
+    written = 0
+    start = time.perf_counter()
+    dialect = session.get_bind().dialect.name
+    rows = uniqueRows(model, rows)
+    for i in range(0, len(rows), batchSize):
+        chunk = rows[i:i + batchSize]
+        chunkStart = time.perf_counter()
+        try:
+            with session.begin_nested():
+                _upsertChunk(session, model, chunk, dialect)
+            written += len(chunk)
+            DB_WRITE_LATENCY.observe(time.perf_counter() - chunkStart, table=model.__tablename__)
+        except sqlalchemy.exc.DBAPIError as ex:
+            logging.warning(f'Batch upsert of {len(chunk)} rows into {model.__tablename__} failed, falling back to single rows, reason: {repr(ex)}')
+            for row in chunk:
+                try:
+                    with session.begin_nested():
+                        _upsertChunk(session, model, [row], dialect)
+                    written += 1
+                except sqlalchemy.exc.DBAPIError as ex:
+                    logging.error(f'Error writing row {row} into {model.__tablename__}, reason: {repr(ex)}')
+    elapsed = time.perf_counter() - start
+    ROWS_WRITTEN.inc(written, table=model.__tablename__)
+    if written > 0:
+        logging.info(f'Wrote {written} rows into {model.__tablename__} in {elapsed:.2f}s ({written / max(elapsed, 1e-6):.0f} rows/s, batch size {batchSize})')
+    return written
+
+
+def streamMailboxes(db: sqlalchemy.engine.Engine, batchSize: int = DEFAULT_BATCH_SIZE):
+    '''以服务端游标逐个返回邮箱地址'''
+    stmt = sqlalchemy.select(MailBox.address).execution_options(yield_per=batchSize)
+    with sqlalchemy.orm.Session(db) as session:
+        for address in session.scalars(stmt):
+            yield address
+
+
+def loadWatermarks(db: sqlalchemy.engine.Engine, logType: str) -> dict:
+    '''读取某类日志所有邮箱的同步水位线'''
+    stmt = sqlalchemy.select(SyncWatermark.address, SyncWatermark.synced_until).where(SyncWatermark.log_type == logType)
+    with sqlalchemy.orm.Session(db) as session:
+        return {address: until for address, until in session.execute(stmt)}
+
+
+def saveWatermarks(session: sqlalchemy.orm.Session, logType: str, addresses: list, until: datetime.datetime) -> None:
+    '''推进水位线，只应在对应数据提交之后调用'''
+    if len(addresses) == 0:
+        return
+    now = datetime.datetime.now()
+    rows = [{'address': a, 'log_type': logType, 'synced_until': until, 'updated': now} for a in addresses]
+    upsertRows(session, SyncWatermark, rows)
+
+
+class WatermarkBuffer:
+    '''收集已提交的邮箱并分批推进水位线'''
+
+    def __init__(self, db: sqlalchemy.engine.Engine, logType: str, until: datetime.datetime, batchSize: int = DEFAULT_BATCH_SIZE) -> None:
+        self._db = db
+        self._logType = logType
+        self._until = until
+        self._batchSize = batchSize
+        self._addresses = []
+        self._lock = threading.Lock()
+
+    def add(self, address: str) -> None:
+        with self._lock:
+            self._addresses.append(address)
+            if len(self._addresses) >= self._batchSize:
+                self._flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if len(self._addresses) == 0:
+            return
+        with sqlalchemy.orm.Session(self._db) as session:
+            session.begin()
+            saveWatermarks(session, self._logType, self._addresses, self._until)
+            session.commit()
+        self._addresses = []
+
+
+class DeadLetters:
+    '''
+    持久化的失败队列：收集获取失败的同步单元并分批写入 failed_fetch 表，同一单元再次失败时累加次数
+    单元的数据提交后调用 resolved，删除表中该邮箱落在已提交日期区间内的失败记录
+    '''
+
+    def __init__(self, db: sqlalchemy.engine.Engine, batchSize: int = DEFAULT_BATCH_SIZE) -> None:
+        self._db = db
+        self._batchSize = batchSize
+        self._failed = {}
+        self._resolved = []
+        # 每类日志表中已有或本次记录了失败的邮箱，只为这些邮箱执行删除；_loaded 为已从表中读取过的日志类型
+        self._known = collections.defaultdict(set)
+        self._loaded = set()
+        self._lock = threading.Lock()
+
+    def failed(self, logType: str, address: str, dateFrom: datetime.date, dateTo: datetime.date, error) -> None:
+        with self._lock:
+            self._failed[(logType, address, dateFrom, dateTo)] = repr(error)[:1024] if isinstance(error, Exception) else str(error)[:1024]
+            self._known[logType].add(address)
+            if len(self._failed) >= self._batchSize:
+                self._flush()
+
+    def resolved(self, logType: str, address: str, dateFrom: datetime.date, dateTo: datetime.date) -> None:
+        with self._lock:
+            if logType not in self._loaded:
+                with sqlalchemy.orm.Session(self._db) as session:
+                    stmt = sqlalchemy.select(FailedFetch.address).where(FailedFetch.log_type == logType).distinct()
+                    self._known[logType].update(session.scalars(stmt))
+                self._loaded.add(logType)
+            if address not in self._known[logType]:
+                return
+            # 同一批中先失败后成功的单元不再写入；先成功后失败的仍按先删除后写入的顺序保留失败记录
+            for key in [k for k in self._failed if k[0] == logType and k[1] == address and k[2] >= dateFrom and k[3] <= dateTo]:
+                del self._failed[key]
+            self._resolved.append((logType, address, dateFrom, dateTo))
+            if len(self._resolved) >= self._batchSize:
+                self._flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if len(self._failed) == 0 and len(self._resolved) == 0:
+            return
+        now = datetime.datetime.now()
+        with sqlalchemy.orm.Session(self._db) as session:
+            session.begin()
+            for logType, address, dateFrom, dateTo in self._resolved:
+                session.execute(sqlalchemy.delete(FailedFetch).where(
+                    FailedFetch.log_type == logType, FailedFetch.address == address,
+                    FailedFetch.date_from >= dateFrom, FailedFetch.date_to <= dateTo))
+            for (logType, address, dateFrom, dateTo), error in self._failed.items():
+                key = (FailedFetch.log_type == logType, FailedFetch.address == address,
+                       FailedFetch.date_from == dateFrom, FailedFetch.date_to == dateTo)
+                updated = session.execute(sqlalchemy.update(FailedFetch).where(*key).values(
+                    error=error, attempts=FailedFetch.attempts + 1, last_failed=now)).rowcount
+                if updated == 0:
+                    session.execute(sqlalchemy.insert(FailedFetch).values(
+                        log_type=logType, address=address, date_from=dateFrom, date_to=dateTo,
+                        error=error, attempts=1, first_failed=now, last_failed=now))
+            session.commit()
+        logging.info(f'Recorded {len(self._failed)} failed fetches, resolved {len(self._resolved)}')
+        self._failed = {}
+        self._resolved = []
+
+
+def loadDeadLetters(db: sqlalchemy.engine.Engine, logType: str = None, maxAttempts: int = None) -> list:
+    '''读取待重试的失败单元 (id, 日志类型, 邮箱, 起始日期, 结束日期)，maxAttempts 排除失败次数达到上限的单元'''
+    stmt = sqlalchemy.select(FailedFetch.id, FailedFetch.log_type, FailedFetch.address, FailedFetch.date_from, FailedFetch.date_to) \
+        .order_by(FailedFetch.id)
+    if logType is not None:
+        stmt = stmt.where(FailedFetch.log_type == logType)
+    if maxAttempts is not None:
+        stmt = stmt.where(FailedFetch.attempts < maxAttempts)
+    with sqlalchemy.orm.Session(db) as session:
+        return [tuple(row) for row in session.execute(stmt)]
+
+
+def mailboxCosts(db: sqlalchemy.engine.Engine, logType: str, since: datetime.datetime) -> dict:
+    '''按历史日志条数估计每个邮箱的获取成本'''
+    if logType == 'login':
+        stmts = [sqlalchemy.select(LoginLog.address, sqlalchemy.func.count()).where(LoginLog.time >= since).group_by(LoginLog.address)]
+    elif logType == 'mail':
+        stmts = [
+            sqlalchemy.select(MailLog.sender, sqlalchemy.func.count()).where(MailLog.time >= since).group_by(MailLog.sender),
+            sqlalchemy.select(MailLog.receiver, sqlalchemy.func.count()).where(MailLog.time >= since).group_by(MailLog.receiver)
+        ]
+    else:
+        raise ValueError(f'Unknown log type {logType}')
+    costs = {}
+    with sqlalchemy.orm.Session(db) as session:
+        for stmt in stmts:
+            for address, count in session.execute(stmt):
+                costs[address] = costs.get(address, 0) + count
+    return costs
+
+
+def scheduledMailboxes(db: sqlalchemy.engine.Engine, logType: str, config: dict) -> list:
+    '''
+    按估计成本从大到小排列邮箱（最长任务优先），减少运行尾部的等待
+    已停用的邮箱排在最后，skipDisabled 时直接跳过
+    '''
+    since = datetime.datetime.now() - datetime.timedelta(days=config.get('costWindowDays', 7))
+    costs = mailboxCosts(db, logType, since)
+    skipDisabled = config.get('skipDisabled', False)
+    with sqlalchemy.orm.Session(db) as session:
+        mailboxes = [(address, enable) for address, enable in session.execute(sqlalchemy.select(MailBox.address, MailBox.enable))]
+    disabled = sum(1 for _, enable in mailboxes if enable == 0)
+    if skipDisabled:
+        mailboxes = [m for m in mailboxes if m[1] != 0]
+    mailboxes.sort(key=lambda m: (m[1] == 0, -costs.get(m[0], 0)))
+    logging.info(f'Scheduled {len(mailboxes)} mailboxes for {logType} logs by estimated cost, {disabled} disabled mailboxes {"skipped" if skipDisabled else "deprioritized"}')
+    return [address for address, _ in mailboxes]
+
+
+def mailBoxHash(row: dict) -> str:
+    '''计算邮箱信息的摘要，包含地址本身，不同邮箱的摘要不会相同'''
+    fields = [row['address'], row['department_id'], row['alias'], row['need_reset_password'], row['enable']]
+    return hashlib.md5(json.dumps(fields).encode()).hexdigest()
+
+
+def _hashValue(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.name
+    return value
+
+
+def digest(text: str) -> str:
+    return hashlib.md5(text.encode()).hexdigest()
+
+
+def _fieldsHash(values) -> str:
+    return digest(json.dumps([_hashValue(v) for v in values]))
+
+
+def logHash(model, row: dict) -> str:
+    '''日志行的去重摘要，由 model.dedupFields 计算，写入 content_hash 唯一列'''
+    return _fieldsHash(row.get(f) for f in model.dedupFields)
+
+
+def logHasher(model):
+    '''
+    返回计算 model 日志行摘要的函数，与 logHash 结果相同
+    字段在调用时按 dedupFields 确定，供获取日志热路径上的行构造函数在导入时取得
+    '''
+    getter = operator.itemgetter(*model.dedupFields)
+    return lambda row: _fieldsHash(getter(row))
+
+
+class RecentKeys:
+    '''
+    最近写入的去重摘要（LRU 集合），用于在写入数据库前丢弃重叠时间窗口内已写入的行
+    只在数据提交后加入，不会误删未写入的数据
+    '''
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, rows: list) -> list:
+        '''丢弃已写入的行'''
+        with self._lock:
+            return [r for r in rows if r.get('content_hash') not in self._keys]
+
+    def add(self, rows: list) -> None:
+        with self._lock:
+            for r in rows:
+                key = r.get('content_hash')
+                if key is None:
+                    continue
+                self._keys[key] = None
+                self._keys.move_to_end(key)
+            while len(self._keys) > self.capacity:
+                self._keys.popitem(last=False)
+
+
+_recentKeys = {}
+_recentKeysLock = threading.Lock()
+
+
+def recentKeys(model, capacity: int = DEFAULT_RECENT_KEYS) -> RecentKeys:
+    '''每个日志表在进程内共享一个 RecentKeys，不按摘要去重的表返回 None'''
+    if capacity <= 0 or not hasattr(model, 'dedupFields'):
+        return None
+    with _recentKeysLock:
+        if model not in _recentKeys:
+            _recentKeys[model] = RecentKeys(capacity)
+        return _recentKeys[model]
+
+
+def migrateLogHashes(db: sqlalchemy.engine.Engine, model, batchSize: int = DEFAULT_BATCH_SIZE, rehash: bool = False) -> dict:
+    '''
+    为旧表补充去重摘要：缺少 content_hash 列时先添加，再为空摘要的行计算摘要，
+    删除摘要重复的行（保留 id 最小的），最后建立唯一索引
+    rehash 时先清空已有摘要，用于摘要格式变化后重新计算
+    '''
+    table = model.__table__
+    inspector = sqlalchemy.inspect(db)
+    columns = {c['name'] for c in inspector.get_columns(table.name)}
+    with db.begin() as conn:
+        if 'content_hash' not in columns:
+            conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN content_hash VARCHAR(32)')
+        elif rehash:
+            conn.execute(sqlalchemy.update(table).values(content_hash=None))
+
+    hashed = 0
+    fields = [table.c[f] for f in model.dedupFields]
+    while True:
+        stmt = sqlalchemy.select(table.c.id, *fields).where(table.c.content_hash.is_(None)).order_by(table.c.id).limit(batchSize)
+        with db.begin() as conn:
+            rows = conn.execute(stmt).all()
+            if len(rows) == 0:
+                break
+            params = [{'_id': r[0], '_hash': logHash(model, dict(zip(model.dedupFields, r[1:])))} for r in rows]
+            conn.execute(sqlalchemy.update(table).where(table.c.id == sqlalchemy.bindparam('_id'))
+                         .values(content_hash=sqlalchemy.bindparam('_hash')), params)
+        hashed += len(rows)
+        logging.info(f'Hashed {hashed} rows in {table.name}')
+
+    keep = sqlalchemy.select(sqlalchemy.func.min(table.c.id)).group_by(table.c.content_hash).subquery()
+    with db.begin() as conn:
+        # 嵌套一层子查询，MySQL 不允许在 DELETE 的子查询中直接引用被删除的表
+        deleted = conn.execute(sqlalchemy.delete(table).where(
+            table.c.id.not_in(sqlalchemy.select(keep.c[0])))).rowcount
+    logging.info(f'Deleted {deleted} duplicate rows from {table.name}')
+
+    indexes = {i['name'] for i in inspector.get_indexes(table.name)} | \
+        {c['name'] for c in inspector.get_unique_constraints(table.name)}
+    for constraint in table.constraints:
+        if isinstance(constraint, sqlalchemy.UniqueConstraint) and constraint.name not in indexes:
+            with db.begin() as conn:
+                names = ', '.join(c.name for c in constraint.columns)
+                conn.exec_driver_sql(f'CREATE UNIQUE INDEX {constraint.name} ON {table.name} ({names})')
+    return {'hashed': hashed, 'deleted': deleted}
+
+
+# 在旧版 mail_box 表上补充的列及其定义
+MAILBOX_COLUMNS = {
+    'enable': 'INTEGER DEFAULT 1',
+    'content_hash': 'VARCHAR(32)',
+}
+
+
+def migrateMailBox(db: sqlalchemy.engine.Engine) -> list:
+    '''为旧的 mail_box 表补充缺少的列（create_all 不会修改已存在的表），返回添加的列名'''
+    columns = {c['name'] for c in sqlalchemy.inspect(db).get_columns(MailBox.__tablename__)}
+    added = [name for name in MAILBOX_COLUMNS if name not in columns]
+    with db.begin() as conn:
+        for name in added:
+            conn.exec_driver_sql(f'ALTER TABLE {MailBox.__tablename__} ADD COLUMN {name} {MAILBOX_COLUMNS[name]}')
+    if len(added) > 0:
+        logging.info(f'Added columns {added} to {MailBox.__tablename__}')
+    return added
+
+
+def migrateIndexes(db: sqlalchemy.engine.Engine, models) -> list:
+    '''为已存在的表建立模型中新增的索引（create_all 只为新建的表建立索引），返回建立的索引名'''
+    inspector = sqlalchemy.inspect(db)
+    created = []
+    for model in models:
+        existing = {i['name'] for i in inspector.get_indexes(model.__tablename__)}
+        for index in model.__table__.indexes:
+            if index.name not in existing:
+                index.create(db)
+                created.append(index.name)
+                logging.info(f'Created index {index.name} on {model.__tablename__}')
+    return created
+
+
+def loadMailBoxHashes(db: sqlalchemy.engine.Engine) -> dict:
+    '''读取每个邮箱当前的摘要'''
+    stmt = sqlalchemy.select(MailBox.address, MailBox.content_hash)
+    with sqlalchemy.orm.Session(db) as session:
+        return {address: h for address, h in session.execute(stmt)}
+
+
+def deleteMailBoxes(session: sqlalchemy.orm.Session, addresses: list, batchSize: int = DEFAULT_BATCH_SIZE) -> None:
+    for i in range(0, len(addresses), batchSize):
+        session.execute(sqlalchemy.delete(MailBox).where(MailBox.address.in_(addresses[i:i + batchSize])))
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import logging
+import threading
+from common import *
+
+DEFAULT_TTL = 3600
+
+
+class DepartmentIndex:
+    '''
+    部门树的内存索引
+    按 id 查找为 O(1)；预先计算先序遍历区间，判断子孙关系为 O(1)，子树为连续区间
+    '''
+
+    def __init__(self, departments: dict) -> None:
+        self.byId = {}
+        self.children = {}
+        for dept in departments.values():
+            self.byId[dept.id] = dept
+        for dept in self.byId.values():
+            if dept.parentId is not None and dept.parentId in self.byId:
+                self.children.setdefault(dept.parentId, []).append(dept.id)
+        for ids in self.children.values():
+            ids.sort(key=lambda i: self.byId[i].order)
+        for dept in self.byId.values():
+            dept.hasChild = dept.id in self.children
+        self._order = []
+        self._enter = {}
+        self._exit = {}
+        roots = [d.id for d in self.byId.values() if d.parentId is None or d.parentId not in self.byId]
+        for root in roots:
+            self._walk(root)
+
+    def _walk(self, root: int) -> None:
+        '''迭代式先序遍历，记录每个部门子树在 _order 中的区间'''
+        stack = [(root, False)]
+        while len(stack) > 0:
+            deptId, leaving = stack.pop()
+            if leaving:
+                self._exit[deptId] = len(self._order)
+                continue
+            self._enter[deptId] = len(self._order)
+            self._order.append(deptId)
+            stack.append((deptId, True))
+            for child in reversed(self.children.get(deptId, [])):
+                stack.append((child, False))
+
+    def __len__(self) -> int:
+        return len(self.byId)
+
+    def get(self, deptId: int) -> Department:
+        return self.byId.get(int(deptId))
+
+    def isDescendant(self, deptId: int, ancestorId: int) -> bool:
+        '''deptId 是否位于 ancestorId 的子树中（含自身）'''
+        deptId, ancestorId = int(deptId), int(ancestorId)
+        if deptId not in self._enter or ancestorId not in self._enter:
+            return False
+        return self._enter[ancestorId] <= self._enter[deptId] < self._exit[ancestorId]
+
+    def subtree(self, deptId: int) -> list:
+        '''子树中全部部门 id（含自身），按先序排列'''
+        deptId = int(deptId)
+        if deptId not in self._enter:
+            return []
+        return self._order[self._enter[deptId]:self._exit[deptId]]
+
+    def ancestors(self, deptId: int) -> list:
+        '''从父部门到根部门的 id 列表'''
+        result = []
+        dept = self.get(deptId)
+        while dept is not None and dept.parentId is not None and dept.parentId in self.byId:
+            result.append(dept.parentId)
+            dept = self.byId[dept.parentId]
+        return result
+
+    def save(self, filename: str) -> None:
+        with open(filename, 'w') as fp:
+            json.dump(self.byId, fp,
+                      default=lambda x: x.__dict__,
+                      indent=4)
+
+    @staticmethod
+    def load(filename: str):
+        with open(filename) as fp:
+            data: dict = json.load(fp)
+        departments = {}
+        for d in data.values():
+            dept = Department()
+            dept.__dict__.update(d)
+            departments[dept.id] = dept
+        return DepartmentIndex(departments)
+
+
+_cache = {}
+_cacheLock = threading.Lock()
+
+
+def getDepartmentIndex(filename: str, client=None, ttl: float = DEFAULT_TTL, refresh: bool = False) -> DepartmentIndex:
+    '''
+    获取部门索引：优先使用进程内缓存，其次是未过期的磁盘文件，
+    都已过期（或 refresh）且提供了 client 时重新遍历部门树并写回磁盘
+    遍历失败时异常直接抛出，不完整的部门树不会写入磁盘或缓存
+    '''
+    with _cacheLock:
+        cached = _cache.get(filename)
+        now = time.time()
+        if not refresh and cached is not None and now - cached[1] < ttl:
+            return cached[0]
+
+        index = None
+        fresh = os.path.exists(filename) and now - os.path.getmtime(filename) < ttl
+        if client is not None and (refresh or not fresh):
+            index = DepartmentIndex(client.getFullDepartmentList())
+            index.save(filename)
+            logging.info(f'Department index rebuilt with {len(index)} departments')
+        elif os.path.exists(filename):
+            index = DepartmentIndex.load(filename)
+        if index is None:
+            return None
+        _cache[filename] = (index, now)
+        return index
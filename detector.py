@@ -0,0 +1,225 @@
+import json
+import logging
+import datetime
+import threading
+import collections
+import sqlalchemy
+from database import *
+
+DEFAULT_LOOKBACK_DAYS = 30
+DEFAULT_FANOUT_WINDOW = 3600
+DEFAULT_FANOUT_USERS = 10
+DEFAULT_BURST_WINDOW = 600
+DEFAULT_BURST_LOGINS = 20
+DEFAULT_MAX_USERS = 100000
+DEFAULT_MAX_IPS = 100000
+DEFAULT_MAX_IPS_PER_USER = 32
+# 每处理这么多条记录按时间清理一次过期数据
+EVICT_EVERY = 10000
+
+NEW_IP = 'new_ip'
+IP_FANOUT = 'ip_fanout'
+CLIENT_BURST = 'client_burst'
+
+
+class LoginDetector:
+    '''
+    登录异常的流式检测，在内存中维护按事件时间滑动的索引：
+    邮箱 -> 最近 lookbackDays 天使用过的 IP，IP -> 最近 fanoutWindow 秒内登录过的邮箱，
+    邮箱 -> 最近 burstWindow 秒内的客户端登录；各索引按容量 LRU 淘汰，内存有上限
+    重叠同步窗口中重复出现的记录按 content_hash 去重，不会重复计数
+    '''
+
+    def __init__(self, lookbackDays: int = DEFAULT_LOOKBACK_DAYS, fanoutWindow: int = DEFAULT_FANOUT_WINDOW,
+                 fanoutUsers: int = DEFAULT_FANOUT_USERS, burstWindow: int = DEFAULT_BURST_WINDOW,
+                 burstLogins: int = DEFAULT_BURST_LOGINS, maxUsers: int = DEFAULT_MAX_USERS, maxIps: int = DEFAULT_MAX_IPS,
+                 maxIpsPerUser: int = DEFAULT_MAX_IPS_PER_USER) -> None:
+        self.lookback = lookbackDays * 86400
+        self.fanoutWindow = fanoutWindow
+        self.fanoutUsers = fanoutUsers
+        self.burstWindow = burstWindow
+        self.burstLogins = burstLogins
+        self.maxUsers = maxUsers
+        self.maxIps = maxIps
+        self.maxIpsPerUser = maxIpsPerUser
+        self._userIps = collections.OrderedDict()
+        self._ipUsers = collections.OrderedDict()
+        self._bursts = collections.OrderedDict()
+        self._alerted = {}
+        self._clock = 0
+        self._observed = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _touch(index: collections.OrderedDict, key, capacity: int) -> dict:
+        entry = index.get(key)
+        if entry is None:
+            entry = index[key] = {}
+            if len(index) > capacity:
+                index.popitem(last=False)
+        else:
+            index.move_to_end(key)
+        return entry
+
+    def _alert(self, alerts: list, kind: str, key, ts: float, cooldown: float, **fields) -> None:
+        '''同一对象在 cooldown 秒内只报警一次'''
+        last = self._alerted.get((kind, key))
+        if last is not None and abs(ts - last) < cooldown:
+            return
+        self._alerted[(kind, key)] = ts
+        alerts.append(dict(time=datetime.datetime.fromtimestamp(ts), kind=kind, **fields))
+
+    def _observe(self, row: dict, alerts: list = None) -> None:
+        address, ip = row['address'], row['ip']
+        if address is None or ip is None or row['time'] is None:
+            return
+        ts = row['time'].timestamp()
+        self._clock = max(self._clock, ts)
+
+        ips = self._touch(self._userIps, address, self.maxUsers)
+        if alerts is not None and len(ips) > 0 and ip not in ips:
+            self._alert(alerts, NEW_IP, (address, ip), ts, float('inf'), address=address, ip=ip,
+                        detail=f'{len(ips)} known IPs in the last {self.lookback // 86400} days')
+        ips[ip] = max(ips.get(ip, ts), ts)
+        if len(ips) > self.maxIpsPerUser:
+            del ips[min(ips, key=ips.get)]
+
+        users = self._touch(self._ipUsers, ip, self.maxIps)
+        users[address] = max(users.get(address, ts), ts)
+        if alerts is not None and len(users) >= self.fanoutUsers:
+            recent = [a for a, t in users.items() if abs(ts - t) <= self.fanoutWindow]
+            if len(recent) >= self.fanoutUsers:
+                self._alert(alerts, IP_FANOUT, ip, ts, self.fanoutWindow, address=None, ip=ip,
+                            detail=f'{len(recent)} mailboxes within {self.fanoutWindow}s')
+
+        if row['type'] is ExLoginType.CLIENT:
+            logins = self._touch(self._bursts, address, self.maxUsers)
+            logins[row['content_hash']] = ts
+            if alerts is not None and len(logins) >= self.burstLogins:
+                recent = sum(1 for t in logins.values() if abs(ts - t) <= self.burstWindow)
+                if recent >= self.burstLogins:
+                    self._alert(alerts, CLIENT_BURST, address, ts, self.burstWindow, address=address, ip=ip,
+                                detail=f'{recent} client logins within {self.burstWindow}s')
+
+        self._observed += 1
+        if self._observed % EVICT_EVERY == 0:
+            self._evict()
+
+    def _evict(self) -> None:
+        '''按事件时间清理滑动窗口之外的数据'''
+        for index, window in ((self._userIps, self.lookback), (self._ipUsers, self.fanoutWindow), (self._bursts, self.burstWindow)):
+            cutoff = self._clock - window
+            for key in list(index):
+                entries = index[key]
+                for k in [k for k, t in entries.items() if t < cutoff]:
+                    del entries[k]
+                if len(entries) == 0:
+                    del index[key]
+        cutoff = self._clock - self.lookback
+        for key in [k for k, t in self._alerted.items() if t < cutoff]:
+            del self._alerted[key]
+
+    def observe(self, rows: list) -> list:
+        '''处理新写入的登录记录，返回产生的报警'''
+        alerts = []
+        with self._lock:
+            for row in sorted(rows, key=lambda r: r['time']):
+                self._observe(row, alerts)
+        return alerts
+
+    def seed(self, db: sqlalchemy.engine.Engine, batchSize: int = DEFAULT_BATCH_SIZE) -> int:
+        '''启动时从 login_log 读取最近 lookbackDays 天的记录建立索引，不产生报警'''
+        since = datetime.datetime.now() - datetime.timedelta(seconds=self.lookback)
+        table = LoginLog.__table__
+        stmt = sqlalchemy.select(table.c.time, table.c.address, table.c.ip, table.c.type, table.c.content_hash) \
+            .where(table.c.time >= since).order_by(table.c.time).execution_options(yield_per=batchSize)
+        seeded = 0
+        with self._lock, sqlalchemy.orm.Session(db) as session:
+            for row in session.execute(stmt):
+                self._observe(row._mapping)
+                seeded += 1
+            self._evict()
+        logging.info(f'Seeded login detector with {seeded} rows, {len(self._userIps)} mailboxes and {len(self._ipUsers)} IPs')
+        return seeded
+
+    def sizes(self) -> dict:
+        return {'users': len(self._userIps), 'ips': len(self._ipUsers), 'bursts': len(self._bursts)}
+
+
+class AlertFile:
+    '''报警逐行以 JSON 追加写入文件'''
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def write(self, alerts: list) -> None:
+        with self._lock, open(self.filename, 'a', encoding='utf-8') as fp:
+            for alert in alerts:
+                fp.write(json.dumps(dict(alert, time=alert['time'].isoformat()), ensure_ascii=False) + '\n')
+
+
+class AlertTable:
+    '''报警写入 login_alert 表'''
+
+    def __init__(self, db: sqlalchemy.engine.Engine) -> None:
+        self.db = db
+
+    def write(self, alerts: list) -> None:
+        now = datetime.datetime.now()
+        with sqlalchemy.orm.Session(self.db) as session:
+            session.begin()
+            session.execute(sqlalchemy.insert(LoginAlert), [dict(a, created=now) for a in alerts])
+            session.commit()
+
+
+class DetectorHook:
+    '''流水线写入登录记录后的回调：检测并写出报警'''
+
+    def __init__(self, detector: LoginDetector, sinks: list) -> None:
+        self.detector = detector
+        self.sinks = sinks
+
+    def __call__(self, rows: list) -> None:
+        alerts = self.detector.observe(rows)
+        if len(alerts) == 0:
+            return
+        logging.warning(f'Login detector raised {len(alerts)} alerts: {[(a["kind"], a["address"], a["ip"]) for a in alerts[:5]]}')
+        for sink in self.sinks:
+            try:
+                sink.write(alerts)
+            except Exception as ex:
+                logging.error(f'Error writing {len(alerts)} login alerts to {type(sink).__name__}, reason: {repr(ex)}')
+
+
+_hook = None
+_hookLock = threading.Lock()
+
+
+def getDetectorHook(db: sqlalchemy.engine.Engine, config: dict) -> DetectorHook:
+    '''
+    按配置中的 detector 创建检测回调，未配置时返回 None
+    进程内只创建并从数据表初始化一次，守护模式下各次同步共享同一份索引
+    '''
+    global _hook
+    options = config.get('detector')
+    if not options:
+        return None
+    with _hookLock:
+        if _hook is None:
+            detector = LoginDetector(options.get('lookbackDays', DEFAULT_LOOKBACK_DAYS),
+                                     options.get('fanoutWindow', DEFAULT_FANOUT_WINDOW),
+                                     options.get('fanoutUsers', DEFAULT_FANOUT_USERS),
+                                     options.get('burstWindow', DEFAULT_BURST_WINDOW),
+                                     options.get('burstLogins', DEFAULT_BURST_LOGINS),
+                                     options.get('maxUsers', DEFAULT_MAX_USERS),
+                                     options.get('maxIps', DEFAULT_MAX_IPS),
+                                     options.get('maxIpsPerUser', DEFAULT_MAX_IPS_PER_USER))
+            detector.seed(db, config.get('batchSize', DEFAULT_BATCH_SIZE))
+            sinks = []
+            if options.get('alertFile'):
+                sinks.append(AlertFile(options['alertFile']))
+            if options.get('alertTable'):
+                sinks.append(AlertTable(db))
+            _hook = DetectorHook(detector, sinks)
+        return _hook
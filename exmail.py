@@ -2,7 +2,30 @@ import requests
 import datetime
 import logging
 import json
+import os
+import tempfile
+import threading
+import time
+import concurrent.futures
+try:
+    # 可选：更快的 JSON 解析
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
 from common import *
+from ratelimit import *
+from metrics import API_LATENCY, API_ERRORS, API_RETRIES
+
+
+class ExMailApiError(Exception):
+    '''接口返回错误或重试耗尽'''
+
+    def __init__(self, errcode: int, errmsg: str) -> None:
+        super().__init__(f'{errcode}({errmsg})')
+        self.errcode = errcode
+        self.errmsg = errmsg
+
 
 class ExMailApi:
     _base: str = 'https://api.exmail.qq.com/cgi-bin/'
@@ -10,18 +33,30 @@ class ExMailApi:
     _secret: str = None
     _token: str = None
     _tokenExpiry: datetime.datetime = None
+    # 剩余有效期低于该值时在后台提前刷新令牌
     _tokenExpiryThreshold: datetime.timedelta = datetime.timedelta(minutes=10)
+    # 剩余有效期低于该值时同步等待刷新完成
+    _tokenMinimumValidity: datetime.timedelta = datetime.timedelta(minutes=1)
+    _tokenLock: threading.Lock = None
     _session: requests.Session = None
     _config: str = 'config.json'
+    # 所有客户端实例共享同一速率控制，配置取自首个实例的 rateLimit 字段
+    _rateControl: RateController = None
+    _rateControlLock: threading.Lock = threading.Lock()
 
     def __init__(self, configName: str = None) -> None:
         if configName is None:
             configName = self._config
+        self._configName = configName
         with open(configName) as fp:
             data = json.load(fp)
         self._corpId = data['corpId']
         self._secret = data['corpSecret']
         self._session = requests.session()
+        self._tokenLock = threading.Lock()
+        with ExMailApi._rateControlLock:
+            if ExMailApi._rateControl is None:
+                ExMailApi._rateControl = RateController(data.get('rateLimit'))
         if data['accessToken'] is not None:
             self._token = data['accessToken']
         if data['accessTokenExpiry'] is not None:
@@ -31,36 +66,140 @@ class ExMailApi:
         return datetime.datetime.now()
 
     def saveConfig(self) -> None:
-        data = {
+        '''原子写入配置文件，避免并发或中断时留下不完整的文件'''
+        with open(self._configName) as fp:
+            data = json.load(fp)
+        data.update({
             'corpId': self._corpId,
             'corpSecret': self._secret,
             'accessToken': self._token,
-            'accessTokenExpiry': self._tokenExpiry
-        }
-        with open(self._config, 'w') as fp:
-            json.dump(data, fp, default=str)
+            'accessTokenExpiry': self._tokenExpiry.strftime('%Y-%m-%d %H:%M:%S.%f') if self._tokenExpiry is not None else None
+        })
+        dirName = os.path.dirname(os.path.abspath(self._configName))
+        fd, tmpName = tempfile.mkstemp(dir=dirName, prefix='.tmp-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(data, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmpName, self._configName)
+        except BaseException:
+            os.unlink(tmpName)
+            raise
 
-    def getToken(self) -> str:
-        if self._token == None or self._now() + self._tokenExpiryThreshold > self._tokenExpiry:
-            # Get new token
-            url = self._base + 'gettoken'
-            params = {
-                'corpid': self._corpId,
-                'corpsecret': self._secret
-            }
-            r = self._session.get(url, params=params)
-            resp = r.json()
-            if 'access_token' in resp:
-                self._token = resp['access_token']
-                self._tokenExpiry = self._now() + datetime.timedelta(seconds=resp['expires_in'])
-                self.saveConfig()
-                logging.info(f'Token update succeeded, expiry is {self._tokenExpiry}')
-            if 'errcode' in resp and resp['errcode'] != 0:
+    def _tokenRemaining(self) -> datetime.timedelta:
+        if self._token is None or self._tokenExpiry is None:
+            return datetime.timedelta(0)
+        return self._tokenExpiry - self._now()
+
+    def _tokenUsable(self) -> bool:
+        return self._tokenRemaining() > self._tokenMinimumValidity
+
+    def _refreshToken(self) -> None:
+        '''请求新令牌，调用方需持有 _tokenLock'''
+        url = self._base + 'gettoken'
+        params = {
+            'corpid': self._corpId,
+            'corpsecret': self._secret
+        }
+        r = self._session.get(url, params=params)
+        resp = r.json()
+        if 'access_token' in resp:
+            self._tokenExpiry = self._now() + datetime.timedelta(seconds=resp['expires_in'])
+            self._token = resp['access_token']
+            self.saveConfig()
+            logging.info(f'Token update succeeded, expiry is {self._tokenExpiry}')
+        if 'errcode' in resp and resp['errcode'] != 0:
+            logging.error(f'Token update failed, reason is {resp["errcode"]}({resp["errmsg"]})')
+            if not self._tokenUsable():
                 self._token = None
                 self._tokenExpiry = None
-                logging.error(f'Token update failed, reason is {resp["errcode"]}({resp["errmsg"]})')
-        
-        return self._token
+
+    def _backgroundRefresh(self) -> None:
+        try:
+            self._refreshToken()
+        except Exception as ex:
+            logging.error(f'Background token update failed, reason: {repr(ex)}')
+        finally:
+            self._tokenLock.release()
+
+    def getToken(self) -> str:
+        remaining = self._tokenRemaining()
+        if remaining > self._tokenExpiryThreshold:
+            return self._token
+        if remaining > self._tokenMinimumValidity:
+            # 令牌仍可用，由一个后台线程提前刷新，其余调用直接返回当前令牌
+            if self._tokenLock.acquire(blocking=False):
+                threading.Thread(target=self._backgroundRefresh, daemon=True).start()
+            return self._token
+
+        with self._tokenLock:
+            # 等待期间可能已有其他线程完成刷新
+            if not self._tokenUsable():
+                self._refreshToken()
+            return self._token
+
+    def _invalidateToken(self, token: str) -> None:
+        '''接口提示令牌失效时作废该令牌，已被其他线程刷新的令牌不受影响'''
+        if self._token == token:
+            self._tokenExpiry = None
+
+    @staticmethod
+    def _observe(path: str, started: float, result: str, errcode: str) -> None:
+        '''记录单次请求的耗时、错误与重试'''
+        API_LATENCY.observe(time.perf_counter() - started, endpoint=path)
+        if result != OK:
+            API_ERRORS.inc(endpoint=path, errcode=errcode)
+        if result not in (OK, FAILED):
+            API_RETRIES.inc(endpoint=path, reason=result)
+
+    def _request(self, method: str, path: str, params: dict = None, jsonData: dict = None) -> dict:
+        '''
+        在速率控制下调用接口
+        限流、HTTP 429/5xx、网络错误与令牌失效会在截止时间内带抖动重试，重试耗尽时抛出 ExMailApiError
+        其余 errcode 原样返回，由调用方处理
+        '''
+        control = self._rateControl
+        deadline = control.deadline()
+        attempt = 0
+        while True:
+            if not control.acquire(path, deadline):
+                raise ExMailApiError(-1, f'Rate limit wait for {path} exceeded deadline')
+            result, data, errcode, reason = FAILED, None, -1, None
+            token, label = None, 'gettoken'
+            started = time.perf_counter()
+            try:
+                # 令牌在占用并发槽后获取，获取失败同样释放槽位并按重试策略处理
+                token = self.getToken()
+                query = {'access_token': token}
+                if params is not None:
+                    query.update(params)
+                label = 'network'
+                r = self._session.request(method, self._base + path, params=query, json=jsonData)
+                label = f'http_{r.status_code}'
+                if classify(r.status_code) == THROTTLED:
+                    result, reason = THROTTLED, f'HTTP {r.status_code}'
+                else:
+                    data = loads(r.content)
+                    errcode = data.get('errcode', 0)
+                    label = str(errcode)
+                    result, reason = classify(r.status_code, errcode), f'{errcode}({data.get("errmsg")})'
+            except (requests.RequestException, ValueError) as ex:
+                result, reason = RETRY, repr(ex)
+            finally:
+                control.release(result)
+                self._observe(path, started, result, label)
+
+            if result in (OK, FAILED):
+                return data
+            if result == TOKEN_EXPIRED:
+                self._invalidateToken(token)
+            delay = control.retry.nextDelay(attempt, deadline)
+            if delay is None:
+                raise ExMailApiError(errcode, f'Giving up on {path} after {attempt + 1} attempts, last error is {reason}')
+            logging.warning(f'Request to {path} is {result} ({reason}), retrying in {delay:.1f}s (attempt {attempt + 1})')
+            time.sleep(delay)
+            attempt += 1
 
 class ExMailLogApi(ExMailApi):
     _config = 'log.json'
@@ -69,85 +208,77 @@ class ExMailLogApi(ExMailApi):
         获取登录记录
         https://exmail.qq.com/qy_mng_logic/doc#10029
         '''
-        url = self._base + 'log/login'
         jsonData = {
             'begin_date': dateFrom.isoformat(),
             'end_date': dateTo.isoformat(),
             'userid': userId
         }
-        params = {
-            'access_token': self.getToken()
-        }
-        r = self._session.post(url, json=jsonData, params=params)
-        data = r.json()
+        data = self._request('POST', 'log/login', jsonData=jsonData)
         if data['errcode'] == 0:
             return data['list']
         else:
             logging.error(f'Error fetching login log for user {userId}, error is {data["errcode"]}({data["errmsg"]})')
-            return []
+            raise ExMailApiError(data['errcode'], data['errmsg'])
 
     def getMailLog(self, userId: str, dateFrom: datetime.date, dateTo: datetime.date, type: ExMailType = ExMailType.ALL):
         '''
         获取邮件记录
         https://exmail.qq.com/qy_mng_logic/doc#10028
         '''
-        url = self._base + 'log/mail'
         jsonData = {
             'begin_date': dateFrom.isoformat(),
             'end_date': dateTo.isoformat(),
             'userid': userId,
             'mailtype': type.value
         }
-        params = {
-            'access_token': self.getToken()
-        }
-        r = self._session.post(url, json=jsonData, params=params)
-        data = r.json()
+        data = self._request('POST', 'log/mail', jsonData=jsonData)
         if data['errcode'] == 0:
             return data['list']
         else:
             logging.error(f'Error fetching mail log for user {userId}, error is {data["errcode"]}({data["errmsg"]})')
-            return []
+            raise ExMailApiError(data['errcode'], data['errmsg'])
     
     def getOpLog(self, dateFrom: datetime.date, dateTo: datetime.date, type: ExMailOpQueryType = ExMailOpQueryType.ALL):
         '''
         获取操作记录
         https://exmail.qq.com/qy_mng_logic/doc#10031
         '''
-        url = self._base + 'log/operation'
         jsonData = {
             'begin_date': dateFrom.isoformat(),
             'end_date': dateTo.isoformat(),
             'type': type.value
         }
-        params = {
-            'access_token': self.getToken()
-        }
-        r = self._session.post(url, json=jsonData, params=params)
-        data = r.json()
+        data = self._request('POST', 'log/operation', jsonData=jsonData)
         if data['errcode'] == 0:
             return data['list']
         else:
             logging.error(f'Error fetching op log for type {type}, error is {data["errcode"]}({data["errmsg"]})')
-            return []
+            raise ExMailApiError(data['errcode'], data['errmsg'])
 
 
 class ExMailContactApi(ExMailApi):
     _config = 'contact.json'
-    def getFullDepartmentList(self):
+    def getFullDepartmentList(self, parallel: int = 8) -> dict:
         '''
         获取完整部门列表
+        按层广度优先遍历整棵部门树，同一层的部门并发请求
+        任一部门获取失败时抛出 ExMailApiError，不返回缺少子树的部门列表
         '''
         root = Department.root()
         result = {root.id: root}
-        rootList = self.getDepartmentList(root).values()
-        for dept in rootList:
-            childList = self.getDepartmentList(dept.id)
-            if len(childList) > 0:
-                dept.hasChild = True
-            result[dept.id] = dept
-            for childDept in childList.values():
-                result[childDept.id] = childDept
+        level = [root]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            while len(level) > 0:
+                nextLevel = []
+                for dept, children in zip(level, executor.map(lambda d: self.getDepartmentList(d.id), level)):
+                    for child in children.values():
+                        if child.id in result:
+                            continue
+                        dept.hasChild = True
+                        result[child.id] = child
+                        nextLevel.append(child)
+                level = nextLevel
+        logging.info(f'Got {len(result)} departments in total')
         return result
     
     def getDepartmentList(self, id: int = 1):
@@ -155,13 +286,10 @@ class ExMailContactApi(ExMailApi):
         获取部门列表
         https://exmail.qq.com/qy_mng_logic/doc#10011
         '''
-        url = self._base + 'department/list'
         params = {
-            'id': id,
-            'access_token': self.getToken()
+            'id': id
         }
-        r = self._session.get(url, params=params)
-        data = r.json()
+        data = self._request('GET', 'department/list', params=params)
         if data['errcode'] == 0:
             result = {}
             for item in data['department']:
@@ -171,17 +299,14 @@ class ExMailContactApi(ExMailApi):
             return result
         else:
             logging.error(f'Error fetching departments for parent {id}, error is {data["errcode"]}({data["errmsg"]})')
-            return {}
+            raise ExMailApiError(data['errcode'], data['errmsg'])
     
     def getMemberBrief(self, dept: Department, fetchChild: bool = False) -> dict:
-        url = self._base + 'user/simplelist'
         params = {
             'department_id': dept.id,
-            'access_token': self.getToken(),
             'fetch_child': 1 if fetchChild else 0
         }
-        r = self._session.get(url, params=params)
-        data = r.json()
+        data = self._request('GET', 'user/simplelist', params=params)
         if data['errcode'] == 0:
             result = {}
             for user in data['userlist']:
@@ -193,14 +318,11 @@ class ExMailContactApi(ExMailApi):
             return {}
         
     def getMemberDetail(self, dept: Department, fetchChild: bool = False) -> dict:
-        url = self._base + 'user/list'
         params = {
             'department_id': dept.id,
-            'access_token': self.getToken(),
             'fetch_child': 1 if fetchChild else 0
         }
-        r = self._session.get(url, params=params)
-        data = r.json()
+        data = self._request('GET', 'user/list', params=params)
         if data['errcode'] == 0:
             result = {}
             for user in data['userlist']:
@@ -216,16 +338,11 @@ class ExMailContactApi(ExMailApi):
         更新用户信息
         https://exmail.qq.com/qy_mng_logic/doc#10015
         '''
-        url = self._base + 'user/update'
-        params = {
-            'access_token': self.getToken()
-        }
         jsonData = {
             'userid': userid
         }
         jsonData.update(data)
-        r = self._session.post(url, params=params, json=jsonData)
-        data = r.json()
+        data = self._request('POST', 'user/update', jsonData=jsonData)
         logging.info(f'Update user info for {userid} with data {str(jsonData)}, result is {data["errcode"]}, message is {data["errmsg"]}')
         if data['errcode'] == 0:
             return True
@@ -1,183 +1,561 @@
 import datetime
 import json
+import enum
 import fire
 import logging
-import sqlalchemy
+import atexit
+import signal
+import asyncio
 import concurrent.futures
-from sqlalchemy.dialects.mysql import insert
+import sqlalchemy
+import metrics
 from exmail import *
+from database import *
+from pipeline import *
+from backfill import *
+from lease import *
+from departments import *
+from archive import *
+from rollup import repairRollup, readRollup, ROLLUP_MODELS
+from detector import getDetectorHook
+from query import runQuery, DEFAULT_PAGE_SIZE
+from scheduler import Scheduler, DEFAULT_JITTER
 
 DEPARTMENT_JSON = 'department.json'
 DEPT_USER_JSON = 'dept-user.json'
+# 操作日志不区分邮箱，使用固定地址记录水位线
+OP_LOG_WATERMARK = '*'
+# 操作日志接口单次返回的最大条数未公开，返回条数达到该值时视为可能被截断
+DEFAULT_OP_LOG_LIMIT = 1000
+OP_QUERY_CATEGORIES = [t for t in ExMailOpQueryType if t is not ExMailOpQueryType.ALL]
 
 logging.basicConfig(level=logging.INFO, filename='exmail.log',
                     format='%(asctime)s - %(levelname)s : %(message)s')
 
-def getDepartment(deptId: int):
-    '''获取部门信息'''
-    with open(DEPARTMENT_JSON) as fp:
-        data: dict = json.load(fp)
-    d = data.get(deptId, None)
-    if d is not None:
-        dept = Department()
-        dept.__dict__.update(d)
-        return dept
-    else:
+def getDepartment(deptId: int, client: ExMailContactApi = None):
+    '''获取部门信息，使用进程内缓存的部门索引'''
+    index = getDepartmentIndex(DEPARTMENT_JSON, client)
+    if index is None:
         return None
+    return index.get(deptId)
 
 
 def syncDepartmentList(client: ExMailContactApi):
     '''同步部门列表'''
-    deptList = client.getFullDepartmentList()
-    with open(DEPARTMENT_JSON, 'w') as fp:
-        json.dump(deptList, fp,
-                  default=lambda x: x.__dict__,
-                  indent=4)
+    getDepartmentIndex(DEPARTMENT_JSON, client, refresh=True)
 
 def syncDepartmentUserList(client: ExMailContactApi, deptId: int):
     '''同步指定部门下的用户列表'''
-    deptUserList = client.getMemberBrief(getDepartment(deptId))
+    deptUserList = client.getMemberBrief(getDepartment(deptId, client))
     with open(DEPT_USER_JSON, 'w') as fp:
         json.dump(deptUserList, fp,
                   default=lambda x: x.__dict__,
                   indent=4)
 
-def syncUserList(client: ExMailContactApi, config: dict):
-    '''同步用户列表'''
-    userList = client.getMemberDetail(Department.root(), True)
+def mailBoxRow(u: dict) -> dict:
+    '''将 API 返回的用户信息转换为 MailBox 行（不含更新时间）'''
+    row = {
+        'address': u['userid'],
+        'department_id': ','.join([str(x) for x in u['department']]),
+        'alias': ','.join(u['slaves']),
+        'need_reset_password': u['cpwd_login'],
+        'enable': u['enable']
+    }
+    row['content_hash'] = mailBoxHash(row)
+    return row
+
+def syncUserList(client: ExMailContactApi, config: dict) -> dict:
+    '''同步用户列表，只写入新增、变化与删除的用户'''
+    with metrics.phase('fetch'):
+        userList = client.getMemberDetail(Department.root(), True)
     logging.info(f'Fetched {len(userList)} users')
+    if len(userList) == 0:
+        # 接口出错时返回空列表，此时不能据此删除全部用户
+        logging.error('No users fetched, skipping user sync')
+        return None
     db = getDB(config['db'])
-    with sqlalchemy.orm.Session(db) as session:
+    with metrics.phase('diff'):
+        snapshot = {row['address']: row for row in map(mailBoxRow, userList.values())}
+        existing = loadMailBoxHashes(db)
+
+        now = datetime.datetime.now()
+        inserts, updates = [], []
+        for address, row in snapshot.items():
+            if address not in existing:
+                inserts.append(dict(row, updated=now))
+            elif existing[address] != row['content_hash']:
+                updates.append(dict(row, updated=now))
+        deletes = [address for address in existing if address not in snapshot]
+
+    with metrics.phase('write'), sqlalchemy.orm.Session(db) as session:
         session.begin()
-        for u in userList.values():
-            data = {
-                'address': u['userid'],
-                'department_id': ','.join([str(x) for x in u['department']]),
-                'alias': ','.join(u['slaves']),
-                'need_reset_password': u['cpwd_login'],
-                'updated': datetime.datetime.now(),
-                'enable': u['enable']
-            }
-            stmt = sqlalchemy.dialects.mysql.insert(MailBox).values(data).on_duplicate_key_update(data)
-            session.execute(stmt)
+        upsertRows(session, MailBox, inserts + updates, config.get('batchSize', DEFAULT_BATCH_SIZE))
+        deleteMailBoxes(session, deletes, config.get('batchSize', DEFAULT_BATCH_SIZE))
         session.commit()
-    logging.info('User fetching is finished')
+    result = {
+        'inserted': len(inserts),
+        'updated': len(updates),
+        'deleted': len(deletes),
+        'unchanged': len(snapshot) - len(inserts) - len(updates)
+    }
+    logging.info(f'User fetching is finished, {result}')
+    return result
+
+_LOGIN_TYPES = enumLookup(ExLoginType)
+_MAIL_TYPES = enumLookup(ExMailType)
+_MAIL_STATUSES = enumLookup(ExMailStatus)
+_OP_TYPES = enumLookup(ExMailOpType)
+
+_LOGIN_HASH = logHasher(LoginLog)
+_MAIL_HASH = logHasher(MailLog)
+_OP_HASH = logHasher(OpLog)
+
+# 以下行构造函数位于获取日志的热路径上：枚举查表，摘要函数按 dedupFields 预先生成
+
+def loginLogRow(mailbox: str, log: dict) -> dict:
+    '''将 API 返回的登录记录转换为数据库行'''
+    row = {
+        'time': datetime.datetime.fromtimestamp(log['time']),
+        'address': mailbox,
+        'type': _LOGIN_TYPES.get(log['type']) or ExLoginType(log['type']),
+        'ip': log['ip']
+    }
+    row['content_hash'] = _LOGIN_HASH(row)
+    return row
 
-def singleLoginLogs(mailbox: str, date1: datetime.date, date2: datetime.date, client: ExMailLogApi):
-    '''获取单个用户的登录日志并储存至数据库'''
+def mailLogRow(log: dict) -> dict:
+    '''将 API 返回的邮件记录转换为数据库行'''
+    row = {
+        'time': datetime.datetime.fromtimestamp(log['time']),
+        'sender': log['sender'],
+        'receiver': log['receiver'],
+        'subject': log['subject'],
+        'status': _MAIL_STATUSES.get(log['status']) or ExMailStatus(log['status']),
+        'type': _MAIL_TYPES.get(log['mailtype']) or ExMailType(log['mailtype'])
+    }
+    row['content_hash'] = _MAIL_HASH(row)
+    return row
+
+def opLogRow(log: dict) -> dict:
+    '''将 API 返回的操作记录转换为数据库行'''
+    row = {
+        'time': datetime.datetime.fromtimestamp(log['time']),
+        'operator': log['operator'],
+        'operand': log['operand'],
+        'type': _OP_TYPES.get(log['type']) or ExMailOpType(log['type'])
+    }
+    row['content_hash'] = _OP_HASH(row)
+    return row
+
+def singleLoginLogs(mailbox: str, date1: datetime.date, date2: datetime.date, client: ExMailLogApi, deadLetters: DeadLetters = None):
+    '''获取单个用户的登录日志，失败时返回 None 并记入 deadLetters'''
     logging.info(f'Fetching login log for user {mailbox} from {date1.isoformat()} to {date2.isoformat()}')
     try:
-        result = []
         logs = client.getLoginLog(mailbox, date1, date2)
-        for log in logs:
-            data = {
-                'time': datetime.datetime.fromtimestamp(log['time']),
-                'address': mailbox,
-                'type': ExLoginType(log['type']),
-                'ip': log['ip']
-            }
-            result.append(data)
-        return result
+        return [loginLogRow(mailbox, log) for log in logs]
     except Exception as ex:
         logging.error(f'Error fetching login log for user {mailbox}, reason: {repr(ex)}')
+        if deadLetters is not None:
+            deadLetters.failed('login', mailbox, date1, date2, ex)
 
-def loginLogs(client: ExMailLogApi, config: dict, date1: datetime.date, date2: datetime.date):
-    '''多线程同步登录日志'''
-    db = getDB(config['db'])
-    logging.info('Selecting users for fetching login logs')
-    stmt = sqlalchemy.select(MailBox)
-    mailboxes = []
-    with sqlalchemy.orm.Session(db) as session:
-        for row in session.execute(stmt):
-            mailboxes.append(row[0].address)
-    logging.info(f'Fetching login logs for {len(mailboxes)} users')
+def syncSince(watermarks: dict, address: str, config: dict, now: datetime.datetime) -> datetime.datetime:
+    '''增量同步的起始时间：水位线减去重叠时间，没有水位线时取最近 initialDays 天'''
+    mark = watermarks.get(address)
+    if mark is None:
+        return datetime.datetime.combine(now.date() - datetime.timedelta(days=config.get('initialDays', 2)), datetime.time.min)
+    return mark - datetime.timedelta(minutes=config.get('watermarkOverlap', 60))
 
-    with sqlalchemy.orm.Session(db) as session:
-        futureList = []
-        session.begin()
-        with concurrent.futures.ThreadPoolExecutor(max_workers=config['parallel']) as executor:
-            for m in mailboxes:
-                future = executor.submit(singleLoginLogs, m, date1, date2, client)
-                futureList.append(future)
+def filterSince(rows: list, since: datetime.datetime) -> list:
+    '''丢弃早于起始时间的记录，获取失败（None）原样返回'''
+    if rows is None:
+        return None
+    return [r for r in rows if r['time'] >= since]
 
-        for f in concurrent.futures.as_completed(futureList):
-            for data in f.result():
-                session.execute(insert(LoginLog).values(data).on_duplicate_key_update(data))
+def syncMailboxes(db: sqlalchemy.engine.Engine, logType: str, config: dict):
+    '''按配置的调度方式返回待同步邮箱：cost 为最长任务优先（默认），table 为按表顺序流式读取'''
+    if config.get('schedule', 'cost') == 'cost':
+        return scheduledMailboxes(db, logType, config)
+    return streamMailboxes(db, config.get('batchSize', DEFAULT_BATCH_SIZE))
 
-        session.commit()
-    logging.info(f'Finished fetching login logs for {len(mailboxes)} users')
+def mailboxLogs(db: sqlalchemy.engine.Engine, config: dict, model, logType: str, fetch, date1: datetime.date = None, date2: datetime.date = None,
+                mailboxes=None, onCommitted=None, onFailed=None, deadLetters: DeadLetters = None, onRows=None) -> dict:
+    '''
+    多线程同步邮箱的某类日志，fetch(mailbox, date1, date2) 返回待写入的行
+    未指定 mailboxes 时同步全部邮箱；未指定日期时按水位线增量同步，数据提交后才推进水位线
+    给出 deadLetters 时，邮箱数据提交后清除其在已同步区间内的失败记录；onRows 见 runPipeline
+    '''
+    batchSize = config.get('batchSize', DEFAULT_BATCH_SIZE)
+    if mailboxes is None:
+        with metrics.phase('schedule'):
+            mailboxes = syncMailboxes(db, logType, config)
+    if date1 is not None:
+        def committedRange(m):
+            if deadLetters is not None:
+                deadLetters.resolved(logType, m, date1, date2)
+            if onCommitted is not None:
+                onCommitted(m)
+
+        with metrics.phase('pipeline'):
+            return runPipeline(db, model, mailboxes, lambda m: fetch(m, date1, date2), config, committedRange, onFailed, onRows)
+
+    now = datetime.datetime.now()
+    watermarks = loadWatermarks(db, logType)
+    marks = WatermarkBuffer(db, logType, now, batchSize)
 
+    def fetchSince(m):
+        since = syncSince(watermarks, m, config, now)
+        return filterSince(fetch(m, since.date(), now.date()), since)
+
+    def committed(m):
+        marks.add(m)
+        if deadLetters is not None:
+            deadLetters.resolved(logType, m, syncSince(watermarks, m, config, now).date(), now.date())
+        if onCommitted is not None:
+            onCommitted(m)
+
+    try:
+        with metrics.phase('pipeline'):
+            return runPipeline(db, model, mailboxes, fetchSince, config, committed, onFailed, onRows)
+    finally:
+        with metrics.phase('watermarks'):
+            marks.flush()
 
-def singleMailLogs(mailbox: str, date1: datetime.date, date2: datetime.date, client: ExMailLogApi):
-    '''获取单个用户的邮件日志并储存至数据库'''
+def loginLogs(client: ExMailLogApi, config: dict, date1: datetime.date = None, date2: datetime.date = None) -> dict:
+    '''多线程同步登录日志，未指定日期时增量同步'''
+    db = getDB(config['db'])
+    logging.info('Start fetching login logs')
+    deadLetters = DeadLetters(db, config.get('batchSize', DEFAULT_BATCH_SIZE))
+    try:
+        stats = mailboxLogs(db, config, LoginLog, 'login', lambda m, d1, d2: singleLoginLogs(m, d1, d2, client, deadLetters), date1, date2,
+                            deadLetters=deadLetters, onRows=getDetectorHook(db, config))
+    finally:
+        deadLetters.flush()
+    logging.info(f'Finished fetching login logs for {stats["tasks"]} users')
+    return stats
+
+
+def singleMailLogs(mailbox: str, date1: datetime.date, date2: datetime.date, client: ExMailLogApi, deadLetters: DeadLetters = None):
+    '''获取单个用户的邮件日志，失败时返回 None 并记入 deadLetters'''
     logging.info(f'Fetching mail log for user {mailbox} from {date1.isoformat()} to {date2.isoformat()}')
     try:
         logs = client.getMailLog(mailbox, date1, date2)
-        result = []
-        for log in logs:
-            data = {
-                'time': datetime.datetime.fromtimestamp(log['time']),
-                'sender': log['sender'],
-                'receiver': log['receiver'],
-                'subject': log['subject'],
-                'status': ExMailStatus(log['status']),
-                'type': ExMailType(log['mailtype'])
-            }
-            result.append(data)
-        return result
+        return [mailLogRow(log) for log in logs]
     except Exception as ex:
         logging.error(f'Error fetching mail log for user {mailbox}, reason: {repr(ex)}')
+        if deadLetters is not None:
+            deadLetters.failed('mail', mailbox, date1, date2, ex)
 
 
-def mailLogs(client: ExMailLogApi, config: dict, date1: datetime.date, date2: datetime.date):
-    '''同步邮件日志'''
+def mailLogs(client: ExMailLogApi, config: dict, date1: datetime.date = None, date2: datetime.date = None) -> dict:
+    '''同步邮件日志，未指定日期时增量同步'''
     db = getDB(config['db'])
-    logging.info('Selecting users for fetching mail logs')
-    stmt = sqlalchemy.select(MailBox)
-    mailboxes = []
-    with sqlalchemy.orm.Session(db) as session:
-        for row in session.execute(stmt):
-            mailboxes.append(row[0].address)
-    logging.info(f'Fetching mail logs for {len(mailboxes)} users')
+    logging.info('Start fetching mail logs')
+    deadLetters = DeadLetters(db, config.get('batchSize', DEFAULT_BATCH_SIZE))
+    try:
+        stats = mailboxLogs(db, config, MailLog, 'mail', lambda m, d1, d2: singleMailLogs(m, d1, d2, client, deadLetters), date1, date2,
+                            deadLetters=deadLetters)
+    finally:
+        deadLetters.flush()
+    logging.info(f'Finished fetching mail logs for {stats["tasks"]} users')
+    return stats
 
-    with sqlalchemy.orm.Session(db) as session:
-        futureList = []
-        session.begin()
-        with concurrent.futures.ThreadPoolExecutor(max_workers=config['parallel']) as executor:
-            for m in mailboxes:
-                future = executor.submit(singleMailLogs, m, date1, date2, client)
-                futureList.append(future)
-
-        for f in concurrent.futures.as_completed(futureList):
-            for data in f.result():
-                session.execute(insert(MailLog).values(data).on_duplicate_key_update(data))
-        session.commit()
-    logging.info(f'Finished fetching mail logs for {len(mailboxes)} users')
+
+async def asyncSingleLoginLogs(mailbox: str, date1: datetime.date, date2: datetime.date, client, deadLetters: DeadLetters = None):
+    '''协程获取单个用户的登录日志'''
+    logging.info(f'Fetching login log for user {mailbox} from {date1.isoformat()} to {date2.isoformat()}')
+    try:
+        logs = await client.getLoginLog(mailbox, date1, date2)
+        return [loginLogRow(mailbox, log) for log in logs]
+    except Exception as ex:
+        logging.error(f'Error fetching login log for user {mailbox}, reason: {repr(ex)}')
+        if deadLetters is not None:
+            deadLetters.failed('login', mailbox, date1, date2, ex)
+
+
+async def asyncSingleMailLogs(mailbox: str, date1: datetime.date, date2: datetime.date, client, deadLetters: DeadLetters = None):
+    '''协程获取单个用户的邮件日志'''
+    logging.info(f'Fetching mail log for user {mailbox} from {date1.isoformat()} to {date2.isoformat()}')
+    try:
+        logs = await client.getMailLog(mailbox, date1, date2)
+        return [mailLogRow(log) for log in logs]
+    except Exception as ex:
+        logging.error(f'Error fetching mail log for user {mailbox}, reason: {repr(ex)}')
+        if deadLetters is not None:
+            deadLetters.failed('mail', mailbox, date1, date2, ex)
 
 
-def opLogs(client: ExMailLogApi, config: dict, date1: datetime.date, date2: datetime.date):
-    '''同步邮件日志'''
+def asyncLogs(config: dict, model, logType: str, fetch, date1: datetime.date = None, date2: datetime.date = None) -> dict:
+    '''使用协程客户端同步登录或邮件日志，未指定日期时增量同步'''
+    from asyncexmail import AsyncExMailLogApi, DEFAULT_CONCURRENCY
+    db = getDB(config['db'])
+    concurrency = config.get('asyncConcurrency', DEFAULT_CONCURRENCY)
+    batchSize = config.get('batchSize', DEFAULT_BATCH_SIZE)
+    now = datetime.datetime.now()
+    marks = None
+    deadLetters = DeadLetters(db, batchSize)
+    if date1 is None:
+        watermarks = loadWatermarks(db, logType)
+        marks = WatermarkBuffer(db, logType, now, batchSize)
+
+    def committed(m):
+        if marks is None:
+            deadLetters.resolved(logType, m, date1, date2)
+            return
+        marks.add(m)
+        deadLetters.resolved(logType, m, syncSince(watermarks, m, config, now).date(), now.date())
+
+    async def run():
+        async with AsyncExMailLogApi(concurrency=concurrency) as client:
+            async def fetchTask(m):
+                if marks is None:
+                    return await fetch(m, date1, date2, client, deadLetters)
+                since = syncSince(watermarks, m, config, now)
+                return filterSince(await fetch(m, since.date(), now.date(), client, deadLetters), since)
+
+            with metrics.phase('schedule'):
+                mailboxes = syncMailboxes(db, logType, config)
+            with metrics.phase('pipeline'):
+                return await runAsyncPipeline(db, model, mailboxes, fetchTask, config, concurrency, committed,
+                                              onRows=getDetectorHook(db, config) if model is LoginLog else None)
+
+    logging.info(f'Start fetching {model.__tablename__} with up to {concurrency} concurrent requests')
+    try:
+        stats = asyncio.run(run())
+    finally:
+        if marks is not None:
+            with metrics.phase('watermarks'):
+                marks.flush()
+        deadLetters.flush()
+    logging.info(f'Finished fetching {model.__tablename__} for {stats["tasks"]} users')
+    return stats
+
+
+def planOpShards(date1: datetime.date, date2: datetime.date, byType: bool = False, shardDays: int = 1) -> list:
+    '''
+    将操作日志的时间窗口切分为 (起始日期, 结束日期, 查询类别) 分片，默认每段只查询 ALL，疑似被截断时再由 splitOpShard 拆分
+    byType 时每段直接按各类别查询，不属于任何类别的操作会被遗漏
+    '''
+    types = OP_QUERY_CATEGORIES if byType else [ExMailOpQueryType.ALL]
+    return [(dateFrom, dateTo, t) for dateFrom, dateTo in shardRanges(date1, date2, shardDays) for t in types]
+
+def splitOpShard(shard: tuple) -> list:
+    '''拆分疑似被截断的分片：多天的分片按天对半拆分，单天的 ALL 拆为各类别，无法再拆分时返回空列表'''
+    dateFrom, dateTo, queryType = shard
+    days = (dateTo - dateFrom).days
+    if days > 0:
+        middle = dateFrom + datetime.timedelta(days=days // 2)
+        return [(dateFrom, middle, queryType), (middle + datetime.timedelta(days=1), dateTo, queryType)]
+    if queryType is ExMailOpQueryType.ALL:
+        return [(dateFrom, dateTo, t) for t in OP_QUERY_CATEGORIES]
+    return []
+
+def _opShardName(shard: tuple) -> str:
+    dateFrom, dateTo, queryType = shard
+    return f'{dateFrom.isoformat()}~{dateTo.isoformat()}/{queryType.name}'
+
+def fetchOpShards(client: ExMailLogApi, shards: list, parallel: int = 8, limit: int = DEFAULT_OP_LOG_LIMIT,
+                  deadLetters: DeadLetters = None) -> tuple:
+    '''
+    并发获取各分片的操作日志，合并后按 content_hash 去重，返回 (行, 统计)
+    返回条数达到 limit 的分片自动拆分后重新获取，已无法拆分的记入 truncated，获取失败的记入 failed 与 deadLetters
+    '''
+    rows = {}
+    stats = {'shards': 0, 'split': 0, 'truncated': [], 'failed': []}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = {executor.submit(client.getOpLog, *shard): shard for shard in shards}
+        while len(futures) > 0:
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                shard = futures.pop(future)
+                name = _opShardName(shard)
+                try:
+                    logs = future.result()
+                except Exception as ex:
+                    logging.error(f'Error fetching op log shard {name}, reason: {repr(ex)}')
+                    stats['failed'].append(name)
+                    if deadLetters is not None:
+                        deadLetters.failed('op', OP_LOG_WATERMARK, shard[0], shard[1], ex)
+                    continue
+                stats['shards'] += 1
+                metrics.ROWS_FETCHED.inc(len(logs), table=OpLog.__tablename__)
+                if len(logs) >= limit:
+                    parts = splitOpShard(shard)
+                    if len(parts) > 0:
+                        logging.warning(f'Op log shard {name} returned {len(logs)} records and may be truncated, splitting into {len(parts)} shards')
+                        stats['split'] += 1
+                        for part in parts:
+                            futures[executor.submit(client.getOpLog, *part)] = part
+                        continue
+                    logging.error(f'Op log shard {name} returned {len(logs)} records and cannot be split further, some records may be missing')
+                    metrics.OP_LOG_TRUNCATED.inc(type=shard[2].name)
+                    stats['truncated'].append(name)
+                for log in logs:
+                    row = opLogRow(log)
+                    rows[row['content_hash']] = row
+    return list(rows.values()), stats
+
+def opLogs(client: ExMailLogApi, config: dict, date1: datetime.date = None, date2: datetime.date = None) -> int:
+    '''
+    同步操作日志，未指定日期时增量同步
+    窗口按天切分后并发获取，返回条数疑似被截断的分片再按查询类别拆分（opShardByType 时一开始就按类别切分）；
+    有分片获取失败时仍写入其余数据，但不推进水位线
+    '''
     db = getDB(config['db'])
     logging.info('Start fetching op logs')
+    now, since = None, None
+    if date1 is None:
+        now = datetime.datetime.now()
+        since = syncSince(loadWatermarks(db, 'op'), OP_LOG_WATERMARK, config, now)
+        date1, date2 = since.date(), now.date()
+    shards = planOpShards(date1, date2, config.get('opShardByType', False), config.get('opShardDays', 1))
+    logging.info(f'Fetching op log from {date1.isoformat()} to {date2.isoformat()} in {len(shards)} shards')
+    deadLetters = DeadLetters(db, config.get('batchSize', DEFAULT_BATCH_SIZE))
+    with metrics.phase('fetch'):
+        rows, stats = fetchOpShards(client, shards, config.get('parallel', 8), config.get('opLogLimit', DEFAULT_OP_LOG_LIMIT), deadLetters)
     with sqlalchemy.orm.Session(db) as session:
-        logging.info(f'Fetching op log for from {date1.isoformat()} to {date2.isoformat()}')
-        logs = client.getOpLog(date1, date2)
-        session.begin()
-        for log in logs:
-            data = {
-                'time': datetime.datetime.fromtimestamp(log['time']),
-                'operator': log['operator'],
-                'operand': log['operand'],
-                'type': ExMailOpType(log['type'])
-            }
-            session.execute(insert(OpLog).values(data).on_duplicate_key_update(data))
-        session.commit()
-    logging.info('Finished fetching op logs')
+        with metrics.phase('write'):
+            session.begin()
+            if since is not None:
+                rows = filterSince(rows, since)
+            written = upsertRows(session, OpLog, rows, config.get('batchSize', DEFAULT_BATCH_SIZE))
+            if now is not None and len(stats['failed']) == 0:
+                saveWatermarks(session, 'op', [OP_LOG_WATERMARK], now)
+            session.commit()
+    if len(stats['failed']) > 0:
+        logging.error(f'Failed to fetch op log shards {stats["failed"]}, watermark not advanced')
+    else:
+        deadLetters.resolved('op', OP_LOG_WATERMARK, date1, date2)
+    deadLetters.flush()
+    logging.info(f'Finished fetching op logs, {len(rows)} records from {stats["shards"]} shards, '
+                 f'{stats["split"]} split, {len(stats["truncated"])} possibly truncated')
+    return written
+
+def workerLogs(client: ExMailLogApi, config: dict, logType: str, syncRound: str, workerId: str = None) -> dict:
+    '''
+    作为多进程同步中的一个进程增量同步登录或邮件日志
+    同一轮次（syncRound）的各进程通过 sync_lease 表划分邮箱
+    邮箱在数据提交后即标记为 done，水位线仍分批推进；进程在推进前退出时下次同步从旧水位线起重新获取，重复的行按摘要去重
+    '''
+    db = getDB(config['db'])
+    deadLetters = DeadLetters(db, config.get('batchSize', DEFAULT_BATCH_SIZE))
+    if logType == 'login':
+        model, fetch = LoginLog, lambda m, d1, d2: singleLoginLogs(m, d1, d2, client, deadLetters)
+    elif logType == 'mail':
+        model, fetch = MailLog, lambda m, d1, d2: singleMailLogs(m, d1, d2, client, deadLetters)
+    else:
+        raise ValueError(f'Unknown log type {logType}')
+
+    worker = LeaseWorker(db, syncRound, workerId,
+                         config.get('leaseSeconds', DEFAULT_LEASE_SECONDS),
+                         config.get('claimSize', config['parallel'] * 2))
+    with metrics.phase('seed'):
+        worker.seed(syncMailboxes(db, logType, config), config.get('batchSize', DEFAULT_BATCH_SIZE))
+    logging.info(f'Worker {worker.workerId} joined round {syncRound}')
+    try:
+        with worker:
+            stats = mailboxLogs(db, config, model, logType, fetch, mailboxes=worker.tasks(),
+                                onCommitted=worker.done, onFailed=worker.failed, deadLetters=deadLetters,
+                                onRows=getDetectorHook(db, config) if model is LoginLog else None)
+    finally:
+        deadLetters.flush()
+    logging.info(f'Worker {worker.workerId} finished round {syncRound} after {stats["tasks"]} mailboxes')
+    return stats
+
+
+def singleOpLogs(date1: datetime.date, date2: datetime.date, client: ExMailLogApi):
+    '''获取一段时间内的操作日志，失败时返回 None'''
+    logging.info(f'Fetching op log from {date1.isoformat()} to {date2.isoformat()}')
+    try:
+        return [opLogRow(log) for log in client.getOpLog(date1, date2)]
+    except Exception as ex:
+        logging.error(f'Error fetching op log from {date1.isoformat()} to {date2.isoformat()}, reason: {repr(ex)}')
+
+
+def retryFailedFetches(client: ExMailLogApi, config: dict, logType: str = None, maxAttempts: int = None) -> dict:
+    '''
+    只重新获取失败队列中的单元：登录与邮件日志经流水线并发获取，操作日志按分片并发获取
+    数据提交后从队列中删除，再次失败时累加失败次数；maxAttempts 跳过失败次数达到上限的单元
+    '''
+    db = getDB(config['db'])
+    deadLetters = DeadLetters(db, config.get('batchSize', DEFAULT_BATCH_SIZE))
+    units = loadDeadLetters(db, logType, maxAttempts)
+    fetchers = {
+        'login': (LoginLog, lambda u: singleLoginLogs(u[2], u[3], u[4], client, deadLetters)),
+        'mail': (MailLog, lambda u: singleMailLogs(u[2], u[3], u[4], client, deadLetters))
+    }
+    result = {}
+    try:
+        for kind, (model, fetch) in fetchers.items():
+            tasks = [u for u in units if u[1] == kind]
+            if len(tasks) > 0:
+                logging.info(f'Retrying {len(tasks)} failed {kind} log fetches')
+                stats = runPipeline(db, model, tasks, fetch, config, lambda u: deadLetters.resolved(u[1], u[2], u[3], u[4]))
+                result[kind] = {k: stats[k] for k in ('tasks', 'failed', 'fetched', 'written')}
+    finally:
+        deadLetters.flush()
+    tasks = [u for u in units if u[1] == 'op']
+    if len(tasks) > 0:
+        logging.info(f'Retrying {len(tasks)} failed op log fetches')
+        result['op'] = {'tasks': len(tasks), 'written': sum(opLogs(client, config, u[3], u[4]) for u in tasks)}
+    result['remaining'] = len(loadDeadLetters(db, logType))
+    logging.info(f'Finished retrying failed fetches: {result}')
+    return result
+
+
+def backfillLogs(client: ExMailLogApi, config: dict, logType: str, start: datetime.date, end: datetime.date,
+                 shardDays: int = 1, job: str = None) -> dict:
+    '''按 邮箱 × 日期区间 分片回填历史日志，可断点续传'''
+    db = getDB(config['db'])
+    batchSize = config.get('batchSize', DEFAULT_BATCH_SIZE)
+    if job is None:
+        job = f'{logType}:{start.isoformat()}:{end.isoformat()}:{shardDays}'
+    if logType == 'login':
+        model, addresses = LoginLog, streamMailboxes(db, batchSize)
+        fetch = lambda m, d1, d2: singleLoginLogs(m, d1, d2, client)
+    elif logType == 'mail':
+        model, addresses = MailLog, streamMailboxes(db, batchSize)
+        fetch = lambda m, d1, d2: singleMailLogs(m, d1, d2, client)
+    elif logType == 'op':
+        model, addresses = OpLog, [OP_LOG_WATERMARK]
+        fetch = lambda m, d1, d2: singleOpLogs(d1, d2, client)
+    else:
+        raise ValueError(f'Unknown log type {logType}')
+
+    with metrics.phase('plan'):
+        planShards(db, job, logType, addresses, start, end, shardDays, batchSize)
+    logging.info(f'Start backfill job {job}')
+    with metrics.phase('run'):
+        stats = runBackfill(db, config, job, model, fetch)
+    if config.get('ingest') in ('bulk', 'archive') and logType in ROLLUP_MODELS:
+        # 批量导入与归档不经过 upsertRows，回填结束后重新计算涉及日期的汇总
+        with metrics.phase('rollup'):
+            repairRollups(config, logType, start, end)
+    return stats
+
+def repairRollups(config: dict, logType: str, start: datetime.date, end: datetime.date) -> dict:
+    '''
+    逐天重新计算 [start, end] 的汇总
+    配置了 archiveDir 时同时计入当天已移入归档的记录，数据表中的日志清理后汇总仍然完整
+    '''
+    db = getDB(config['db'])
+    model = ROLLUP_MODELS[logType]
+    reader = ArchiveReader(config['archiveDir'], logType) if config.get('archiveDir') else None
+    result = {}
+    d = start
+    while d <= end:
+        extraRows = None
+        if reader is not None:
+            dayStart = datetime.datetime.combine(d, datetime.time())
+            extraRows = (dict(row, content_hash=logHash(model, row))
+                         for row in reader.scan(dayStart, dayStart + datetime.timedelta(days=1)))
+        result[d.isoformat()] = repairRollup(db, model, d, extraRows, config.get('batchSize', DEFAULT_BATCH_SIZE))
+        d += datetime.timedelta(days=1)
+    return result
+
+
+# 守护模式下可调度的命令及其默认间隔（秒）
+DEFAULT_JOBS = {'syncUser': 86400, 'syncLoginLog': 900, 'syncMailLog': 900, 'syncOpLog': 3600}
 
-def getDB(config: dict):
-    '''连接数据库'''
-    url = f'mysql+pymysql://{config["user"]}:{config["password"]}@{config["host"]}:{config["port"]}/{config["database"]}'
-    return sqlalchemy.create_engine(url)
 
 class CLI:
     '''腾讯企业邮箱API同步工具'''
@@ -185,39 +563,232 @@ class CLI:
     def __init__(self) -> None:
         with open('config.json') as fp:
             self._config = json.load(fp)
+        # 连接池大小跟随写入线程数，另外留给水位线、租约心跳与主线程
+        self._config['db'].setdefault('poolSize', self._config.get('writers', DEFAULT_WRITERS) + 3)
         self._logClient = ExMailLogApi()
         self._contactClient = ExMailContactApi()
+        self._exportMetrics()
+
+    def _exportMetrics(self) -> None:
+        '''按配置导出 Prometheus 指标：metricsFile 在退出时写入文件，metricsPort 在运行期间提供 HTTP 接口'''
+        if self._config.get('metricsPort'):
+            metrics.startMetricsServer(self._config['metricsPort'], self._config.get('metricsHost', '127.0.0.1'))
+        if self._config.get('metricsFile'):
+            atexit.register(metrics.writeMetrics, self._config['metricsFile'])
+
+    def serve(self) -> None:
+        '''
+        常驻运行，按配置 jobs 中的间隔（秒）重复运行同步命令，如 {"syncUser": 86400, "syncLoginLog": 900}
+        jobJitter 为间隔的随机抖动比例；同一命令不会重叠运行
+        所有任务共用连接池、HTTP 会话与令牌缓存，收到 SIGTERM 或 Ctrl+C 后等待正在运行的任务结束再退出
+        '''
+        jobs = self._config.get('jobs', DEFAULT_JOBS)
+        # 不同命令可能同时运行，各自需要一组写入连接
+        self._config['db']['poolSize'] = len(jobs) * (self._config.get('writers', DEFAULT_WRITERS) + 3)
+        scheduler = Scheduler()
+        for name, interval in jobs.items():
+            if name not in DEFAULT_JOBS:
+                raise ValueError(f'Unknown job {name}, expected one of {list(DEFAULT_JOBS)}')
+            scheduler.add(name, self._job(getattr(self, name)), interval, self._config.get('jobJitter', DEFAULT_JITTER))
+        signal.signal(signal.SIGTERM, lambda *args: scheduler.interrupt())
+        scheduler.start()
+        try:
+            scheduler.wait()
+        except KeyboardInterrupt:
+            logging.info('Interrupted, waiting for running jobs to finish')
+        scheduler.stop()
+
+    def _job(self, func):
+        '''守护模式下每次运行后更新指标文件'''
+        def run():
+            try:
+                func()
+            finally:
+                if self._config.get('metricsFile'):
+                    metrics.writeMetrics(self._config['metricsFile'])
+        return run
 
     def syncDepartment(self) -> None:
         '''同步所有部门信息'''
-        syncDepartmentList(self._contactClient)
+        with metrics.command('syncDepartment'):
+            syncDepartmentList(self._contactClient)
     
-    def syncLoginLog(self) -> None:
-        '''同步最近两天的登录日志'''
-        date1 = datetime.date.today() - datetime.timedelta(days=2)
-        date2 = datetime.date.today()
-        loginLogs(self._logClient, self._config, date1, date2)
+    def _window(self, full: bool) -> tuple:
+        '''full 时返回最近两天，否则返回 (None, None) 表示按水位线增量同步'''
+        if not full:
+            return None, None
+        return datetime.date.today() - datetime.timedelta(days=2), datetime.date.today()
+
+    def syncLoginLog(self, mode: str = 'thread', full: bool = False) -> None:
+        '''增量同步登录日志，mode 为 thread 或 async，full 时同步最近两天'''
+        with metrics.command('syncLoginLog'):
+            date1, date2 = self._window(full)
+            if mode == 'async':
+                asyncLogs(self._config, LoginLog, 'login', asyncSingleLoginLogs, date1, date2)
+            else:
+                loginLogs(self._logClient, self._config, date1, date2)
     
-    def syncMailLog(self) -> None:
-        '''同步最近两天的邮件日志'''
-        date1 = datetime.date.today() - datetime.timedelta(days=2)
-        date2 = datetime.date.today()
-        mailLogs(self._logClient, self._config, date1, date2)
+    def syncMailLog(self, mode: str = 'thread', full: bool = False) -> None:
+        '''增量同步邮件日志，mode 为 thread 或 async，full 时同步最近两天'''
+        with metrics.command('syncMailLog'):
+            date1, date2 = self._window(full)
+            if mode == 'async':
+                asyncLogs(self._config, MailLog, 'mail', asyncSingleMailLogs, date1, date2)
+            else:
+                mailLogs(self._logClient, self._config, date1, date2)
     
+    def backfill(self, start: str, end: str, logType: str = 'mail', shardDays: int = 1, job: str = None,
+                 apiRate: float = None, dbRate: float = None, bulk: bool = False, archive: bool = False) -> None:
+        '''
+        回填 start 至 end（YYYY-MM-DD）的历史日志，logType 为 login、mail 或 op
+        中断后以相同参数重新运行即可继续；apiRate 限制每秒请求数，dbRate 限制每秒写入行数
+        bulk 时经暂存文件批量导入（MySQL 需在 db 配置中设置 localInfile）
+        archive 时直接写入配置中 archiveDir 下的归档，不写数据库
+        '''
+        with metrics.command('backfill'):
+            config = dict(self._config)
+            if bulk:
+                config['ingest'] = 'bulk'
+            if archive:
+                config['ingest'] = 'archive'
+            if apiRate is not None:
+                config['fetchRate'] = apiRate
+            if dbRate is not None:
+                config['writeRate'] = dbRate
+            backfillLogs(self._logClient, config, logType,
+                         datetime.date.fromisoformat(str(start)), datetime.date.fromisoformat(str(end)),
+                         shardDays, job)
+
+    def archive(self, logType: str = 'mail', before: str = None, days: int = 180) -> int:
+        '''将 before（YYYY-MM-DD，默认为 days 天前）之前的日志从数据表移入 archiveDir 下的归档'''
+        with metrics.command('archive'):
+            if before is None:
+                before = datetime.date.today() - datetime.timedelta(days=days)
+            before = datetime.datetime.combine(datetime.date.fromisoformat(str(before)), datetime.time())
+            return moveToArchive(getDB(self._config['db']), self._config['archiveDir'], logType, before,
+                                 self._config.get('batchSize', DEFAULT_BATCH_SIZE))
+
+    def searchArchive(self, logType: str = 'mail', start: str = None, end: str = None, address: str = None, limit: int = 100) -> None:
+        '''在归档中按时间范围 [start, end)（YYYY-MM-DD）与邮箱检索，逐行输出 JSON'''
+        reader = ArchiveReader(self._config['archiveDir'], logType)
+        start = datetime.datetime.fromisoformat(str(start)) if start is not None else None
+        end = datetime.datetime.fromisoformat(str(end)) if end is not None else None
+        for i, row in enumerate(reader.scan(start, end, address)):
+            if limit is not None and i >= limit:
+                break
+            print(json.dumps(row, default=lambda x: x.name if isinstance(x, enum.Enum) else str(x), ensure_ascii=False))
+
+    def _analytics(self):
+        from analytics import Analytics, DEFAULT_CACHE_DIR
+        return Analytics(getDB(self._config['db']), self._config.get('analyticsCacheDir', DEFAULT_CACHE_DIR),
+                         self._config.get('domains'), self._config.get('batchSize', DEFAULT_BATCH_SIZE))
+
+    def _dates(self, start: str, end: str) -> tuple:
+        '''默认为最近 7 天'''
+        end = datetime.date.fromisoformat(str(end)) if end is not None else datetime.date.today()
+        start = datetime.date.fromisoformat(str(start)) if start is not None else end - datetime.timedelta(days=6)
+        return start, end
+
+    def loginsPerIp(self, start: str = None, end: str = None, top: int = 20) -> list:
+        '''登录次数最多的 IP 及登录用户数，日期为 YYYY-MM-DD，默认最近 7 天'''
+        with metrics.command('loginsPerIp'):
+            return self._analytics().loginsPerIp(*self._dates(start, end), top)
+
+    def newIps(self, start: str = None, end: str = None, lookback: int = 30) -> list:
+        '''用户首次使用的登录 IP，与之前 lookback 天比较'''
+        with metrics.command('newIps'):
+            return self._analytics().newIps(*self._dates(start, end), lookback)
+
+    def topExternalSenders(self, start: str = None, end: str = None, top: int = 20) -> list:
+        '''来信最多的外部发件人，内部域名取配置 domains 或邮箱表'''
+        with metrics.command('topExternalSenders'):
+            return self._analytics().topExternalSenders(*self._dates(start, end), top)
+
+    def bounceRates(self, start: str = None, end: str = None, minSent: int = 20, top: int = 20) -> dict:
+        '''每日与各发件人的退信率'''
+        with metrics.command('bounceRates'):
+            return self._analytics().bounceRates(*self._dates(start, end), minSent, top)
+
+    def worker(self, logType: str = 'mail', syncRound: str = None, workerId: str = None) -> None:
+        '''
+        以多进程方式增量同步登录或邮件日志，可在多台主机上同时运行
+        同一轮次的进程共同完成全部邮箱，syncRound 默认为 日志类型:当前小时
+        '''
+        with metrics.command('worker'):
+            if syncRound is None:
+                syncRound = f'{logType}:{datetime.datetime.now():%Y-%m-%dT%H}'
+            workerLogs(self._logClient, self._config, logType, syncRound, workerId)
+
+    def repairRollup(self, logType: str = 'mail', day: str = None, end: str = None) -> dict:
+        '''从日志（及归档）重新计算 day 这一天（YYYY-MM-DD，默认昨天）的汇总，给出 end 时修复 [day, end] 的每一天'''
+        with metrics.command('repairRollup'):
+            day = datetime.date.fromisoformat(str(day)) if day is not None else datetime.date.today() - datetime.timedelta(days=1)
+            end = datetime.date.fromisoformat(str(end)) if end is not None else day
+            return repairRollups(self._config, logType, day, end)
+
+    def activity(self, logType: str = 'mail', address: str = None, start: str = None, end: str = None, grain: str = 'day') -> list:
+        '''从汇总表读取 [start, end]（YYYY-MM-DD，默认最近 7 天）内每个邮箱的邮件或登录次数，grain 为 day 或 hour'''
+        with metrics.command('activity'):
+            start, end = self._dates(start, end)
+            rows = readRollup(getDB(self._config['db']), ROLLUP_MODELS[logType], grain,
+                              datetime.datetime.combine(start, datetime.time()),
+                              datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time()), address)
+            return [{k: v.name if isinstance(v, enum.Enum) else v.isoformat() if isinstance(v, datetime.datetime) else v
+                     for k, v in row.items()} for row in rows]
+
+    def retryFailed(self, logType: str = None, maxAttempts: int = None) -> dict:
+        '''重新获取失败队列（failed_fetch 表）中的单元，logType 为 login、mail 或 op，默认全部'''
+        with metrics.command('retryFailed'):
+            return retryFailedFetches(self._logClient, self._config, logType, maxAttempts)
+
+    def queryMail(self, sender: str = None, receiver: str = None, address: str = None, start: str = None, end: str = None,
+                  type: str = None, status: str = None, format: str = 'ndjson', output: str = None, pageSize: int = DEFAULT_PAGE_SIZE,
+                  limit: int = None, after: str = None, serverSide: bool = False, explain: bool = False) -> int:
+        '''
+        按发件人、收件人（address 为二者之一）与时间范围 [start, end) 查询邮件日志，以 NDJSON 或 CSV 流式输出
+        按 (time, id) keyset 分页，after 为上次输出的续传位置 "时间,id"；serverSide 使用服务端游标，explain 只显示执行计划
+        '''
+        with metrics.command('queryMail'):
+            count = runQuery(getDB(self._config['db']), 'mail', start, end, after, format, output, pageSize, limit, serverSide, explain,
+                             sender=sender, receiver=receiver, address=address, type=type, status=status)
+            return count if output is not None else None
+
+    def queryLogin(self, address: str = None, ip: str = None, start: str = None, end: str = None, type: str = None,
+                   format: str = 'ndjson', output: str = None, pageSize: int = DEFAULT_PAGE_SIZE, limit: int = None,
+                   after: str = None, serverSide: bool = False, explain: bool = False) -> int:
+        '''按邮箱、IP 与时间范围 [start, end) 查询登录日志，参数同 queryMail'''
+        with metrics.command('queryLogin'):
+            count = runQuery(getDB(self._config['db']), 'login', start, end, after, format, output, pageSize, limit, serverSide, explain,
+                             address=address, ip=ip, type=type)
+            return count if output is not None else None
+
     def initDB(self) -> None:
         '''初始化数据表'''
         db = getDB(self._config['db'])
         create_all(db)
+        migrateMailBox(db)
+        migrateIndexes(db, (LoginLog, MailLog))
     
-    def syncUser(self) -> None:
-        '''同步用户列表'''
-        syncUserList(self._contactClient, self._config)
-
-    def syncOpLog(self) -> None:
-        '''同步最近两天的操作日志'''
-        date1 = datetime.date.today() - datetime.timedelta(days=2)
-        date2 = datetime.date.today()
-        opLogs(self._logClient, self._config, date1, date2)
+    def migrateDedup(self, rehash: bool = False) -> dict:
+        '''为旧的日志表添加 content_hash 去重列、删除重复行并建立唯一索引，rehash 时重新计算全部摘要'''
+        with metrics.command('migrateDedup'):
+            db = getDB(self._config['db'])
+            create_all(db)
+            migrateMailBox(db)
+            migrateIndexes(db, (LoginLog, MailLog))
+            return {model.__tablename__: migrateLogHashes(db, model, self._config.get('batchSize', DEFAULT_BATCH_SIZE), rehash)
+                    for model in (LoginLog, MailLog, OpLog)}
+
+    def syncUser(self) -> dict:
+        '''同步用户列表，返回新增、更新、删除与未变化的用户数'''
+        with metrics.command('syncUser'):
+            return syncUserList(self._contactClient, self._config)
+
+    def syncOpLog(self, full: bool = False) -> None:
+        '''增量同步操作日志，full 时同步最近两天'''
+        with metrics.command('syncOpLog'):
+            date1, date2 = self._window(full)
+            opLogs(self._logClient, self._config, date1, date2)
 
 
 if __name__ == '__main__':
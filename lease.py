@@ -0,0 +1,178 @@
+import os
+import uuid
+import socket
+import logging
+import datetime
+import threading
+import sqlalchemy
+from sqlalchemy.dialects import postgresql, sqlite
+from database import *
+
+LEASE_PENDING = 'pending'
+LEASE_DONE = 'done'
+LEASE_FAILED = 'failed'
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+def defaultWorkerId() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def seedStatement(dialect: str = 'mysql'):
+    '''插入租约并忽略本轮已存在的邮箱：MySQL 使用 INSERT IGNORE，SQLite 与 PostgreSQL 使用 ON CONFLICT DO NOTHING'''
+    if dialect == 'mysql':
+        return sqlalchemy.insert(SyncLease).prefix_with('IGNORE')
+    if dialect not in ('sqlite', 'postgresql'):
+        raise ValueError(f'Unsupported database dialect {dialect}')
+    insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+    return insert(SyncLease).on_conflict_do_nothing(index_elements=['sync_round', 'address'])
+
+
+class LeaseWorker:
+    '''
+    通过数据库租约在多个进程（可在不同主机上）之间划分一轮同步的邮箱
+    每个进程分批认领待处理且无人持有或租约已过期的邮箱，后台心跳续约，
+    完成后标记为 done；进程退出或卡死后其租约过期，由其他进程接手
+    各进程需保持时钟同步
+    '''
+
+    def __init__(self, db: sqlalchemy.engine.Engine, syncRound: str, workerId: str = None,
+                 leaseSeconds: int = DEFAULT_LEASE_SECONDS, claimSize: int = 16,
+                 maxAttempts: int = DEFAULT_MAX_ATTEMPTS) -> None:
+        self._db = db
+        self.syncRound = syncRound
+        self.workerId = workerId or defaultWorkerId()
+        self._lease = datetime.timedelta(seconds=leaseSeconds)
+        self._claimSize = claimSize
+        self._maxAttempts = maxAttempts
+        self._stop = threading.Event()
+        # 本进程有邮箱完成或失败、或收到停止信号时唤醒等待中的 tasks
+        self._wake = threading.Event()
+        self._heartbeat = None
+
+    def seed(self, addresses, batchSize: int = DEFAULT_BATCH_SIZE) -> None:
+        '''写入本轮的邮箱列表，已存在的邮箱忽略，因此每个进程都可以调用'''
+        now = datetime.datetime.now()
+        stmt = seedStatement(self._db.dialect.name)
+        batch = []
+        with sqlalchemy.orm.Session(self._db) as session:
+            session.begin()
+            for priority, address in enumerate(addresses):
+                batch.append({
+                    'sync_round': self.syncRound,
+                    'address': address,
+                    'priority': priority,
+                    'state': LEASE_PENDING,
+                    'attempts': 0,
+                    'updated': now
+                })
+                if len(batch) >= batchSize:
+                    session.execute(stmt, batch)
+                    batch = []
+            if len(batch) > 0:
+                session.execute(stmt, batch)
+            session.commit()
+
+    def _claimable(self, now: datetime.datetime):
+        return sqlalchemy.and_(
+            SyncLease.sync_round == self.syncRound,
+            SyncLease.state == LEASE_PENDING,
+            sqlalchemy.or_(SyncLease.owner == None, SyncLease.lease_until < now))
+
+    def claim(self) -> list:
+        '''认领一批邮箱，条件更新保证同一邮箱同一时刻只属于一个进程'''
+        now = datetime.datetime.now()
+        token = uuid.uuid4().hex
+        with sqlalchemy.orm.Session(self._db) as session:
+            session.begin()
+            ids = session.scalars(
+                sqlalchemy.select(SyncLease.id).where(self._claimable(now))
+                .order_by(SyncLease.priority).limit(self._claimSize)
+                .with_for_update(skip_locked=True)).all()
+            if len(ids) == 0:
+                session.commit()
+                return []
+            session.execute(
+                sqlalchemy.update(SyncLease)
+                .where(SyncLease.id.in_(ids), self._claimable(now))
+                .values(owner=self.workerId, claim_token=token, lease_until=now + self._lease,
+                        attempts=SyncLease.attempts + 1, updated=now))
+            session.commit()
+            stmt = sqlalchemy.select(SyncLease.address).where(SyncLease.claim_token == token).order_by(SyncLease.priority)
+            return list(session.scalars(stmt))
+
+    def remaining(self) -> int:
+        '''本轮尚未完成的邮箱数（含其他进程持有的）'''
+        stmt = sqlalchemy.select(sqlalchemy.func.count()).select_from(SyncLease) \
+            .where(SyncLease.sync_round == self.syncRound, SyncLease.state == LEASE_PENDING)
+        with sqlalchemy.orm.Session(self._db) as session:
+            return session.execute(stmt).scalar()
+
+    def tasks(self):
+        '''持续认领并逐个返回邮箱，直到本轮全部完成'''
+        while True:
+            self._wake.clear()
+            claimed = self.claim()
+            if len(claimed) > 0:
+                logging.info(f'Worker {self.workerId} claimed {len(claimed)} mailboxes in round {self.syncRound}')
+                yield from claimed
+                continue
+            if self.remaining() == 0:
+                return
+            # 其余邮箱由本进程或其他进程持有：本进程的邮箱完成或失败时立即重新检查，否则定期检查其他进程的租约是否过期
+            self._wake.wait(self._lease.total_seconds() / 4)
+            if self._stop.is_set():
+                return
+
+    def _finish(self, address: str, values: dict) -> None:
+        values['updated'] = datetime.datetime.now()
+        with sqlalchemy.orm.Session(self._db) as session:
+            session.begin()
+            session.execute(
+                sqlalchemy.update(SyncLease)
+                .where(SyncLease.sync_round == self.syncRound, SyncLease.address == address, SyncLease.owner == self.workerId)
+                .values(**values))
+            session.commit()
+        self._wake.set()
+
+    def done(self, address: str) -> None:
+        self._finish(address, {'state': LEASE_DONE})
+
+    def failed(self, address: str) -> None:
+        '''释放租约以便重试，超过最大尝试次数后标记为 failed'''
+        self._finish(address, {
+            'owner': None,
+            'lease_until': None,
+            'state': sqlalchemy.case((SyncLease.attempts >= self._maxAttempts, LEASE_FAILED), else_=LEASE_PENDING)
+        })
+
+    def renew(self) -> int:
+        now = datetime.datetime.now()
+        with sqlalchemy.orm.Session(self._db) as session:
+            session.begin()
+            result = session.execute(
+                sqlalchemy.update(SyncLease)
+                .where(SyncLease.sync_round == self.syncRound, SyncLease.owner == self.workerId, SyncLease.state == LEASE_PENDING)
+                .values(lease_until=now + self._lease))
+            session.commit()
+            return result.rowcount
+
+    def _beat(self) -> None:
+        while not self._stop.wait(self._lease.total_seconds() / 3):
+            try:
+                self.renew()
+            except Exception as ex:
+                logging.error(f'Worker {self.workerId} failed to renew leases, reason: {repr(ex)}')
+
+    def __enter__(self):
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop.set()
+        self._wake.set()
+        self._heartbeat.join()
@@ -0,0 +1,186 @@
+import os
+import time
+import bisect
+import tempfile
+import threading
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labelText(names: tuple, values: tuple, extra: str = None) -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if len(parts) > 0 else ''
+
+
+class _Metric:
+    kind: str = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, '') for n in self.labels)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_labelText(self.labels, key)} {value}')
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # [各桶计数, 总和, 总数]
+            data = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            if i < len(self.buckets):
+                data[0][i] += 1
+            data[1] += value
+            data[2] += 1
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                le = 'le="%s"' % bound
+                lines.append(f'{self.name}_bucket{_labelText(self.labels, key, le)} {cumulative}')
+            le = 'le="+Inf"'
+            lines.append(f'{self.name}_bucket{_labelText(self.labels, key, le)} {count}')
+            lines.append(f'{self.name}_sum{_labelText(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_labelText(self.labels, key)} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+API_LATENCY = REGISTRY.register(Histogram('exmail_api_request_seconds', 'Latency of exmail API requests', ('endpoint',)))
+API_ERRORS = REGISTRY.register(Counter('exmail_api_errors_total', 'Failed exmail API requests by errcode', ('endpoint', 'errcode')))
+API_RETRIES = REGISTRY.register(Counter('exmail_api_retries_total', 'Retried exmail API requests by reason', ('endpoint', 'reason')))
+ROWS_FETCHED = REGISTRY.register(Counter('exmail_rows_fetched_total', 'Rows fetched from the API', ('table',)))
+ROWS_WRITTEN = REGISTRY.register(Counter('exmail_rows_written_total', 'Rows written to the database', ('table',)))
+QUEUE_DEPTH = REGISTRY.register(Gauge('exmail_queue_depth', 'Row batches waiting for a writer', ('table',)))
+DB_WRITE_LATENCY = REGISTRY.register(Histogram('exmail_db_write_seconds', 'Latency of one batched database write', ('table',)))
+PHASE_SECONDS = REGISTRY.register(Gauge('exmail_phase_seconds', 'Duration of the last run of a command phase', ('command', 'phase')))
+PHASE_SECONDS_TOTAL = REGISTRY.register(Counter('exmail_phase_seconds_total', 'Total time spent in a command phase', ('command', 'phase')))
+OP_LOG_TRUNCATED = REGISTRY.register(Counter('exmail_op_log_truncated_total', 'Op log shards that may be truncated and cannot be split further', ('type',)))
+
+
+# 当前线程正在运行的命令，守护模式下各任务在各自线程中运行
+_current = threading.local()
+
+
+def _command() -> str:
+    return getattr(_current, 'command', 'none')
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    '''记录当前命令中一个阶段的耗时'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        PHASE_SECONDS.set(round(elapsed, 6), command=_command(), phase=name)
+        PHASE_SECONDS_TOTAL.inc(elapsed, command=_command(), phase=name)
+
+
+@contextlib.contextmanager
+def command(name: str):
+    '''标记正在运行的命令，其中的 phase() 都归属于该命令，整体耗时记为 total 阶段'''
+    previous = _command()
+    _current.command = name
+    try:
+        with phase('total'):
+            yield
+    finally:
+        _current.command = previous
+
+
+def writeMetrics(filename: str) -> None:
+    '''以 Prometheus 文本格式原子写入文件，可供 node_exporter 的 textfile 收集器读取'''
+    dirName = os.path.dirname(os.path.abspath(filename))
+    fd, tmpName = tempfile.mkstemp(dir=dirName, prefix='.tmp-', suffix='.prom')
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(REGISTRY.render())
+    os.replace(tmpName, filename)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        payload = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def startMetricsServer(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    '''在后台线程提供 /metrics'''
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
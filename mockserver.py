@@ -0,0 +1,247 @@
+import json
+import time
+import zlib
+import random
+import datetime
+import threading
+import urllib.parse
+import fire
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from common import *
+
+
+class MockExMail:
+    '''
+    企业邮箱 API 的本地替身，生成确定性的部门、用户与日志数据
+    latency 为平均延迟（秒），jitter 为延迟的随机浮动比例；
+    errorRate 为随机返回 -1 或 HTTP 503 的比例；rateLimit 为每秒允许的请求数，超出时返回 45009
+    opLogLimit 为操作日志单次返回的最大条数（0 为不限），超出部分被截断
+    '''
+
+    def __init__(self, users: int = 1000, departments: int = 20, loginsPerDay: int = 5, mailsPerDay: int = 20,
+                 opsPerDay: int = 50, heavyRatio: float = 0.02, heavyFactor: int = 50,
+                 latency: float = 0.02, jitter: float = 0.5, errorRate: float = 0, rateLimit: float = 0,
+                 opLogLimit: int = 0, domain: str = 'example.com', seed: int = 0) -> None:
+        self.users = users
+        self.departments = departments
+        self.loginsPerDay = loginsPerDay
+        self.mailsPerDay = mailsPerDay
+        self.opsPerDay = opsPerDay
+        self.heavyRatio = heavyRatio
+        self.heavyFactor = heavyFactor
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.rateLimit = rateLimit
+        self.opLogLimit = opLogLimit
+        self.domain = domain
+        self.seed = seed
+        self._window = (0, 0)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'throttled': 0}
+
+    def _rng(self, *key) -> random.Random:
+        return random.Random(zlib.crc32(repr((self.seed,) + key).encode()))
+
+    def userId(self, i: int) -> str:
+        return f'user{i:06d}@{self.domain}'
+
+    def _userIndex(self, userId: str) -> int:
+        try:
+            return int(userId[4:10])
+        except ValueError:
+            return -1
+
+    def _isHeavy(self, i: int) -> bool:
+        return self._rng('heavy', i).random() < self.heavyRatio
+
+    def _days(self, body: dict):
+        d = datetime.date.fromisoformat(body['begin_date'])
+        end = datetime.date.fromisoformat(body['end_date'])
+        while d <= end:
+            yield d
+            d += datetime.timedelta(days=1)
+
+    def _times(self, rng: random.Random, day: datetime.date, count: int) -> list:
+        start = int(time.mktime(day.timetuple()))
+        return sorted(start + rng.randrange(86400) for _ in range(count))
+
+    def _count(self, rng: random.Random, i: int, perDay: int) -> int:
+        n = rng.randint(0, perDay * 2)
+        return n * self.heavyFactor if self._isHeavy(i) else n
+
+    # 部门与用户：部门 2..departments+1 挂在根部门下，用户按编号分配到部门
+
+    def departmentList(self, deptId: int) -> list:
+        if deptId != 1:
+            return []
+        return [{'id': d, 'name': f'Dept {d}', 'parentid': 1, 'order': d} for d in range(2, self.departments + 2)]
+
+    def user(self, i: int) -> dict:
+        rng = self._rng('user', i)
+        return {
+            'userid': self.userId(i),
+            'name': f'User {i}',
+            'department': [2 + i % self.departments],
+            'slaves': [f'alias{i}@{self.domain}'] if rng.random() < 0.3 else [],
+            'cpwd_login': rng.randint(0, 1),
+            'enable': 0 if rng.random() < 0.05 else 1
+        }
+
+    def userList(self, deptId: int) -> list:
+        return [self.user(i) for i in range(self.users) if deptId == 1 or 2 + i % self.departments == deptId]
+
+    def loginLog(self, body: dict) -> list:
+        i = self._userIndex(body['userid'])
+        result = []
+        for day in self._days(body):
+            rng = self._rng('login', i, day.isoformat())
+            for t in self._times(rng, day, self._count(rng, i, self.loginsPerDay)):
+                result.append({'time': t, 'ip': f'10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}', 'type': rng.randint(1, 5)})
+        return result
+
+    def mailLog(self, body: dict) -> list:
+        i = self._userIndex(body['userid'])
+        result = []
+        for day in self._days(body):
+            rng = self._rng('mail', i, day.isoformat())
+            for t in self._times(rng, day, self._count(rng, i, self.mailsPerDay)):
+                sent = rng.random() < 0.4
+                other = f'peer{rng.randrange(100000)}@remote.example.org'
+                result.append({
+                    'time': t,
+                    'sender': body['userid'] if sent else other,
+                    'receiver': other if sent else body['userid'],
+                    'subject': f'Subject {rng.randrange(1000000)}',
+                    'mailtype': ExMailType.SEND.value if sent else ExMailType.RECEIVE.value,
+                    'status': ExMailStatus.SEND_SUCCESS.value if sent else rng.choice([13, 13, 13, 12, 11])
+                })
+        return result
+
+    def opCategory(self, opType: int) -> int:
+        '''操作类型所属的查询类别，按类型值均匀分配到各类别'''
+        return 1 + opType % (len(ExMailOpQueryType) - 1)
+
+    def opLog(self, body: dict) -> list:
+        result = []
+        opTypes = [t.value for t in ExMailOpType]
+        queryType = body.get('type', ExMailOpQueryType.ALL.value)
+        for day in self._days(body):
+            rng = self._rng('op', day.isoformat())
+            for t in self._times(rng, day, rng.randint(0, self.opsPerDay * 2)):
+                log = {
+                    'time': t,
+                    'operator': f'admin@{self.domain}',
+                    'operand': self.userId(rng.randrange(max(self.users, 1))),
+                    'type': rng.choice(opTypes)
+                }
+                if queryType == ExMailOpQueryType.ALL.value or self.opCategory(log['type']) == queryType:
+                    result.append(log)
+        if self.opLogLimit > 0:
+            result = result[:self.opLogLimit]
+        return result
+
+    def _throttled(self) -> bool:
+        if self.rateLimit <= 0:
+            return False
+        with self._lock:
+            second = int(time.time())
+            windowSecond, count = self._window
+            if windowSecond != second:
+                windowSecond, count = second, 0
+            count += 1
+            self._window = (windowSecond, count)
+            return count > self.rateLimit
+
+    def handle(self, method: str, path: str, query: dict, body: dict) -> tuple:
+        '''返回 (HTTP 状态码, 响应 JSON)'''
+        with self._lock:
+            self.stats['requests'] += 1
+        if self.latency > 0:
+            time.sleep(max(0, random.uniform(self.latency * (1 - self.jitter), self.latency * (1 + self.jitter))))
+        if path == 'gettoken':
+            return 200, {'errcode': 0, 'errmsg': 'ok', 'access_token': 'mock-token', 'expires_in': 7200}
+        if self._throttled():
+            with self._lock:
+                self.stats['throttled'] += 1
+            return 200, {'errcode': 45009, 'errmsg': 'api freq out of limit'}
+        if self.errorRate > 0 and random.random() < self.errorRate:
+            with self._lock:
+                self.stats['errors'] += 1
+            if random.random() < 0.5:
+                return 503, None
+            return 200, {'errcode': -1, 'errmsg': 'system busy'}
+
+        ok = {'errcode': 0, 'errmsg': 'ok'}
+        if path == 'log/login':
+            return 200, dict(ok, list=self.loginLog(body))
+        if path == 'log/mail':
+            return 200, dict(ok, list=self.mailLog(body))
+        if path == 'log/operation':
+            return 200, dict(ok, list=self.opLog(body))
+        if path == 'department/list':
+            return 200, dict(ok, department=self.departmentList(int(query.get('id', 1))))
+        if path == 'user/list':
+            return 200, dict(ok, userlist=self.userList(int(query.get('department_id', 1))))
+        if path == 'user/simplelist':
+            users = [{'userid': u['userid'], 'name': u['name'], 'department': u['department']} for u in self.userList(int(query.get('department_id', 1)))]
+            return 200, dict(ok, userlist=users)
+        if path == 'user/update':
+            return 200, ok
+        return 404, {'errcode': 404, 'errmsg': f'unknown api {path}'}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    mock: MockExMail = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _dispatch(self, method: str) -> None:
+        url = urllib.parse.urlparse(self.path)
+        path = url.path.split('/cgi-bin/', 1)[-1]
+        query = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length > 0 else {}
+        status, data = self.mock.handle(method, path, query, body)
+        payload = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self) -> None:
+        self._dispatch('GET')
+
+    def do_POST(self) -> None:
+        self._dispatch('POST')
+
+
+def startServer(mock: MockExMail, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    '''在后台线程启动替身服务，port 为 0 时自动分配端口'''
+    handler = type('Handler', (_Handler,), {'mock': mock})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def baseUrl(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}/cgi-bin/'
+
+
+def serve(host: str = '127.0.0.1', port: int = 8080, **options) -> None:
+    '''以前台方式运行替身服务，参数同 MockExMail'''
+    server = startServer(MockExMail(**options), host, port)
+    print(f'Mock exmail API listening on {baseUrl(server)}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    fire.Fire(serve)
@@ -0,0 +1,329 @@
+import time
+import queue
+import asyncio
+import logging
+import threading
+import collections
+import concurrent.futures
+import sqlalchemy
+from database import *
+from ratelimit import TokenBucket
+from bulkload import stagingWorker, DEFAULT_STAGING_ROWS
+from archive import ArchiveWriter, archiveWorker, ARCHIVE_MODELS, DEFAULT_FLUSH_ROWS
+from metrics import ROWS_FETCHED, QUEUE_DEPTH
+
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_WRITERS = 1
+# 队列空闲这么多秒后提交已缓存的行
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+_STOP = object()
+
+
+class _PipelineState:
+    '''
+    流水线共享状态：统计数据与每个任务尚未提交的数据块数
+    任务的全部数据提交后调用 onCommitted(task)，获取或写入失败时调用 onFailed(task)，
+    每批数据提交后以该批行调用 onRows(rows)
+    '''
+
+    def __init__(self, table: str, onCommitted=None, onFailed=None, recent: RecentKeys = None, onRows=None) -> None:
+        self.table = table
+        self.recent = recent
+        self.onRows = onRows
+        self.stats = {'tasks': 0, 'fetched': 0, 'skipped': 0, 'written': 0, 'failed': 0}
+        self.lock = threading.Lock()
+        self._onCommitted = onCommitted
+        self._onFailed = onFailed
+        self._pending = {}
+        self._failed = set()
+        self._started = time.perf_counter()
+        # (完成时刻, 耗时, 任务)，用于统计运行尾部
+        self._timings = []
+
+    def fetched(self, task, rows: list, chunks: int) -> None:
+        with self.lock:
+            self.stats['fetched'] += len(rows)
+            if chunks > 0:
+                self._pending[task] = chunks
+        ROWS_FETCHED.inc(len(rows), table=self.table)
+        if chunks == 0:
+            self._committed(task)
+
+    def fresh(self, rows: list) -> list:
+        '''丢弃最近已写入的行'''
+        if self.recent is None or len(rows) == 0:
+            return rows
+        result = self.recent.filter(rows)
+        if len(result) < len(rows):
+            with self.lock:
+                self.stats['skipped'] += len(rows) - len(result)
+        return result
+
+    def timed(self, task, started: float) -> None:
+        now = time.perf_counter()
+        with self.lock:
+            self._timings.append((now - self._started, now - started, task))
+
+    def finish(self) -> dict:
+        '''汇总运行时间与尾部统计：tail 为 95% 任务完成后到运行结束的时间'''
+        wall = time.perf_counter() - self._started
+        self.stats['wall'] = round(wall, 3)
+        if len(self._timings) > 0:
+            finishes = sorted(t[0] for t in self._timings)
+            p50 = finishes[int(len(finishes) * 0.5)]
+            p95 = finishes[min(len(finishes) - 1, int(len(finishes) * 0.95))]
+            self.stats['p50Finish'] = round(p50, 3)
+            self.stats['p95Finish'] = round(p95, 3)
+            self.stats['tail'] = round(wall - p95, 3)
+            slowest = sorted(self._timings, key=lambda t: t[1], reverse=True)[:5]
+            self.stats['slowest'] = [(task, round(duration, 3)) for _, duration, task in slowest]
+        return self.stats
+
+    def fetchFailed(self, task) -> None:
+        with self.lock:
+            self.stats['failed'] += 1
+        self._callback(self._onFailed, task)
+
+    def written(self, tasks: collections.Counter, rows: int, ok: bool) -> None:
+        done, failed = [], []
+        with self.lock:
+            self.stats['written'] += rows
+            for task, chunks in tasks.items():
+                if not ok:
+                    self._failed.add(task)
+                self._pending[task] -= chunks
+                if self._pending[task] == 0:
+                    del self._pending[task]
+                    if task in self._failed:
+                        self._failed.discard(task)
+                        self.stats['failed'] += 1
+                        failed.append(task)
+                    else:
+                        done.append(task)
+        for task in done:
+            self._committed(task)
+        for task in failed:
+            self._callback(self._onFailed, task)
+
+    def committedRows(self, rows: list) -> None:
+        if self.onRows is not None:
+            try:
+                self.onRows(rows)
+            except Exception as ex:
+                logging.error(f'Error handling {len(rows)} committed rows of {self.table}, reason: {repr(ex)}')
+
+    def _committed(self, task) -> None:
+        self._callback(self._onCommitted, task)
+
+    def _callback(self, callback, task) -> None:
+        if callback is not None:
+            try:
+                callback(task)
+            except Exception as ex:
+                logging.error(f'Error handling task {task}, reason: {repr(ex)}')
+
+
+def _writeWorker(db: sqlalchemy.engine.Engine, model, rowQueue: queue.Queue, batchSize: int, state: _PipelineState, writeLimit: TokenBucket = None,
+                 flushInterval: float = None):
+    '''
+    写入线程：从队列中取出数据并分批写入数据库，writeLimit 限制每秒写入行数
+    队列空闲 flushInterval 秒后提交不足一批的行，使任务不必等到流水线结束才完成
+    '''
+    buffer = []
+    tasks = collections.Counter()
+
+    def flush():
+        if len(buffer) == 0:
+            return
+        written, ok = 0, False
+        rows = uniqueRows(model, buffer)
+        if writeLimit is not None:
+            writeLimit.wait(len(rows))
+        try:
+            with sqlalchemy.orm.Session(db) as session:
+                session.begin()
+                written = upsertRows(session, model, rows, batchSize)
+                session.commit()
+            ok = written == len(rows)
+            if ok and state.recent is not None:
+                state.recent.add(rows)
+            if ok:
+                state.committedRows(rows)
+        except Exception as ex:
+            written = 0
+            logging.error(f'Error writing {len(buffer)} rows into {model.__tablename__}, reason: {repr(ex)}')
+        state.written(tasks, written, ok)
+        buffer.clear()
+        tasks.clear()
+
+    while True:
+        try:
+            item = rowQueue.get(timeout=flushInterval)
+        except queue.Empty:
+            flush()
+            continue
+        QUEUE_DEPTH.set(rowQueue.qsize(), table=model.__tablename__)
+        if item is _STOP:
+            break
+        task, rows = item
+        buffer.extend(rows)
+        tasks[task] += 1
+        if len(buffer) >= batchSize:
+            flush()
+    flush()
+
+
+def _chunks(rows: list, batchSize: int) -> list:
+    return [rows[i:i + batchSize] for i in range(0, len(rows), batchSize)]
+
+
+def _fetchWorker(task, fetch, rowQueue: queue.Queue, batchSize: int, state: _PipelineState, fetchLimit: TokenBucket = None):
+    '''获取线程：获取单个任务的数据并分批放入队列，fetch 返回 None 表示获取失败'''
+    if fetchLimit is not None:
+        fetchLimit.wait()
+    started = time.perf_counter()
+    rows = fetch(task)
+    state.timed(task, started)
+    if rows is None:
+        state.fetchFailed(task)
+        return
+    chunks = _chunks(state.fresh(rows), batchSize)
+    state.fetched(task, rows, len(chunks))
+    for chunk in chunks:
+        rowQueue.put((task, chunk))
+
+
+def _fetchDone(future: concurrent.futures.Future, task, state: _PipelineState, slots: threading.BoundedSemaphore) -> None:
+    '''获取线程结束：释放任务槽位，获取线程中未预料的异常按获取失败处理'''
+    slots.release()
+    ex = future.exception()
+    if ex is not None:
+        logging.error(f'Unexpected error fetching task {task} for {state.table}, reason: {repr(ex)}')
+        state.fetchFailed(task)
+
+
+def _limit(config: dict, key: str) -> TokenBucket:
+    '''根据配置创建限速令牌桶，未配置时不限速'''
+    rate = config.get(key)
+    return TokenBucket(rate) if rate else None
+
+
+def _startWriters(db: sqlalchemy.engine.Engine, model, rowQueue: queue.Queue, config: dict, state: _PipelineState) -> list:
+    flushInterval = config.get('flushInterval', DEFAULT_FLUSH_INTERVAL)
+    if config.get('ingest') == 'archive':
+        # 归档模式：写入按天分区的压缩归档而不是数据库
+        logType = next(k for k, m in ARCHIVE_MODELS.items() if m is model)
+        writer = ArchiveWriter(config['archiveDir'], logType)
+        args = (writer, rowQueue, config.get('archiveFlushRows', DEFAULT_FLUSH_ROWS), state, _STOP, flushInterval)
+        t = threading.Thread(target=archiveWorker, args=args, daemon=True)
+        t.start()
+        return [t]
+    if config.get('ingest') == 'bulk':
+        # 批量导入模式：单个线程写暂存文件，按 stagingRows 行整体导入
+        args = (db, model, rowQueue, config.get('stagingRows', DEFAULT_STAGING_ROWS), config.get('batchSize', DEFAULT_BATCH_SIZE),
+                state, config.get('stagingDir'), _STOP, _limit(config, 'writeRate'), flushInterval)
+        t = threading.Thread(target=stagingWorker, args=args, daemon=True)
+        t.start()
+        return [t]
+    writers = []
+    # 所有写入线程共享同一个限速令牌桶
+    writeLimit = _limit(config, 'writeRate')
+    for _ in range(config.get('writers', DEFAULT_WRITERS)):
+        t = threading.Thread(target=_writeWorker, args=(db, model, rowQueue, config.get('batchSize', DEFAULT_BATCH_SIZE), state, writeLimit, flushInterval),
+                             daemon=True)
+        t.start()
+        writers.append(t)
+    return writers
+
+
+def _stopWriters(rowQueue: queue.Queue, writers: list) -> None:
+    for _ in writers:
+        rowQueue.put(_STOP)
+    for t in writers:
+        t.join()
+
+
+def runPipeline(db: sqlalchemy.engine.Engine, model, tasks, fetch, config: dict, onCommitted=None, onFailed=None, onRows=None) -> dict:
+    '''
+    边获取边写入的生产者/消费者流水线
+    tasks 为可迭代的任务（如邮箱地址），fetch(task) 返回待写入的行列表，失败时返回 None
+    onCommitted(task) 在该任务的全部数据提交后调用，onFailed(task) 在获取或写入失败时调用，onRows(rows) 在每批数据逐批写入数据库后调用（批量导入与归档模式不调用）
+    config 中的 fetchRate（每秒任务数）与 writeRate（每秒行数）用于限速，recentKeys 为进程内去重缓存的容量（0 为关闭），
+    flushInterval 为队列空闲多少秒后提交写入线程中已缓存的行（否则只在凑满一批或结束时提交），
+    ingest 为 bulk 时经暂存文件批量导入（见 bulkload.py），为 archive 时写入 archiveDir 下的归档（见 archive.py）
+    '''
+    parallel = config['parallel']
+    batchSize = config.get('batchSize', DEFAULT_BATCH_SIZE)
+    rowQueue = queue.Queue(maxsize=config.get('queueSize', DEFAULT_QUEUE_SIZE))
+    state = _PipelineState(model.__tablename__, onCommitted, onFailed, recentKeys(model, config.get('recentKeys', DEFAULT_RECENT_KEYS)), onRows)
+    writers = _startWriters(db, model, rowQueue, config, state)
+    fetchLimit = _limit(config, 'fetchRate')
+
+    # 限制已提交但未完成的任务数，避免一次性展开整个任务列表
+    slots = threading.BoundedSemaphore(parallel * 2)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            for task in tasks:
+                slots.acquire()
+                state.stats['tasks'] += 1
+                future = executor.submit(_fetchWorker, task, fetch, rowQueue, batchSize, state, fetchLimit)
+                future.add_done_callback(lambda f, task=task: _fetchDone(f, task, state, slots))
+    finally:
+        _stopWriters(rowQueue, writers)
+    stats = state.finish()
+    logging.info(f'Pipeline for {model.__tablename__} finished: {stats["tasks"]} tasks ({stats["failed"]} failed), {stats["fetched"]} rows fetched, {stats["skipped"]} recently written rows skipped, {stats["written"]} rows written')
+    logging.info(f'Run timing for {model.__tablename__}: wall {stats["wall"]}s, 50% done at {stats.get("p50Finish")}s, 95% done at {stats.get("p95Finish")}s, tail {stats.get("tail")}s, slowest {stats.get("slowest")}')
+    return stats
+
+
+async def runAsyncPipeline(db: sqlalchemy.engine.Engine, model, tasks, fetch, config: dict, concurrency: int, onCommitted=None, onFailed=None,
+                           onRows=None) -> dict:
+    '''
+    协程版本的流水线，fetch(task) 为返回行列表的协程
+    写入仍由写入线程完成，队列满时在线程中等待以免阻塞事件循环
+    '''
+    batchSize = config.get('batchSize', DEFAULT_BATCH_SIZE)
+    rowQueue = queue.Queue(maxsize=config.get('queueSize', DEFAULT_QUEUE_SIZE))
+    state = _PipelineState(model.__tablename__, onCommitted, onFailed, recentKeys(model, config.get('recentKeys', DEFAULT_RECENT_KEYS)), onRows)
+    writers = _startWriters(db, model, rowQueue, config, state)
+    fetchLimit = _limit(config, 'fetchRate')
+
+    async def runTask(task):
+        if fetchLimit is not None:
+            await asyncio.sleep(fetchLimit.reserve())
+        started = time.perf_counter()
+        try:
+            rows = await fetch(task)
+        except Exception as ex:
+            logging.error(f'Unexpected error fetching task {task} for {state.table}, reason: {repr(ex)}')
+            rows = None
+        state.timed(task, started)
+        if rows is None:
+            state.fetchFailed(task)
+            return
+        chunks = _chunks(state.fresh(rows), batchSize)
+        state.fetched(task, rows, len(chunks))
+        for chunk in chunks:
+            try:
+                rowQueue.put_nowait((task, chunk))
+            except queue.Full:
+                await asyncio.to_thread(rowQueue.put, (task, chunk))
+
+    slots = asyncio.Semaphore(concurrency * 2)
+    pending = set()
+    try:
+        for task in tasks:
+            await slots.acquire()
+            state.stats['tasks'] += 1
+            t = asyncio.create_task(runTask(task))
+            pending.add(t)
+            t.add_done_callback(pending.discard)
+            t.add_done_callback(lambda _: slots.release())
+        await asyncio.gather(*pending)
+    finally:
+        await asyncio.to_thread(_stopWriters, rowQueue, writers)
+    stats = state.finish()
+    logging.info(f'Async pipeline for {model.__tablename__} finished: {stats["tasks"]} tasks ({stats["failed"]} failed), {stats["fetched"]} rows fetched, {stats["skipped"]} recently written rows skipped, {stats["written"]} rows written')
+    logging.info(f'Run timing for {model.__tablename__}: wall {stats["wall"]}s, 50% done at {stats.get("p50Finish")}s, 95% done at {stats.get("p95Finish")}s, tail {stats.get("tail")}s, slowest {stats.get("slowest")}')
+    return stats
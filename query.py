@@ -0,0 +1,153 @@
+import csv
+import sys
+import enum
+import json
+import logging
+import datetime
+import sqlalchemy
+from database import *
+
+DEFAULT_PAGE_SIZE = 1000
+QUERY_MODELS = {'mail': MailLog, 'login': LoginLog}
+
+
+def queryConditions(model, start: datetime.datetime = None, end: datetime.datetime = None, **fields) -> list:
+    '''
+    时间范围 [start, end) 与按列相等的过滤条件，值为 None 的列不过滤
+    枚举列可用名称（如 SEND）；邮件日志的 address 匹配发件人或收件人
+    '''
+    table = model.__table__
+    conditions = []
+    if start is not None:
+        conditions.append(table.c.time >= start)
+    if end is not None:
+        conditions.append(table.c.time < end)
+    for name, value in fields.items():
+        if value is None:
+            continue
+        if name == 'address' and model is MailLog:
+            conditions.append(sqlalchemy.or_(table.c.sender == value, table.c.receiver == value))
+            continue
+        column = table.c[name]
+        enumClass = getattr(column.type, 'enum_class', None)
+        if enumClass is not None and not isinstance(value, enum.Enum):
+            value = enumClass[str(value).upper()]
+        conditions.append(column == value)
+    return conditions
+
+
+def queryStatement(model, conditions: list, after: tuple = None, limit: int = None):
+    '''按 (time, id) 排序的查询，after 为上一页最后一行的 (time, id)，展开为索引可用的范围条件'''
+    table = model.__table__
+    columns = [c for c in table.columns if c.name != 'content_hash']
+    stmt = sqlalchemy.select(*columns).where(*conditions)
+    if after is not None:
+        time, rowId = after
+        stmt = stmt.where(sqlalchemy.or_(table.c.time > time, sqlalchemy.and_(table.c.time == time, table.c.id > rowId)))
+    stmt = stmt.order_by(table.c.time, table.c.id)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+def parseCursor(value) -> tuple:
+    '''解析 "时间,id" 形式的续传位置'''
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.rsplit(',', 1)
+    time, rowId = value
+    return datetime.datetime.fromisoformat(str(time)), int(rowId)
+
+
+def streamRows(db: sqlalchemy.engine.Engine, model, conditions: list, after: tuple = None, pageSize: int = DEFAULT_PAGE_SIZE,
+               limit: int = None, serverSide: bool = False):
+    '''
+    逐行返回查询结果，内存占用与结果总数无关；time 为空的记录不会返回
+    默认按 keyset 分页，每页是一个独立的短查询，从上一页最后一行的 (time, id) 继续，页数增加不会变慢；
+    serverSide 时改为单个查询，经服务端游标每次取 pageSize 行
+    '''
+    returned = 0
+    if serverSide:
+        stmt = queryStatement(model, conditions, after, limit).execution_options(stream_results=True, yield_per=pageSize)
+        with db.connect() as conn:
+            for row in conn.execute(stmt):
+                yield dict(row._mapping)
+        return
+    while limit is None or returned < limit:
+        size = pageSize if limit is None else min(pageSize, limit - returned)
+        with db.connect() as conn:
+            page = [dict(row._mapping) for row in conn.execute(queryStatement(model, conditions, after, size))]
+        for row in page:
+            yield row
+        returned += len(page)
+        if len(page) < size:
+            break
+        after = (page[-1]['time'], page[-1]['id'])
+
+
+def explainQuery(db: sqlalchemy.engine.Engine, stmt) -> list:
+    '''返回数据库为查询选择的执行计划，每行一条'''
+    dialect = db.dialect.name
+    sql = str(stmt.compile(dialect=db.dialect, compile_kwargs={'literal_binds': True}))
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+    with db.connect() as conn:
+        return [' | '.join(str(v) for v in row) for row in conn.exec_driver_sql(prefix + sql)]
+
+
+def _plain(value):
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def writeRows(rows, fp, format: str = 'ndjson') -> tuple:
+    '''将行写为 NDJSON 或 CSV（首行为表头），返回 (行数, 最后一行的 (time, id))'''
+    if format not in ('ndjson', 'csv'):
+        raise ValueError(f'Unknown output format {format}')
+    count, last, writer = 0, None, None
+    for row in rows:
+        record = {k: _plain(v) for k, v in row.items()}
+        if format == 'ndjson':
+            fp.write(json.dumps(record, ensure_ascii=False) + '\n')
+        else:
+            if writer is None:
+                writer = csv.DictWriter(fp, fieldnames=list(record))
+                writer.writeheader()
+            writer.writerow(record)
+        count += 1
+        last = (row['time'], row['id'])
+    return count, last
+
+
+def runQuery(db: sqlalchemy.engine.Engine, logType: str, start=None, end=None, after=None, format: str = 'ndjson',
+             output: str = None, pageSize: int = DEFAULT_PAGE_SIZE, limit: int = None, serverSide: bool = False,
+             explain: bool = False, **fields) -> int:
+    '''
+    查询登录或邮件日志并流式输出到 output（默认标准输出），返回输出的行数
+    explain 时只输出第一页查询的执行计划；结束时在日志中记录续传位置，可作为 after 继续
+    邮件日志按 address 查询时匹配发件人或收件人，没有能直接按 (time, id) 顺序读取的索引，每页都要重新排序，因此改用服务端游标
+    '''
+    model = QUERY_MODELS[logType]
+    if model is MailLog and fields.get('address') is not None:
+        serverSide = True
+    start = datetime.datetime.fromisoformat(str(start)) if start is not None else None
+    end = datetime.datetime.fromisoformat(str(end)) if end is not None else None
+    after = parseCursor(after)
+    conditions = queryConditions(model, start, end, **fields)
+    if explain:
+        stmt = queryStatement(model, conditions, after, None if serverSide else min(pageSize, limit or pageSize))
+        for line in explainQuery(db, stmt):
+            print(line)
+        return 0
+    rows = streamRows(db, model, conditions, after, pageSize, limit, serverSide)
+    if output is None:
+        count, last = writeRows(rows, sys.stdout, format)
+    else:
+        with open(output, 'w', encoding='utf-8', newline='') as fp:
+            count, last = writeRows(rows, fp, format)
+    if last is not None:
+        logging.info(f'Query on {model.__tablename__} returned {count} rows, resume with --after {last[0].isoformat()},{last[1]}')
+    return count
@@ -0,0 +1,199 @@
+import time
+import random
+import asyncio
+import threading
+
+# 频率限制相关错误码：-1 系统繁忙，45009 接口调用超过限制，45011 调用过于频繁，45033 并发超过限制
+THROTTLE_ERRCODES = {-1, 45009, 45011, 45033}
+# 令牌失效相关错误码：40014 不合法的 access_token，42001 access_token 已过期
+TOKEN_ERRCODES = {40014, 42001}
+
+OK = 'ok'
+THROTTLED = 'throttled'
+TOKEN_EXPIRED = 'token_expired'
+FAILED = 'failed'
+# 网络错误等：重试但不降低并发上限
+RETRY = 'retry'
+
+
+def classify(httpStatus: int, errcode: int = None) -> str:
+    '''根据 HTTP 状态码与 errcode 判断请求结果'''
+    if httpStatus == 429 or httpStatus >= 500:
+        return THROTTLED
+    if errcode in THROTTLE_ERRCODES:
+        return THROTTLED
+    if errcode in TOKEN_ERRCODES:
+        return TOKEN_EXPIRED
+    if errcode == 0:
+        return OK
+    return FAILED
+
+
+class TokenBucket:
+    '''令牌桶，rate 为每秒补充的令牌数，capacity 为允许的突发量'''
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n: float = 1) -> float:
+        '''预留 n 个令牌，返回需要等待的秒数'''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def wait(self, n: float = 1) -> None:
+        '''阻塞直到取得 n 个令牌'''
+        delay = self.reserve(n)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AdaptiveConcurrency:
+    '''
+    AIMD 并发控制：成功时线性增加并发上限，被限流时成倍减小
+    '''
+
+    def __init__(self, initial: int = 8, minimum: int = 1, maximum: int = 64, decrease: float = 0.5) -> None:
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.inflight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout: float = None) -> bool:
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.inflight < int(self.limit), timeout):
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self) -> None:
+        with self._cond:
+            self.inflight -= 1
+            self._cond.notify()
+
+    def onSuccess(self) -> None:
+        with self._cond:
+            before = int(self.limit)
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if int(self.limit) > before:
+                self._cond.notify()
+
+    def onThrottle(self) -> None:
+        with self._cond:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class AsyncAdaptiveConcurrency:
+    '''
+    AdaptiveConcurrency 的协程版本：等待槽位时挂起协程而不阻塞事件循环，须在事件循环内创建
+    '''
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = None, decrease: float = 0.5) -> None:
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum if maximum is not None else initial
+        self.decrease = decrease
+        self.inflight = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, timeout: float = None) -> bool:
+        async with self._cond:
+            if self.inflight >= int(self.limit):
+                try:
+                    await asyncio.wait_for(self._cond.wait_for(lambda: self.inflight < int(self.limit)), timeout)
+                except asyncio.TimeoutError:
+                    return False
+            self.inflight += 1
+            return True
+
+    async def release(self, result: str) -> None:
+        async with self._cond:
+            self.inflight -= 1
+            if result == OK:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif result == THROTTLED:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            free = int(self.limit) - self.inflight
+            if free > 0:
+                self._cond.notify(free)
+
+
+class RetryPolicy:
+    '''带随机抖动的指数退避重试，总耗时不超过 deadline 秒'''
+
+    def __init__(self, maxAttempts: int = 6, baseDelay: float = 0.5, maxDelay: float = 30, deadline: float = 120) -> None:
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.deadline = deadline
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+
+    def nextDelay(self, attempt: int, deadline: float) -> float:
+        '''返回下次重试前的等待秒数，不应再重试时返回 None'''
+        if attempt + 1 >= self.maxAttempts:
+            return None
+        delay = self.delay(attempt)
+        if time.monotonic() + delay > deadline:
+            return None
+        return delay
+
+
+class RateController:
+    '''
+    API 调用速率控制：每个接口一个令牌桶，所有接口共享 AIMD 并发上限与重试策略
+    config 示例：{"rate": 20, "burst": 40, "endpoints": {"log/mail": 10},
+                  "concurrency": 8, "maxConcurrency": 64, "retries": 6, "deadline": 120}
+    '''
+
+    def __init__(self, config: dict = None) -> None:
+        config = config or {}
+        self._rate = config.get('rate', 20)
+        self._burst = config.get('burst', None)
+        self._endpointRates = config.get('endpoints', {})
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.concurrency = AdaptiveConcurrency(
+            initial=config.get('concurrency', 8),
+            maximum=config.get('maxConcurrency', 64))
+        self.retry = RetryPolicy(
+            maxAttempts=config.get('retries', 6),
+            deadline=config.get('deadline', 120))
+
+    def bucket(self, endpoint: str) -> TokenBucket:
+        with self._lock:
+            if endpoint not in self._buckets:
+                rate = self._endpointRates.get(endpoint, self._rate)
+                self._buckets[endpoint] = TokenBucket(rate, self._burst)
+            return self._buckets[endpoint]
+
+    def deadline(self) -> float:
+        return time.monotonic() + self.retry.deadline
+
+    def acquire(self, endpoint: str, deadline: float) -> bool:
+        '''阻塞直到可以发出请求，超过 deadline 时返回 False'''
+        wait = self.bucket(endpoint).reserve()
+        if time.monotonic() + wait > deadline:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return self.concurrency.acquire(max(0, deadline - time.monotonic()))
+
+    def release(self, result: str) -> None:
+        self.concurrency.release()
+        if result == OK:
+            self.concurrency.onSuccess()
+        elif result == THROTTLED:
+            self.concurrency.onThrottle()
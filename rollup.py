@@ -0,0 +1,191 @@
+import enum
+import datetime
+import logging
+import collections
+import sqlalchemy
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from common import *
+
+GRAINS = ('hour', 'day')
+# 单条累加语句包含的汇总行数
+ROLLUP_CHUNK = 1000
+
+
+def _mailOwner(row: dict) -> str:
+    '''发信计入发件人，收信计入收件人'''
+    return row['sender'] if row['type'] is ExMailType.SEND else row['receiver']
+
+
+# 日志表 -> (汇总表, 维度列, 记录归属的邮箱)
+ROLLUPS = {
+    LoginLog: (LoginRollup, ('type',), lambda row: row['address']),
+    MailLog: (MailRollup, ('type', 'status'), _mailOwner),
+}
+ROLLUP_MODELS = {'login': LoginLog, 'mail': MailLog}
+
+
+def bucketStart(time: datetime.datetime, grain: str) -> datetime.datetime:
+    if grain == 'hour':
+        return time.replace(minute=0, second=0, microsecond=0)
+    if grain == 'day':
+        return datetime.datetime.combine(time.date(), datetime.time())
+    raise ValueError(f'Unknown rollup grain {grain}')
+
+
+def rollupCounts(model, rows) -> collections.Counter:
+    '''将日志行汇总为 (grain, address, bucket, 维度...) -> 条数，缺少归属邮箱或维度的行不计入'''
+    _, dimensions, owner = ROLLUPS[model]
+    counts = collections.Counter()
+    for row in rows:
+        address = owner(row)
+        values = tuple(row[d] for d in dimensions)
+        if address is None or row['time'] is None or None in values:
+            continue
+        for grain in GRAINS:
+            counts[(grain, address, bucketStart(row['time'], grain)) + values] += 1
+    return counts
+
+
+def _rollupValues(model, counts: collections.Counter) -> list:
+    '''按主键排序，减少并发累加同一批汇总行时的死锁'''
+    _, dimensions, _ = ROLLUPS[model]
+    names = ('grain', 'address', 'bucket') + dimensions
+    keys = sorted(counts, key=lambda k: [v.value if isinstance(v, enum.Enum) else v for v in k])
+    return [dict(zip(names, k), count=counts[k]) for k in keys]
+
+
+def incrementStatement(rollupModel, values: list, dialect: str = 'mysql'):
+    '''多行累加：汇总行已存在时在原有条数上增加'''
+    table = rollupModel.__table__
+    if dialect == 'mysql':
+        stmt = mysql.insert(table).values(values)
+        return stmt.on_duplicate_key_update(count=table.c['count'] + stmt.inserted['count'])
+    if dialect not in ('sqlite', 'postgresql'):
+        raise ValueError(f'Unsupported database dialect {dialect}')
+    insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+    stmt = insert(table).values(values)
+    return stmt.on_conflict_do_update(index_elements=[c.name for c in table.primary_key.columns],
+                                      set_={'count': table.c['count'] + stmt.excluded['count']})
+
+
+def _visibleHashes(session: sqlalchemy.orm.Session, table, hashes: list) -> set:
+    return set(session.scalars(sqlalchemy.select(table.c.content_hash).where(table.c.content_hash.in_(hashes))))
+
+
+def insertNewRows(session: sqlalchemy.orm.Session, model, rows: list, dialect: str) -> set:
+    '''
+    插入 content_hash 尚不存在的日志行，已存在的行不修改，返回本事务实际插入的摘要
+    SQLite 与 PostgreSQL 由 ON CONFLICT DO NOTHING RETURNING 直接返回；并发事务插入同一摘要时后者等待前者提交后跳过
+    MySQL 不支持 RETURNING：在同一一致性快照（REPEATABLE READ，见 getDB）中比较插入前后可见的摘要，
+    其他事务在快照之后提交的行两次都不可见，只有本事务插入的行在插入后可见；
+    重复的行以不改变任何值的 ON DUPLICATE KEY UPDATE 加排他锁，不会被本事务修改
+    '''
+    table = model.__table__
+    if dialect == 'mysql':
+        hashes = [r['content_hash'] for r in rows]
+        before = _visibleHashes(session, table, hashes)
+        stmt = mysql.insert(table).values(rows)
+        session.execute(stmt.on_duplicate_key_update(content_hash=table.c.content_hash))
+        return _visibleHashes(session, table, hashes) - before
+    if dialect not in ('sqlite', 'postgresql'):
+        raise ValueError(f'Unsupported database dialect {dialect}')
+    insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+    stmt = insert(table).values(rows).on_conflict_do_nothing().returning(table.c.content_hash)
+    return set(session.scalars(stmt))
+
+
+def upsertLogRows(session: sqlalchemy.orm.Session, model, rows: list, dialect: str) -> int:
+    '''
+    写入日志行并在同一事务中累加汇总表，返回累加的汇总行数
+    只有本事务实际插入的行计入汇总，重复或并发写入同一日志不会被重复计数；
+    已存在的行不参与摘要的字段（如邮件状态）变化时加锁更新，并把计数从旧维度移到新维度
+    在汇总表出现之前写入的行没有对应的汇总，状态变化时旧维度可能出现负数，由 repairRollup 重新计算
+    '''
+    if len(rows) == 0:
+        return 0
+    table = model.__table__
+    # 按摘要排序，并发事务以相同顺序加锁
+    rows = sorted(rows, key=lambda r: r['content_hash'])
+    inserted = insertNewRows(session, model, rows, dialect)
+    counts = collections.Counter()
+    counts.update(rollupCounts(model, [r for r in rows if r['content_hash'] in inserted]))
+
+    columns = [c for c in rows[0] if c != 'content_hash' and c not in model.dedupFields]
+    existing = [r for r in rows if r['content_hash'] not in inserted]
+    if len(columns) > 0 and len(existing) > 0:
+        stmt = sqlalchemy.select(table.c.content_hash, *[table.c[c] for c in columns]) \
+            .where(table.c.content_hash.in_([r['content_hash'] for r in existing])) \
+            .order_by(table.c.content_hash).with_for_update()
+        current = {r[0]: dict(zip(columns, r[1:])) for r in session.execute(stmt)}
+        changed = []
+        for row in existing:
+            old = current.get(row['content_hash'])
+            if old is None or all(old[c] == row[c] for c in columns):
+                continue
+            changed.append(row)
+            counts.update(rollupCounts(model, [row]))
+            counts.subtract(rollupCounts(model, [dict(row, **old)]))
+        if len(changed) > 0:
+            update = sqlalchemy.update(table).where(table.c.content_hash == sqlalchemy.bindparam('_hash')) \
+                .values({c: sqlalchemy.bindparam(f'_{c}') for c in columns})
+            session.connection().execute(update, [dict({f'_{c}': r[c] for c in columns}, _hash=r['content_hash']) for r in changed])
+
+    values = _rollupValues(model, collections.Counter({k: v for k, v in counts.items() if v != 0}))
+    rollupModel = ROLLUPS[model][0]
+    for i in range(0, len(values), ROLLUP_CHUNK):
+        session.execute(incrementStatement(rollupModel, values[i:i + ROLLUP_CHUNK], dialect))
+    return len(values)
+
+
+def repairRollup(db: sqlalchemy.engine.Engine, model, day: datetime.date, extraRows=None, batchSize: int = 1000) -> dict:
+    '''
+    从日志表重新计算某一天的汇总，在一个事务中替换该天全部 hour 与 day 汇总行
+    extraRows 为同一天不在日志表中的记录（如已移入归档的部分），须带 content_hash，与日志表按摘要去重
+    与同步同时运行时，期间写入的日志可能被重复或遗漏计数，宜在同步空闲时执行
+    '''
+    rollupModel = ROLLUPS[model][0]
+    table, rollupTable = model.__table__, rollupModel.__table__
+    start = datetime.datetime.combine(day, datetime.time())
+    end = start + datetime.timedelta(days=1)
+    columns = [c for c in table.columns if c.name != 'id']
+    stmt = sqlalchemy.select(*columns).where(table.c.time >= start, table.c.time < end) \
+        .execution_options(yield_per=batchSize)
+    counts = collections.Counter()
+    seen = set() if extraRows is not None else None
+    rows = 0
+    with db.begin() as conn:
+        batch = []
+        for row in conn.execute(stmt):
+            row = dict(zip((c.name for c in columns), row))
+            if seen is not None:
+                seen.add(row['content_hash'])
+            batch.append(row)
+            if len(batch) >= batchSize:
+                counts.update(rollupCounts(model, batch))
+                rows += len(batch)
+                batch = []
+        for row in extraRows or ():
+            if row['content_hash'] not in seen and start <= row['time'] < end:
+                seen.add(row['content_hash'])
+                batch.append(row)
+        counts.update(rollupCounts(model, batch))
+        rows += len(batch)
+
+        deleted = conn.execute(sqlalchemy.delete(rollupTable).where(rollupTable.c.bucket >= start, rollupTable.c.bucket < end)).rowcount
+        values = _rollupValues(model, counts)
+        for i in range(0, len(values), ROLLUP_CHUNK):
+            conn.execute(sqlalchemy.insert(rollupTable), values[i:i + ROLLUP_CHUNK])
+    logging.info(f'Repaired {rollupTable.name} for {day.isoformat()} from {rows} rows, replaced {deleted} rollup rows with {len(values)}')
+    return {'rows': rows, 'deleted': deleted, 'inserted': len(values)}
+
+
+def readRollup(db: sqlalchemy.engine.Engine, model, grain: str, start: datetime.datetime, end: datetime.datetime,
+               address: str = None) -> list:
+    '''读取 [start, end) 内的汇总行，address 为空时返回全部邮箱'''
+    table = ROLLUPS[model][0].__table__
+    stmt = sqlalchemy.select(table).where(table.c.grain == grain, table.c.bucket >= start, table.c.bucket < end)
+    if address is not None:
+        stmt = stmt.where(table.c.address == address)
+    stmt = stmt.order_by(table.c.address, table.c.bucket)
+    with db.connect() as conn:
+        return [dict(row._mapping) for row in conn.execute(stmt)]
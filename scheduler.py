@@ -0,0 +1,85 @@
+import time
+import random
+import logging
+import threading
+
+DEFAULT_JITTER = 0.1
+
+
+class Job:
+    '''按固定间隔重复运行的任务，每次间隔加上 ±jitter 比例的随机抖动'''
+
+    def __init__(self, name: str, func, interval: float, jitter: float = DEFAULT_JITTER) -> None:
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.runs = 0
+        self.failures = 0
+        self.lastDuration = None
+
+    def delay(self) -> float:
+        return max(0, self.interval * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def run(self) -> None:
+        start = time.perf_counter()
+        self.runs += 1
+        try:
+            self.func()
+            status = 'finished'
+        except Exception as ex:
+            self.failures += 1
+            status = f'failed ({repr(ex)})'
+            logging.exception(f'Job {self.name} failed')
+        self.lastDuration = time.perf_counter() - start
+        logging.info(f'Job {self.name} {status} in {self.lastDuration:.2f}s (run {self.runs}, {self.failures} failures)')
+
+
+class Scheduler:
+    '''
+    每个任务在自己的线程中循环运行，同一任务上一次运行结束前不会再次启动
+    运行时间超过间隔时，下一次在结束后立即开始；首次运行在 [0, jitter × 间隔] 内随机错开
+    '''
+
+    def __init__(self) -> None:
+        self.jobs = []
+        self._stop = threading.Event()
+        self._threads = []
+
+    def add(self, name: str, func, interval: float, jitter: float = DEFAULT_JITTER) -> Job:
+        job = Job(name, func, interval, jitter)
+        self.jobs.append(job)
+        return job
+
+    def _loop(self, job: Job) -> None:
+        nextRun = time.monotonic() + random.uniform(0, job.interval * job.jitter)
+        while not self._stop.wait(max(0, nextRun - time.monotonic())):
+            started = time.monotonic()
+            job.run()
+            nextRun = started + job.delay()
+            if nextRun < time.monotonic():
+                logging.warning(f'Job {job.name} took longer than its interval of {job.interval}s')
+            logging.info(f'Next run of {job.name} in {max(0, nextRun - time.monotonic()):.0f}s')
+
+    def start(self) -> None:
+        for job in self.jobs:
+            t = threading.Thread(target=self._loop, args=(job,), name=f'job-{job.name}', daemon=True)
+            t.start()
+            self._threads.append(t)
+        logging.info(f'Scheduler started with jobs {[(j.name, j.interval) for j in self.jobs]}')
+
+    def interrupt(self) -> None:
+        '''请求停止，可在信号处理函数中调用'''
+        self._stop.set()
+
+    def stop(self) -> None:
+        '''不再启动新的运行，并等待正在运行的任务结束'''
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+        logging.info('Scheduler stopped')
+
+    def wait(self) -> None:
+        '''阻塞直到 interrupt() 或 stop() 被调用'''
+        while not self._stop.wait(1):
+            pass
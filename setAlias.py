@@ -1,22 +1,158 @@
-import exmail
-import logging
+'''
+批量设置别名邮箱
+输入为制表符分隔的文本（默认第 1 列为用户名，第 3 列为别名），逐行流式读取
+与 MailBox 表中的 alias 比较，跳过无需修改的用户，其余在速率控制下并发更新
+每行结果追加写入报告，中断后以相同参数重新运行会跳过报告中已完成的用户
 
-FILENAME = r'C:\Users\admin\XXBDOC\邮件系统相关\日常业务处置\新生别名邮箱\result_2021.txt'
+    python setAlias.py result_2021.txt --domain m.fudan.edu.cn
+'''
+import json
+import logging
+import itertools
+import concurrent.futures
+import fire
+import sqlalchemy
+import exmail
+from database import *
 
 logging.basicConfig(level=logging.INFO, filename='exmail.log',
                     format='%(asctime)s - %(levelname)s : %(message)s')
 
-def setAlias(userid: str, alias: str):
-    client.updateMember(userid, {'slaves': [alias]})
-    # print(userid, alias)
+OK = 'ok'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+PLANNED = 'planned'
+# 报告中视为已完成、重新运行时跳过的状态
+DONE = (OK, SKIPPED)
 
-def main(filename):                   
-    data = (x.split('\t') for x in open(filename, encoding='utf-8').read().splitlines())
-    for userid, _, alias in data:
-        print("set alias %s for %s" % (alias, userid))
-        setAlias(userid + '@m.fudan.edu.cn', alias)
-        # logging.info("set alias %s for %s" % (alias, userid))
 
-if __name__ == '__main__':
+def readInput(filename: str, userColumn: int = 0, aliasColumn: int = 2, domain: str = None):
+    '''逐行返回 (邮箱, 别名)，用户名不含 @ 时补上 domain'''
+    with open(filename, encoding='utf-8') as fp:
+        for line in fp:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) <= max(userColumn, aliasColumn) or not fields[userColumn]:
+                continue
+            userid, alias = fields[userColumn].strip(), fields[aliasColumn].strip()
+            if '@' not in userid and domain is not None:
+                userid = f'{userid}@{domain}'
+            yield userid, alias
+
+
+def readReport(filename: str) -> set:
+    '''报告中已完成的邮箱'''
+    done = set()
+    try:
+        with open(filename, encoding='utf-8') as fp:
+            for line in fp:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) >= 3 and fields[2] in DONE:
+                    done.add(fields[0])
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def currentAliases(db: sqlalchemy.engine.Engine, addresses: list) -> dict:
+    '''读取邮箱当前的别名列表，表中没有的邮箱不在结果中'''
+    stmt = sqlalchemy.select(MailBox.address, MailBox.alias).where(MailBox.address.in_(addresses))
+    with sqlalchemy.orm.Session(db) as session:
+        return {address: [a for a in (alias or '').split(',') if a] for address, alias in session.execute(stmt)}
+
+
+def targetAliases(current: list, alias: str, merge: bool) -> list:
+    '''merge 时在现有别名上追加，否则替换为唯一的别名'''
+    if not merge:
+        return [alias]
+    return current + [alias] if alias not in current else current
+
+
+def updateAlias(client: exmail.ExMailContactApi, address: str, slaves: list) -> tuple:
+    '''调用接口设置别名，返回 (状态, 说明)'''
+    try:
+        if client.updateMember(address, {'slaves': slaves}):
+            return OK, ''
+        return FAILED, 'update rejected, see exmail.log'
+    except Exception as ex:
+        return FAILED, repr(ex)
+
+
+def saveAliases(db: sqlalchemy.engine.Engine, updated: dict) -> None:
+    '''同步更新 MailBox 中的别名，其余字段与摘要由下次 syncUser 刷新'''
+    if len(updated) == 0:
+        return
+    with sqlalchemy.orm.Session(db) as session:
+        session.begin()
+        table = MailBox.__table__
+        session.execute(sqlalchemy.update(table).where(table.c.address == sqlalchemy.bindparam('_address'))
+                        .values(alias=sqlalchemy.bindparam('_alias')),
+                        [{'_address': a, '_alias': ','.join(s)} for a, s in updated.items()])
+        session.commit()
+
+
+def setAliases(client: exmail.ExMailContactApi, db: sqlalchemy.engine.Engine, rows, report: str,
+               merge: bool = False, parallel: int = 8, batchSize: int = DEFAULT_BATCH_SIZE, dryRun: bool = False) -> dict:
+    '''
+    批量设置别名，rows 为 (邮箱, 别名) 的可迭代对象
+    按 batchSize 分批与数据库比较，需要修改的并发调用接口，结果逐行追加到 report
+    '''
+    done = readReport(report)
+    stats = {OK: 0, SKIPPED: 0, FAILED: 0, PLANNED: 0, 'resumed': 0}
+    rows = iter(rows)
+    with open(report, 'a', encoding='utf-8') as fp, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+
+        def record(address: str, alias: str, status: str, message: str = '') -> None:
+            fp.write(f'{address}\t{alias}\t{status}\t{message}\n')
+            fp.flush()
+            stats[status] += 1
+
+        while True:
+            batch = list(itertools.islice(rows, batchSize))
+            if len(batch) == 0:
+                break
+            pending = [(address, alias) for address, alias in batch if address not in done]
+            stats['resumed'] += len(batch) - len(pending)
+            current = currentAliases(db, [address for address, _ in pending])
+            futures = {}
+            for address, alias in pending:
+                slaves = targetAliases(current.get(address, []), alias, merge)
+                if address in current and slaves == current[address]:
+                    record(address, alias, SKIPPED, 'already set')
+                elif dryRun:
+                    record(address, alias, PLANNED, f'dry run, would set {slaves}')
+                else:
+                    futures[executor.submit(updateAlias, client, address, slaves)] = (address, alias, slaves)
+            updated = {}
+            for future in concurrent.futures.as_completed(futures):
+                address, alias, slaves = futures[future]
+                status, message = future.result()
+                record(address, alias, status, message)
+                if status == OK:
+                    updated[address] = slaves
+            saveAliases(db, updated)
+            logging.info(f'Alias update progress: {stats}')
+    return stats
+
+
+def main(filename: str, report: str = None, domain: str = None, merge: bool = False, parallel: int = None,
+         userColumn: int = 0, aliasColumn: int = 2, dryRun: bool = False) -> dict:
+    '''
+    按输入文件批量设置别名，report 默认为 输入文件名.report.tsv
+    merge 时保留已有别名并追加，否则替换；dryRun 只比较不修改
+    '''
+    with open('config.json') as fp:
+        config = json.load(fp)
     client = exmail.ExMailContactApi('contact.json')
-    main(FILENAME)
\ No newline at end of file
+    db = getDB(config['db'])
+    if report is None:
+        report = f'{filename}.report.tsv'
+    rows = readInput(filename, userColumn, aliasColumn, domain)
+    stats = setAliases(client, db, rows, report, merge, parallel or config.get('parallel', 8),
+                       config.get('batchSize', DEFAULT_BATCH_SIZE), dryRun)
+    logging.info(f'Alias update finished: {stats}, see {report} for details')
+    return stats
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
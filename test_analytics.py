@@ -0,0 +1,47 @@
+import datetime
+import sqlalchemy
+from common import *
+from database import upsertRows, logHash
+from analytics import Analytics
+
+DAY = datetime.date(2024, 1, 1)
+
+
+def _db(tmp_path):
+    db = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "analytics.db"}')
+    create_all(db)
+    return db
+
+
+def _mail(i: int, sender: str, status: ExMailStatus, mailType: ExMailType = ExMailType.SEND) -> dict:
+    row = {'time': datetime.datetime(2024, 1, 1, 8, i), 'sender': sender, 'receiver': 'b@example.com',
+           'subject': f'mail {i}', 'type': mailType, 'status': status}
+    row['content_hash'] = logHash(MailLog, row)
+    return row
+
+
+def _write(db, rows: list) -> None:
+    with sqlalchemy.orm.Session(db) as session:
+        session.begin()
+        upsertRows(session, MailLog, rows)
+        session.commit()
+
+
+def test_cache_is_recomputed_after_status_update(tmp_path):
+    db = _db(tmp_path)
+    rows = [_mail(i, 'a@example.com', ExMailStatus.SEND_SUCCESS) for i in range(4)]
+    _write(db, rows)
+    analytics = Analytics(db, str(tmp_path / 'cache'), domains=['example.com'])
+    assert analytics.bounceRates(DAY, DAY, minSent=1)['daily'][0]['bounced'] == 0
+
+    # 同一封邮件的状态原地更新：行数与最大 id 都不变
+    _write(db, [dict(rows[1], status=ExMailStatus.SEND_FAILURE)])
+    assert analytics.bounceRates(DAY, DAY, minSent=1)['daily'][0]['bounced'] == 1
+
+
+def test_cache_depends_on_domains(tmp_path):
+    db = _db(tmp_path)
+    _write(db, [_mail(i, 'x@partner.com', ExMailStatus.RECV_SUCCESS, ExMailType.RECEIVE) for i in range(3)])
+    cacheDir = str(tmp_path / 'cache')
+    assert Analytics(db, cacheDir, domains=['example.com']).topExternalSenders(DAY, DAY) == [{'sender': 'x@partner.com', 'mails': 3}]
+    assert Analytics(db, cacheDir, domains=['example.com', 'partner.com']).topExternalSenders(DAY, DAY) == []
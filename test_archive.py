@@ -0,0 +1,60 @@
+import datetime
+import sqlalchemy
+from common import *
+from database import upsertRows, logHash
+from archive import ArchiveWriter, ArchiveReader, moveToArchive
+
+
+def _logins(day: int, n: int) -> list:
+    rows = []
+    for i in range(n):
+        row = {'time': datetime.datetime(2024, 1, day, 0, 0, i), 'address': f'user{i % 3}@example.com',
+               'type': ExLoginType.CLIENT, 'ip': f'10.0.0.{i}'}
+        row['content_hash'] = logHash(LoginLog, row)
+        rows.append(row)
+    return rows
+
+
+def _strip(rows: list) -> list:
+    return [{k: v for k, v in r.items() if k != 'content_hash'} for r in rows]
+
+
+def test_write_and_scan(tmp_path):
+    rows = _logins(1, 10) + _logins(2, 10)
+    with ArchiveWriter(str(tmp_path), 'login', blockRows=4) as writer:
+        writer.write(rows[::-1])
+    reader = ArchiveReader(str(tmp_path), 'login')
+    assert reader.partitions() == [datetime.date(2024, 1, 1), datetime.date(2024, 1, 2)]
+    assert list(reader.scan()) == _strip(rows)
+
+    start, end = datetime.datetime(2024, 1, 1, 0, 0, 5), datetime.datetime(2024, 1, 2, 0, 0, 2)
+    assert list(reader.scan(start, end)) == _strip([r for r in rows if start <= r['time'] < end])
+    assert list(reader.scan(address='user1@example.com')) == _strip([r for r in rows if r['address'] == 'user1@example.com'])
+    assert list(reader.scan(address='nobody@example.com')) == []
+    stats = reader.stats()
+    assert stats['2024-01-01']['rows'] == 10 and stats['2024-01-01']['segments'] == 1
+
+
+def test_unflushed_rows_are_not_visible(tmp_path):
+    writer = ArchiveWriter(str(tmp_path), 'login', blockRows=4)
+    writer.write(_logins(1, 10))
+    assert list(ArchiveReader(str(tmp_path), 'login').scan()) == []
+    writer.flush()
+    writer.write(_logins(1, 2))
+    writer.flush()
+    stats = ArchiveReader(str(tmp_path), 'login').stats()['2024-01-01']
+    assert stats['segments'] == 2 and stats['rows'] == 12
+
+
+def test_move_to_archive(tmp_path):
+    db = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "archive.db"}')
+    create_all(db)
+    rows = _logins(1, 10) + _logins(2, 10)
+    with sqlalchemy.orm.Session(db) as session:
+        session.begin()
+        upsertRows(session, LoginLog, rows)
+        session.commit()
+    assert moveToArchive(db, str(tmp_path / 'archive'), 'login', datetime.datetime(2024, 1, 2), batchSize=3, flushRows=4) == 10
+    with sqlalchemy.orm.Session(db) as session:
+        assert session.scalars(sqlalchemy.select(LoginLog.time)).all() == [r['time'] for r in rows[10:]]
+    assert list(ArchiveReader(str(tmp_path / 'archive'), 'login').scan()) == _strip(rows[:10])
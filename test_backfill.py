@@ -0,0 +1,56 @@
+import datetime
+import pytest
+import sqlalchemy
+from common import *
+from database import logHash
+from backfill import shardRanges, planShards, pendingShards, shardProgress, runBackfill, SHARD_DONE, SHARD_FAILED
+
+
+def _db(tmp_path):
+    db = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "backfill.db"}')
+    create_all(db)
+    return db
+
+
+def _fetch(address: str, dateFrom: datetime.date, dateTo: datetime.date) -> list:
+    row = {'time': datetime.datetime.combine(dateFrom, datetime.time(8)), 'address': address, 'type': ExLoginType.WEB, 'ip': '10.0.0.1'}
+    row['content_hash'] = logHash(LoginLog, row)
+    return [row]
+
+
+def test_shard_ranges():
+    ranges = list(shardRanges(datetime.date(2024, 1, 1), datetime.date(2024, 1, 5), 2))
+    assert ranges == [(datetime.date(2024, 1, 1), datetime.date(2024, 1, 2)), (datetime.date(2024, 1, 3), datetime.date(2024, 1, 4)),
+                      (datetime.date(2024, 1, 5), datetime.date(2024, 1, 5))]
+    with pytest.raises(ValueError):
+        list(shardRanges(datetime.date(2024, 1, 1), datetime.date(2024, 1, 5), 0))
+
+
+def test_backfill_resumes_unfinished_shards(tmp_path):
+    db = _db(tmp_path)
+    config = {'parallel': 2, 'batchSize': 4, 'recentKeys': 0}
+    start, end = datetime.date(2024, 1, 1), datetime.date(2024, 1, 3)
+    assert planShards(db, 'job', 'login', ['a', 'b'], start, end) == 6
+    # 再次规划同一任务不会改动已有分片
+    assert planShards(db, 'job', 'login', ['a', 'b', 'c'], start, end) == 0
+
+    # 第一次运行中 b 的分片全部失败
+    def flaky(address, dateFrom, dateTo):
+        return None if address == 'b' else _fetch(address, dateFrom, dateTo)
+
+    stats = runBackfill(db, config, 'job', LoginLog, flaky)
+    assert stats['failed'] == 3
+    assert shardProgress(db, 'job') == {SHARD_DONE: 3, SHARD_FAILED: 3}
+    assert [s[1] for s in pendingShards(db, 'job')] == ['b'] * 3
+
+    fetched = []
+
+    def fetch(address, dateFrom, dateTo):
+        fetched.append((address, dateFrom))
+        return _fetch(address, dateFrom, dateTo)
+
+    runBackfill(db, config, 'job', LoginLog, fetch)
+    assert sorted(fetched) == [('b', start), ('b', start + datetime.timedelta(days=1)), ('b', end)]
+    assert shardProgress(db, 'job') == {SHARD_DONE: 6}
+    with sqlalchemy.orm.Session(db) as session:
+        assert session.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(LoginLog)).scalar() == 6
@@ -0,0 +1,45 @@
+import datetime
+import sqlalchemy
+from common import *
+from database import upsertRows, logHash
+from bulkload import StagingFile, bulkLoad
+
+
+def _db(tmp_path):
+    db = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "bulk.db"}')
+    create_all(db)
+    return db
+
+
+def _mail(i: int, status: ExMailStatus = ExMailStatus.SEND_SUCCESS, subject: str = None) -> dict:
+    row = {'time': datetime.datetime(2024, 1, 1, 8, i), 'sender': 'a@example.com', 'receiver': 'b@example.com',
+           'subject': subject or f'mail {i}', 'type': ExMailType.SEND, 'status': status}
+    row['content_hash'] = logHash(MailLog, row)
+    return row
+
+
+def test_staging_file_round_trip(tmp_path):
+    staging = StagingFile(MailLog, str(tmp_path))
+    staging.add([_mail(0, subject='tab\\there\nnew line \\N'), dict(_mail(1), subject=None)])
+    staging.close()
+    rows = list(staging.read())
+    subject = staging.columns.index('subject')
+    assert rows[0][subject] == 'tab\\there\nnew line \\N'
+    assert rows[1][subject] is None
+    staging.remove()
+
+
+def test_bulk_load_merges_new_rows_once(tmp_path):
+    db = _db(tmp_path)
+    with sqlalchemy.orm.Session(db) as session:
+        session.begin()
+        upsertRows(session, MailLog, [_mail(0)])
+        session.commit()
+    staging = StagingFile(MailLog, str(tmp_path))
+    # 已存在的行、完全重复的行，以及摘要相同但状态不同的行
+    staging.add([_mail(0), _mail(1), _mail(1), _mail(2, ExMailStatus.SENDING), _mail(2, ExMailStatus.SEND_SUCCESS)])
+    assert bulkLoad(db, staging, batchSize=2) == 2
+    staging.remove()
+    with sqlalchemy.orm.Session(db) as session:
+        hashes = session.scalars(sqlalchemy.select(MailLog.content_hash)).all()
+    assert sorted(hashes) == sorted(_mail(i)['content_hash'] for i in range(3))
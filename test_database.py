@@ -0,0 +1,83 @@
+import json
+import hashlib
+import datetime
+import sqlalchemy
+from common import *
+from database import upsertRows, uniqueRows, logHash, mailBoxHash, DeadLetters, loadDeadLetters
+
+
+def _session():
+    db = sqlalchemy.create_engine('sqlite://')
+    create_all(db)
+    return sqlalchemy.orm.Session(db)
+
+
+def _mailBox(i: int) -> dict:
+    row = {'address': f'user{i}@example.com', 'department_id': '1', 'alias': '', 'need_reset_password': 0, 'enable': 1}
+    row['content_hash'] = mailBoxHash(row)
+    return row
+
+
+def test_upsert_distinct_mailboxes_with_same_attributes():
+    rows = [_mailBox(i) for i in range(50)]
+    assert len({r['content_hash'] for r in rows}) == 50
+    # content_hash 不是 mail_box 的键，即使摘要相同也不能合并不同的邮箱
+    rows = [dict(r, content_hash='0' * 32) for r in rows]
+    with _session() as session:
+        session.begin()
+        assert upsertRows(session, MailBox, rows, batchSize=16) == 50
+        session.commit()
+        assert session.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(MailBox)).scalar() == 50
+
+
+def test_duplicate_log_rows_are_merged():
+    row = {'time': datetime.datetime(2024, 1, 1, 8), 'address': 'a@example.com', 'type': ExLoginType.WEB, 'ip': '10.0.0.1'}
+    row['content_hash'] = logHash(LoginLog, row)
+    assert len(uniqueRows(LoginLog, [row, dict(row)])) == 1
+    with _session() as session:
+        session.begin()
+        upsertRows(session, LoginLog, [row, dict(row)])
+        upsertRows(session, LoginLog, [dict(row)])
+        session.commit()
+        assert session.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(LoginLog)).scalar() == 1
+
+
+def test_log_hash_format():
+    # 与已写入数据库的摘要保持一致，格式变化后须运行 migrateDedup --rehash
+    row = {'time': datetime.datetime(2024, 1, 1, 8), 'address': 'a@example.com', 'type': ExLoginType.WEB, 'ip': '10.0.0.1'}
+    assert logHash(LoginLog, row) == hashlib.md5(json.dumps(['2024-01-01T08:00:00', 'a@example.com', 'WEB', '10.0.0.1']).encode()).hexdigest()
+
+
+def _rollupCounts(session) -> dict:
+    stmt = sqlalchemy.select(MailRollup.status, MailRollup.count).where(MailRollup.grain == 'day')
+    return {status: count for status, count in session.execute(stmt)}
+
+
+def test_rollups_count_inserted_rows_and_move_status():
+    row = {'time': datetime.datetime(2024, 1, 1, 8), 'sender': 'a@example.com', 'receiver': 'b@example.com',
+           'subject': 'hello', 'type': ExMailType.SEND, 'status': ExMailStatus.SENDING}
+    row['content_hash'] = logHash(MailLog, row)
+    with _session() as session:
+        session.begin()
+        upsertRows(session, MailLog, [row])
+        upsertRows(session, MailLog, [dict(row)])
+        assert _rollupCounts(session) == {ExMailStatus.SENDING: 1}
+        upsertRows(session, MailLog, [dict(row, status=ExMailStatus.SEND_SUCCESS)])
+        session.commit()
+        assert _rollupCounts(session) == {ExMailStatus.SENDING: 0, ExMailStatus.SEND_SUCCESS: 1}
+        assert session.scalars(sqlalchemy.select(MailLog.status)).all() == [ExMailStatus.SEND_SUCCESS]
+
+
+def test_dead_letters_resolved_in_same_batch():
+    db = sqlalchemy.create_engine('sqlite://')
+    create_all(db)
+    day = datetime.date(2024, 1, 1)
+    deadLetters = DeadLetters(db)
+    deadLetters.failed('mail', 'a@example.com', day, day, 'timeout')
+    deadLetters.failed('mail', 'b@example.com', day, day, 'timeout')
+    deadLetters.resolved('mail', 'a@example.com', day, day)
+    deadLetters.flush()
+    assert [u[2] for u in loadDeadLetters(db)] == ['b@example.com']
+    deadLetters.resolved('mail', 'b@example.com', day, day)
+    deadLetters.flush()
+    assert loadDeadLetters(db) == []
@@ -0,0 +1,58 @@
+import json
+import pytest
+import departments
+from exmail import ExMailContactApi, ExMailApiError
+from departments import DepartmentIndex, getDepartmentIndex
+
+# id -> (父部门, 排序)
+TREE = {2: (1, 2), 3: (1, 1), 4: (2, 1), 5: (4, 1), 6: (3, 1)}
+
+
+class _Client(ExMailContactApi):
+    '''按 TREE 返回直接子部门，failing 中的部门返回错误码'''
+
+    def __init__(self, configName: str, failing: set = ()) -> None:
+        super().__init__(configName)
+        self.failing = failing
+
+    def _request(self, method, path, params=None, jsonData=None):
+        parent = params['id']
+        if parent in self.failing:
+            return {'errcode': 60003, 'errmsg': 'department not found'}
+        return {'errcode': 0, 'errmsg': 'ok', 'department': [
+            {'id': i, 'name': f'dept{i}', 'parentid': p, 'order': o} for i, (p, o) in TREE.items() if p == parent]}
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / 'contact.json'
+    path.write_text(json.dumps({'corpId': 'corp', 'corpSecret': 'secret', 'accessToken': None, 'accessTokenExpiry': None}))
+    return str(path)
+
+
+def test_full_department_list_and_index(config, tmp_path):
+    index = DepartmentIndex(_Client(config).getFullDepartmentList(parallel=2))
+    assert len(index) == 6
+    assert index.subtree(1) == [1, 3, 6, 2, 4, 5]
+    assert index.subtree(2) == [2, 4, 5]
+    assert index.isDescendant(5, 2) and not index.isDescendant(6, 2)
+    assert index.ancestors(5) == [4, 2, 1]
+    assert index.get(4).hasChild and not index.get(5).hasChild
+
+    filename = str(tmp_path / 'department.json')
+    index.save(filename)
+    loaded = DepartmentIndex.load(filename)
+    assert loaded.subtree(1) == index.subtree(1)
+
+
+def test_failed_subtree_is_not_saved_or_cached(config, tmp_path, monkeypatch):
+    monkeypatch.setattr(departments, '_cache', {})
+    filename = str(tmp_path / 'department.json')
+    with pytest.raises(ExMailApiError):
+        getDepartmentIndex(filename, _Client(config, failing={4}))
+    assert not (tmp_path / 'department.json').exists()
+    assert filename not in departments._cache
+
+    index = getDepartmentIndex(filename, _Client(config))
+    assert len(index) == 6
+    assert getDepartmentIndex(filename, _Client(config, failing={1})) is index
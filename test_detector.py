@@ -0,0 +1,65 @@
+import datetime
+import sqlalchemy
+from common import *
+from database import upsertRows, logHash
+from detector import LoginDetector, NEW_IP, IP_FANOUT, CLIENT_BURST
+
+T0 = datetime.datetime(2024, 1, 1, 8)
+
+
+def _login(address: str, ip: str, seconds: int, type: ExLoginType = ExLoginType.WEB) -> dict:
+    row = {'time': T0 + datetime.timedelta(seconds=seconds), 'address': address, 'type': type, 'ip': ip}
+    row['content_hash'] = logHash(LoginLog, row)
+    return row
+
+
+def _kinds(alerts: list) -> list:
+    return [(a['kind'], a['address'], a['ip']) for a in alerts]
+
+
+def test_new_ip_alerts_once_per_pair():
+    detector = LoginDetector()
+    assert detector.observe([_login('a', '10.0.0.1', 0)]) == []
+    alerts = detector.observe([_login('a', '10.0.0.2', 60), _login('a', '10.0.0.2', 120)])
+    assert _kinds(alerts) == [(NEW_IP, 'a', '10.0.0.2')]
+    assert detector.observe([_login('a', '10.0.0.1', 180)]) == []
+
+
+def test_ip_fanout():
+    detector = LoginDetector(fanoutWindow=600, fanoutUsers=3)
+    assert detector.observe([_login('a', '10.0.0.9', 0), _login('b', '10.0.0.9', 100)]) == []
+    # 窗口外的登录不计入
+    assert detector.observe([_login('c', '10.0.0.9', 1000)]) == []
+    alerts = detector.observe([_login('d', '10.0.0.9', 1100), _login('e', '10.0.0.9', 1200)])
+    assert _kinds(alerts) == [(IP_FANOUT, None, '10.0.0.9')]
+
+
+def test_client_burst_ignores_duplicate_rows():
+    detector = LoginDetector(burstWindow=60, burstLogins=3)
+    rows = [_login('a', '10.0.0.1', i, ExLoginType.CLIENT) for i in range(2)]
+    # 重叠的同步窗口再次送来相同的记录
+    assert detector.observe(rows + rows) == []
+    alerts = detector.observe([_login('a', '10.0.0.1', 10, ExLoginType.CLIENT)])
+    assert _kinds(alerts) == [(CLIENT_BURST, 'a', '10.0.0.1')]
+
+
+def test_seed_builds_baseline_without_alerts(tmp_path):
+    db = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "detector.db"}')
+    create_all(db)
+    now = datetime.datetime.now().replace(microsecond=0)
+    rows = []
+    for i, ip in enumerate(['10.0.0.1', '10.0.0.2']):
+        row = {'time': now - datetime.timedelta(days=1, seconds=i), 'address': 'a', 'type': ExLoginType.WEB, 'ip': ip}
+        row['content_hash'] = logHash(LoginLog, row)
+        rows.append(row)
+    with sqlalchemy.orm.Session(db) as session:
+        session.begin()
+        upsertRows(session, LoginLog, rows)
+        session.commit()
+    detector = LoginDetector()
+    assert detector.seed(db) == 2
+    assert detector.sizes()['users'] == 1
+    row = {'time': now, 'address': 'a', 'type': ExLoginType.WEB, 'ip': '10.0.0.2'}
+    assert detector.observe([dict(row, content_hash=logHash(LoginLog, row))]) == []
+    row['ip'] = '10.0.0.3'
+    assert _kinds(detector.observe([dict(row, content_hash=logHash(LoginLog, row))])) == [(NEW_IP, 'a', '10.0.0.3')]
@@ -0,0 +1,134 @@
+import json
+import time
+import asyncio
+import datetime
+import threading
+import pytest
+import requests
+from exmail import ExMailApi, ExMailApiError, RateController
+from asyncexmail import AsyncExMailApi
+
+
+class _Response:
+    def __init__(self, data: dict, status: int = 200) -> None:
+        self.status_code = status
+        self.content = json.dumps(data).encode()
+
+    def json(self) -> dict:
+        return json.loads(self.content)
+
+
+class _Session:
+    '''按顺序返回预设结果的假会话，异常会被抛出'''
+
+    def __init__(self, tokens: list, responses: list = None) -> None:
+        self.tokens = tokens
+        self.responses = responses or []
+        self.tokenCalls = 0
+
+    def get(self, url, params=None):
+        self.tokenCalls += 1
+        item = self.tokens.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        return _Response(item)
+
+    def request(self, method, url, params=None, json=None):
+        return _Response(self.responses.pop(0) if self.responses else {'errcode': 0, 'errmsg': 'ok'})
+
+
+def _client(tmp_path, monkeypatch, session: _Session) -> ExMailApi:
+    config = tmp_path / 'config.json'
+    config.write_text(json.dumps({'corpId': 'corp', 'corpSecret': 'secret', 'accessToken': None, 'accessTokenExpiry': None}))
+    control = RateController({'rate': 1000, 'retries': 4, 'deadline': 10})
+    control.retry.baseDelay = 0.01
+    monkeypatch.setattr(ExMailApi, '_rateControl', control)
+    client = ExMailApi(str(config))
+    client._session = session
+    return client
+
+
+def test_token_failure_releases_slot_and_retries(tmp_path, monkeypatch):
+    session = _Session([requests.ConnectionError('down'), {'access_token': 'tok', 'expires_in': 7200}])
+    client = _client(tmp_path, monkeypatch, session)
+    assert client._request('GET', 'user/get')['errcode'] == 0
+    assert session.tokenCalls == 2
+    assert client._rateControl.concurrency.inflight == 0
+
+
+def test_token_failure_gives_up_without_leaking(tmp_path, monkeypatch):
+    session = _Session([requests.ConnectionError('down')] * 4)
+    client = _client(tmp_path, monkeypatch, session)
+    with pytest.raises(ExMailApiError):
+        client._request('GET', 'user/get')
+    assert client._rateControl.concurrency.inflight == 0
+
+
+class _TokenSession:
+    '''每次请求令牌耗时 delay 秒，返回 tok1、tok2……'''
+
+    def __init__(self, delay: float = 0.1) -> None:
+        self.delay = delay
+        self.tokenCalls = 0
+        self._lock = threading.Lock()
+
+    def get(self, url, params=None):
+        with self._lock:
+            self.tokenCalls += 1
+            n = self.tokenCalls
+        time.sleep(self.delay)
+        return _Response({'access_token': f'tok{n}', 'expires_in': 7200})
+
+
+def test_expired_token_is_refreshed_once(tmp_path, monkeypatch):
+    session = _TokenSession()
+    client = _client(tmp_path, monkeypatch, session)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(client.getToken())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert session.tokenCalls == 1
+    assert tokens == ['tok1'] * 8
+    # 新令牌写回配置文件
+    assert json.loads((tmp_path / 'config.json').read_text())['accessToken'] == 'tok1'
+
+
+def test_expiring_token_is_refreshed_in_background(tmp_path, monkeypatch):
+    session = _TokenSession(delay=0.2)
+    client = _client(tmp_path, monkeypatch, session)
+    client._token = 'old'
+    client._tokenExpiry = datetime.datetime.now() + datetime.timedelta(minutes=5)
+    started = time.monotonic()
+    # 仍可用的令牌立即返回，只有一个后台线程刷新
+    assert [client.getToken() for _ in range(5)] == ['old'] * 5
+    assert time.monotonic() - started < 0.1
+    with client._tokenLock:
+        pass
+    assert session.tokenCalls == 1
+    assert client.getToken() == 'tok1'
+
+
+def test_invalidate_only_affects_the_rejected_token(tmp_path, monkeypatch):
+    session = _TokenSession(delay=0)
+    client = _client(tmp_path, monkeypatch, session)
+    assert client.getToken() == 'tok1'
+    client._invalidateToken('stale')
+    assert client.getToken() == 'tok1'
+    client._invalidateToken('tok1')
+    assert client.getToken() == 'tok2'
+    assert session.tokenCalls == 2
+
+
+def test_async_clients_share_one_refresh(tmp_path, monkeypatch):
+    session = _TokenSession()
+    _client(tmp_path, monkeypatch, session)
+
+    async def run():
+        async with AsyncExMailApi(str(tmp_path / 'config.json')) as client:
+            client._session = session
+            return await asyncio.gather(*[client.getTokenAsync() for _ in range(8)])
+
+    assert asyncio.run(run()) == ['tok1'] * 8
+    assert session.tokenCalls == 1
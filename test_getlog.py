@@ -0,0 +1,115 @@
+import json
+import datetime
+import threading
+import sqlalchemy
+from common import *
+from database import logHash, getDB, mailBoxHash
+from lease import LEASE_DONE
+from mockserver import MockExMail, startServer, baseUrl
+import getlog
+
+
+def test_row_hashes_match_log_hash():
+    rows = [
+        (LoginLog, getlog.loginLogRow('a@example.com', {'time': 1704067200, 'type': 1, 'ip': '10.0.0.1'})),
+        (MailLog, getlog.mailLogRow({'time': 1704067200, 'sender': 'a@example.com', 'receiver': 'b@example.com',
+                                     'subject': '主题', 'status': 3, 'mailtype': 1})),
+        (OpLog, getlog.opLogRow({'time': 1704067200, 'operator': 'admin@example.com', 'operand': 'a@example.com', 'type': 19})),
+    ]
+    for model, row in rows:
+        assert row['content_hash'] == logHash(model, row)
+
+
+def test_worker_finishes_round(tmp_path, monkeypatch):
+    mock = MockExMail(users=6, latency=0)
+    server = startServer(mock)
+    monkeypatch.setattr(getlog.ExMailApi, '_base', baseUrl(server))
+    monkeypatch.setattr(getlog.ExMailApi, '_rateControl', getlog.RateController({'rate': 1000}))
+    clientConfig = tmp_path / 'log.json'
+    clientConfig.write_text(json.dumps({'corpId': 'mock', 'corpSecret': 'mock', 'accessToken': None, 'accessTokenExpiry': None}))
+    # batchSize 远大于数据量：只有写入线程在队列空闲时提交，邮箱才会完成
+    config = {'db': {'url': f'sqlite:///{tmp_path / "worker.db"}'}, 'parallel': 2, 'batchSize': 10000, 'flushInterval': 0.1}
+    db = getDB(config['db'])
+    create_all(db)
+    mailboxes = [{'address': mock.userId(i), 'department_id': '1', 'alias': '', 'need_reset_password': 0, 'enable': 1} for i in range(6)]
+    with sqlalchemy.orm.Session(db) as session:
+        session.begin()
+        session.execute(sqlalchemy.insert(MailBox), [dict(m, content_hash=mailBoxHash(m)) for m in mailboxes])
+        session.commit()
+
+    result = {}
+    try:
+        client = getlog.ExMailLogApi(str(clientConfig))
+        t = threading.Thread(target=lambda: result.update(getlog.workerLogs(client, config, 'login', 'login:test', 'w1')), daemon=True)
+        t.start()
+        t.join(30)
+        assert not t.is_alive(), 'worker did not finish the round'
+    finally:
+        server.shutdown()
+
+    assert result['tasks'] == 6 and result['failed'] == 0
+    with sqlalchemy.orm.Session(db) as session:
+        states = session.scalars(sqlalchemy.select(SyncLease.state)).all()
+        assert states == [LEASE_DONE] * 6
+        assert session.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(LoginLog)).scalar() == result['written'] > 0
+
+
+class _OpClient:
+    '''按 (日期, 查询类别) 返回操作记录：busy 当天的 ALL 查询返回 limit 条（被截断），各类别各 1 条；failing 当天抛出异常'''
+
+    def __init__(self, busy: datetime.date, failing: datetime.date = None, limit: int = 5) -> None:
+        self.busy = busy
+        self.failing = failing
+        self.limit = limit
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _logs(self, day: datetime.date, queryType: ExMailOpQueryType, n: int) -> list:
+        base = int(datetime.datetime.combine(day, datetime.time(8)).timestamp())
+        return [{'time': base + queryType.value * 100 + i, 'operator': 'admin@example.com', 'operand': f'{queryType.name}{i}', 'type': 1}
+                for i in range(n)]
+
+    def getOpLog(self, dateFrom: datetime.date, dateTo: datetime.date, type: ExMailOpQueryType = ExMailOpQueryType.ALL) -> list:
+        with self._lock:
+            self.calls.append((dateFrom, dateTo, type))
+        if self.failing is not None and dateFrom <= self.failing <= dateTo:
+            raise getlog.ExMailApiError(-1, 'busy')
+        logs = []
+        day = dateFrom
+        while day <= dateTo:
+            if day == self.busy:
+                logs += self._logs(day, type, self.limit if type is ExMailOpQueryType.ALL else 1)
+            elif type is ExMailOpQueryType.ALL:
+                logs += self._logs(day, type, 1)
+            day += datetime.timedelta(days=1)
+        return logs
+
+
+def test_op_shards():
+    d1, d2 = datetime.date(2024, 1, 1), datetime.date(2024, 1, 3)
+    assert getlog.planOpShards(d1, d2) == [(d, d, ExMailOpQueryType.ALL) for d in (d1, d1 + datetime.timedelta(days=1), d2)]
+    assert len(getlog.planOpShards(d1, d2, byType=True)) == 3 * len(getlog.OP_QUERY_CATEGORIES)
+    assert getlog.planOpShards(d1, d2, shardDays=2) == [(d1, d1 + datetime.timedelta(days=1), ExMailOpQueryType.ALL),
+                                                        (d2, d2, ExMailOpQueryType.ALL)]
+    assert getlog.splitOpShard((d1, d2, ExMailOpQueryType.ALL)) == [(d1, d1 + datetime.timedelta(days=1), ExMailOpQueryType.ALL),
+                                                                    (d2, d2, ExMailOpQueryType.ALL)]
+    assert getlog.splitOpShard((d1, d1, ExMailOpQueryType.ALL)) == [(d1, d1, t) for t in getlog.OP_QUERY_CATEGORIES]
+    assert getlog.splitOpShard((d1, d1, ExMailOpQueryType.BLACKLIST)) == []
+
+
+def test_fetch_op_shards_splits_truncated_shards():
+    d1, d2 = datetime.date(2024, 1, 1), datetime.date(2024, 1, 4)
+    busy = datetime.date(2024, 1, 3)
+    client = _OpClient(busy, failing=datetime.date(2024, 1, 4))
+    rows, stats = getlog.fetchOpShards(client, getlog.planOpShards(d1, d2, shardDays=2), parallel=2, limit=5)
+    # 1-2 日的分片正常；3-4 日的分片先失败
+    assert stats['failed'] == ['2024-01-03~2024-01-04/ALL']
+    assert len(rows) == 2 and stats['split'] == 0
+
+    client = _OpClient(busy)
+    rows, stats = getlog.fetchOpShards(client, getlog.planOpShards(d1, d2, shardDays=2), parallel=2, limit=5)
+    # 3-4 日被截断：先按天拆分，3 日的 ALL 再拆为各类别
+    assert stats['split'] == 2 and stats['truncated'] == [] and stats['failed'] == []
+    assert (busy, busy, ExMailOpQueryType.BLACKLIST) in client.calls
+    assert len(rows) == 3 + len(getlog.OP_QUERY_CATEGORIES)
+    assert len({r['content_hash'] for r in rows}) == len(rows)
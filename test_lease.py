@@ -0,0 +1,91 @@
+import datetime
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from common import *
+from lease import LeaseWorker, seedStatement, LEASE_PENDING, LEASE_DONE, LEASE_FAILED
+
+
+def _db(tmp_path):
+    db = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "lease.db"}')
+    create_all(db)
+    return db
+
+
+def _leases(db) -> dict:
+    with sqlalchemy.orm.Session(db) as session:
+        return {l.address: l for l in session.scalars(sqlalchemy.select(SyncLease))}
+
+
+def test_seed_ignores_existing_mailboxes(tmp_path):
+    db = _db(tmp_path)
+    LeaseWorker(db, 'r1', 'w1').seed(['a', 'b'])
+    LeaseWorker(db, 'r1', 'w2').seed(['b', 'c'], batchSize=1)
+    leases = _leases(db)
+    assert sorted(leases) == ['a', 'b', 'c']
+    assert leases['b'].priority == 1
+
+
+def test_seed_statement_on_postgresql():
+    sql = str(seedStatement('postgresql').compile(dialect=postgresql.dialect()))
+    assert 'ON CONFLICT (sync_round, address) DO NOTHING' in sql
+
+
+def test_claims_are_exclusive(tmp_path):
+    db = _db(tmp_path)
+    w1, w2 = LeaseWorker(db, 'r1', 'w1', claimSize=2), LeaseWorker(db, 'r1', 'w2', claimSize=2)
+    w1.seed(['a', 'b', 'c'])
+    assert w1.claim() == ['a', 'b']
+    assert w2.claim() == ['c']
+    assert w2.claim() == []
+    w1.done('a')
+    # 只能完成自己持有的邮箱
+    w2.done('b')
+    leases = _leases(db)
+    assert leases['a'].state == LEASE_DONE and leases['b'].state == LEASE_PENDING
+    assert w1.remaining() == 2
+
+
+def test_expired_lease_is_reclaimed_and_renewal_extends_it(tmp_path):
+    db = _db(tmp_path)
+    w1, w2 = LeaseWorker(db, 'r1', 'w1', leaseSeconds=60), LeaseWorker(db, 'r1', 'w2', leaseSeconds=60)
+    w1.seed(['a', 'b'])
+    assert w1.claim() == ['a', 'b']
+    before = _leases(db)['a'].lease_until
+    assert w1.renew() == 2
+    assert _leases(db)['a'].lease_until > before
+
+    # 模拟 w1 卡死：租约过期后由 w2 接手，w1 之后的完成标记不再生效
+    with sqlalchemy.orm.Session(db) as session:
+        session.begin()
+        session.execute(sqlalchemy.update(SyncLease).values(lease_until=datetime.datetime.now() - datetime.timedelta(seconds=1)))
+        session.commit()
+    assert w2.claim() == ['a', 'b']
+    assert w1.renew() == 0
+    w1.done('a')
+    leases = _leases(db)
+    assert leases['a'].owner == 'w2' and leases['a'].state == LEASE_PENDING and leases['a'].attempts == 2
+
+
+def test_failed_mailbox_is_retried_until_max_attempts(tmp_path):
+    db = _db(tmp_path)
+    worker = LeaseWorker(db, 'r1', 'w1', maxAttempts=2)
+    worker.seed(['a'])
+    assert worker.claim() == ['a']
+    worker.failed('a')
+    assert _leases(db)['a'].state == LEASE_PENDING
+    assert worker.claim() == ['a']
+    worker.failed('a')
+    assert _leases(db)['a'].state == LEASE_FAILED
+    assert worker.remaining() == 0
+    assert list(worker.tasks()) == []
+
+
+def test_tasks_returns_after_own_mailboxes_finish(tmp_path):
+    db = _db(tmp_path)
+    worker = LeaseWorker(db, 'r1', 'w1', claimSize=1)
+    worker.seed(['a', 'b'])
+    seen = []
+    for address in worker.tasks():
+        seen.append(address)
+        worker.done(address)
+    assert seen == ['a', 'b']
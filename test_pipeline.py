@@ -0,0 +1,98 @@
+import asyncio
+import datetime
+import sqlalchemy
+from common import *
+from database import logHash
+from pipeline import runPipeline, runAsyncPipeline
+
+
+def _db(tmp_path):
+    db = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "pipeline.db"}')
+    create_all(db)
+    return db
+
+
+def _logins(address: str, n: int) -> list:
+    rows = []
+    for i in range(n):
+        row = {'time': datetime.datetime(2024, 1, 1, 0, i), 'address': address, 'type': ExLoginType.WEB, 'ip': f'10.0.0.{i}'}
+        row['content_hash'] = logHash(LoginLog, row)
+        rows.append(row)
+    return rows
+
+
+def _count(db) -> int:
+    with sqlalchemy.orm.Session(db) as session:
+        return session.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(LoginLog)).scalar()
+
+
+def _fetch(task):
+    if task == 'none':
+        return None
+    if task == 'raise':
+        raise RuntimeError('unexpected')
+    if task == 'empty':
+        return []
+    return _logins(task, 7)
+
+
+def test_commit_and_fail_accounting(tmp_path):
+    db = _db(tmp_path)
+    committed, failed = [], []
+    # 每个任务 7 行拆成 3 个数据块，跨越多个写入批次
+    config = {'parallel': 3, 'batchSize': 3, 'writers': 2, 'recentKeys': 0}
+    tasks = ['a', 'none', 'b', 'raise', 'empty', 'c']
+    stats = runPipeline(db, LoginLog, tasks, _fetch, config, committed.append, failed.append)
+    assert sorted(committed) == ['a', 'b', 'c', 'empty']
+    assert sorted(failed) == ['none', 'raise']
+    assert stats['tasks'] == 6 and stats['failed'] == 2
+    assert stats['fetched'] == stats['written'] == _count(db) == 21
+
+
+def test_final_flush_commits_partial_batch(tmp_path):
+    db = _db(tmp_path)
+    committed = []
+    # 不足一批且不按空闲时间提交：只能在流水线结束时写入
+    config = {'parallel': 2, 'batchSize': 1000, 'flushInterval': None, 'recentKeys': 0}
+    stats = runPipeline(db, LoginLog, ['a', 'b'], _fetch, config, committed.append)
+    assert sorted(committed) == ['a', 'b']
+    assert stats['written'] == _count(db) == 14
+
+
+def test_write_failure_fails_every_task_in_batch(tmp_path):
+    db = _db(tmp_path)
+    committed, failed = [], []
+    config = {'parallel': 1, 'batchSize': 1000, 'flushInterval': None, 'recentKeys': 0}
+
+    def fetch(task):
+        rows = _logins(task, 2)
+        if task == 'bad':
+            rows[0]['unknown_column'] = 1
+        return rows
+
+    stats = runPipeline(db, LoginLog, ['a', 'bad'], fetch, config, committed.append, failed.append)
+    assert committed == [] and sorted(failed) == ['a', 'bad']
+    assert stats['failed'] == 2 and stats['written'] == 0
+
+
+def test_recent_keys_skip_rows_already_written(tmp_path):
+    db = _db(tmp_path)
+    config = {'parallel': 1, 'batchSize': 100, 'recentKeys': 100}
+    runPipeline(db, LoginLog, ['recent'], _fetch, config)
+    stats = runPipeline(db, LoginLog, ['recent'], _fetch, config)
+    assert stats['skipped'] == 7 and stats['written'] == 0
+    assert _count(db) == 7
+
+
+def test_async_pipeline(tmp_path):
+    db = _db(tmp_path)
+    committed, failed = [], []
+
+    async def fetch(task):
+        await asyncio.sleep(0)
+        return _fetch(task)
+
+    config = {'batchSize': 3, 'recentKeys': 0}
+    stats = asyncio.run(runAsyncPipeline(db, LoginLog, ['a', 'none', 'raise', 'b'], fetch, config, 2, committed.append, failed.append))
+    assert sorted(committed) == ['a', 'b'] and sorted(failed) == ['none', 'raise']
+    assert stats['written'] == _count(db) == 14
@@ -0,0 +1,76 @@
+import json
+import datetime
+import sqlalchemy
+from common import *
+from database import upsertRows, logHash
+from query import queryConditions, queryStatement, parseCursor, streamRows, explainQuery, runQuery
+
+T0 = datetime.datetime(2024, 1, 1, 8)
+
+
+def _db(tmp_path):
+    db = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "query.db"}')
+    create_all(db)
+    rows = []
+    for i in range(25):
+        # 每三行时间相同，分页边界落在同一时间的行之间
+        row = {'time': T0 + datetime.timedelta(minutes=i // 3), 'address': f'user{i % 2}@example.com',
+               'type': ExLoginType.WEB if i % 5 else ExLoginType.CLIENT, 'ip': f'10.0.0.{i}'}
+        row['content_hash'] = logHash(LoginLog, row)
+        rows.append(row)
+    with sqlalchemy.orm.Session(db) as session:
+        session.begin()
+        upsertRows(session, LoginLog, rows)
+        session.commit()
+    return db
+
+
+def _keys(rows) -> list:
+    return [(r['time'], r['id']) for r in rows]
+
+
+def test_keyset_pages_match_single_query(tmp_path):
+    db = _db(tmp_path)
+    conditions = queryConditions(LoginLog)
+    full = list(streamRows(db, LoginLog, conditions, serverSide=True))
+    assert len(full) == 25 and _keys(full) == sorted(_keys(full))
+    for pageSize in (1, 4, 25, 100):
+        assert list(streamRows(db, LoginLog, conditions, pageSize=pageSize)) == full
+    assert list(streamRows(db, LoginLog, conditions, pageSize=4, limit=10)) == full[:10]
+    # 从第 10 行继续
+    after = (full[9]['time'], full[9]['id'])
+    assert list(streamRows(db, LoginLog, conditions, after, pageSize=4)) == full[10:]
+
+
+def test_filters(tmp_path):
+    db = _db(tmp_path)
+    conditions = queryConditions(LoginLog, T0 + datetime.timedelta(minutes=2), T0 + datetime.timedelta(minutes=6),
+                                 address='user1@example.com', type='web', ip=None)
+    rows = list(streamRows(db, LoginLog, conditions, pageSize=2))
+    assert rows and all(r['address'] == 'user1@example.com' and r['type'] is ExLoginType.WEB for r in rows)
+    assert all(T0 + datetime.timedelta(minutes=2) <= r['time'] < T0 + datetime.timedelta(minutes=6) for r in rows)
+    assert len(rows) == 5
+
+
+def test_address_filter_uses_composite_index(tmp_path):
+    db = _db(tmp_path)
+    stmt = queryStatement(LoginLog, queryConditions(LoginLog, address='user1@example.com'), (T0, 1), 10)
+    plan = '\n'.join(explainQuery(db, stmt))
+    assert 'ix_login_log_address_time' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+def test_run_query_writes_ndjson_and_resumes(tmp_path, caplog):
+    db = _db(tmp_path)
+    output = str(tmp_path / 'out.ndjson')
+    caplog.set_level('INFO')
+    assert runQuery(db, 'login', output=output, pageSize=4, limit=7) == 7
+    with open(output) as fp:
+        first = [json.loads(line) for line in fp]
+    cursor = caplog.records[-1].getMessage().rsplit('--after ', 1)[1]
+    assert parseCursor(cursor) == (datetime.datetime.fromisoformat(first[-1]['time']), first[-1]['id'])
+    assert runQuery(db, 'login', after=cursor, output=output, pageSize=4) == 18
+    with open(output) as fp:
+        rest = [json.loads(line) for line in fp]
+    assert [r['id'] for r in first + rest] == [r['id'] for r in streamRows(db, LoginLog, [], serverSide=True)]
+    assert first[0]['type'] in ('WEB', 'CLIENT')
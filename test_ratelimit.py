@@ -0,0 +1,76 @@
+import time
+import asyncio
+import pytest
+from ratelimit import *
+
+
+def test_classify():
+    assert classify(200, 0) == OK
+    assert classify(429) == THROTTLED
+    assert classify(502) == THROTTLED
+    assert classify(200, 45009) == THROTTLED
+    assert classify(200, 42001) == TOKEN_EXPIRED
+    assert classify(200, 60111) == FAILED
+
+
+def test_token_bucket_burst_then_rate():
+    bucket = TokenBucket(rate=10, capacity=3)
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+    # 桶已空，之后每个令牌需要等待 1 / rate 秒
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+
+def test_token_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(rate=100, capacity=2)
+    bucket.reserve(2)
+    time.sleep(0.1)
+    assert bucket.reserve(2) == 0
+    assert bucket.reserve() > 0
+
+
+def test_adaptive_concurrency_aimd():
+    concurrency = AdaptiveConcurrency(initial=4, minimum=1, maximum=5)
+    assert all(concurrency.acquire(0) for _ in range(4))
+    assert not concurrency.acquire(0)
+    concurrency.release()
+    assert concurrency.acquire(0)
+    # 成功时每次增加 1 / limit，被限流时减半，且不超出 [minimum, maximum]
+    concurrency.onSuccess()
+    assert concurrency.limit == 4.25
+    for _ in range(20):
+        concurrency.onSuccess()
+    assert concurrency.limit == 5
+    concurrency.onThrottle()
+    assert concurrency.limit == 2.5
+    for _ in range(5):
+        concurrency.onThrottle()
+    assert concurrency.limit == 1
+
+
+def test_rate_controller_release_adjusts_limit():
+    control = RateController({'rate': 1000, 'concurrency': 8})
+    assert control.acquire('log/mail', control.deadline())
+    control.release(THROTTLED)
+    assert control.concurrency.limit == 4
+    assert control.concurrency.inflight == 0
+
+
+def test_async_concurrency_waits_without_polling():
+    async def run():
+        concurrency = AsyncAdaptiveConcurrency(2)
+        assert await concurrency.acquire(0)
+        assert await concurrency.acquire(0)
+        assert not await concurrency.acquire(0.01)
+        waiter = asyncio.ensure_future(concurrency.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        await concurrency.release(OK)
+        assert await asyncio.wait_for(waiter, 1)
+        await concurrency.release(OK)
+        await concurrency.release(THROTTLED)
+        return concurrency
+
+    concurrency = asyncio.run(run())
+    assert concurrency.inflight == 0
+    assert concurrency.limit == 1
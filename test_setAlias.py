@@ -0,0 +1,72 @@
+import sqlalchemy
+from common import *
+from database import mailBoxHash
+from setAlias import readInput, readReport, setAliases, OK, SKIPPED, FAILED
+
+
+class _Client:
+    '''记录 updateMember 调用，failing 中的邮箱返回失败'''
+
+    def __init__(self, failing: set = ()) -> None:
+        self.failing = failing
+        self.calls = []
+
+    def updateMember(self, userid: str, data: dict) -> bool:
+        self.calls.append((userid, data['slaves']))
+        return userid not in self.failing
+
+
+def _db(tmp_path):
+    db = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "alias.db"}')
+    create_all(db)
+    rows = []
+    for i, alias in enumerate(['a0@m.example.com', '', 'old@m.example.com']):
+        row = {'address': f'u{i}@example.com', 'department_id': '1', 'alias': alias, 'need_reset_password': 0, 'enable': 1}
+        rows.append(dict(row, content_hash=mailBoxHash(row)))
+    with sqlalchemy.orm.Session(db) as session:
+        session.begin()
+        session.execute(sqlalchemy.insert(MailBox), rows)
+        session.commit()
+    return db
+
+
+def _aliases(db) -> dict:
+    with sqlalchemy.orm.Session(db) as session:
+        return dict(session.execute(sqlalchemy.select(MailBox.address, MailBox.alias)).all())
+
+
+def test_read_input(tmp_path):
+    path = tmp_path / 'input.txt'
+    path.write_text('u0\tname\ta0@m.example.com\nshort\nu1@other.com\tname\ta1@m.example.com\r\n', encoding='utf-8')
+    assert list(readInput(str(path), domain='example.com')) == [('u0@example.com', 'a0@m.example.com'),
+                                                               ('u1@other.com', 'a1@m.example.com')]
+
+
+def test_rerun_skips_completed_users(tmp_path):
+    db = _db(tmp_path)
+    report = str(tmp_path / 'report.tsv')
+    rows = [('u0@example.com', 'a0@m.example.com'), ('u1@example.com', 'a1@m.example.com'), ('u2@example.com', 'a2@m.example.com')]
+
+    client = _Client(failing={'u1@example.com'})
+    stats = setAliases(client, db, rows, report, merge=True, parallel=2, batchSize=2)
+    assert (stats[OK], stats[SKIPPED], stats[FAILED]) == (1, 1, 1)
+    assert sorted(client.calls) == [('u1@example.com', ['a1@m.example.com']),
+                                    ('u2@example.com', ['old@m.example.com', 'a2@m.example.com'])]
+    assert readReport(report) == {'u0@example.com', 'u2@example.com'}
+    assert _aliases(db)['u2@example.com'] == 'old@m.example.com,a2@m.example.com'
+
+    # 重新运行只处理上次失败的用户
+    client = _Client()
+    stats = setAliases(client, db, rows, report, merge=True, parallel=2, batchSize=2)
+    assert stats['resumed'] == 2 and stats[OK] == 1
+    assert client.calls == [('u1@example.com', ['a1@m.example.com'])]
+    assert _aliases(db)['u1@example.com'] == 'a1@m.example.com'
+    assert readReport(report) == {'u0@example.com', 'u1@example.com', 'u2@example.com'}
+
+
+def test_dry_run_does_not_update(tmp_path):
+    db = _db(tmp_path)
+    client = _Client()
+    stats = setAliases(client, db, [('u2@example.com', 'a2@m.example.com')], str(tmp_path / 'report.tsv'), dryRun=True)
+    assert stats['planned'] == 1 and client.calls == []
+    assert _aliases(db)['u2@example.com'] == 'old@m.example.com'